@@ -14,5 +14,7 @@ setup(
   install_requires=["requests"],
   entry_points={"console_scripts": [
           'tldl = tablo_downloader.tablo:main',
-          'tldlapis = tablo_downloader.apis:main']},
+          'tldlapis = tablo_downloader.apis:main',
+          'tldlemu = tablo_downloader.emulator:main',
+          'tldlbench = tablo_downloader.benchmark:main']},
 )
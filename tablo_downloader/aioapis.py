@@ -0,0 +1,319 @@
+"""Asyncio versions of the Tablo APIs in tablo_downloader.apis.
+
+Each API coroutine takes the same arguments and returns the same results,
+including the error dicts, as its synchronous counterpart; responses are
+converted by apis.parse_response. Requests are made with a small HTTP/1.1
+client built on asyncio streams that keeps a pool of keep-alive connections
+per host, so one event loop can drive many requests across devices, e.g.
+
+    async with aioapis.AsyncClient() as client:
+        infos = await asyncio.gather(
+            *[aioapis.server_information(ip, client=client) for ip in ips])
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import ssl
+import time
+import urllib.parse
+
+from tablo_downloader import apis
+from tablo_downloader import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_HEADER_LINES = 100
+
+
+class AsyncClient:
+    """An asyncio HTTP client for Tablo API calls.
+
+    Like apis.Client, at most pool_size connections are open to each host
+    and reused between requests, timeout is a (connect, read) pair, and a
+    transport with an async request(method, url, **kwargs) method may be
+    given to replace the network.
+    """
+
+    def __init__(self, pool_size=apis.DEFAULT_POOL_SIZE,
+                 timeout=(apis.DEFAULT_CONNECT_TIMEOUT,
+                          apis.DEFAULT_READ_TIMEOUT),
+                 headers=None, transport=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.transport = transport
+        self._idle = collections.defaultdict(list)
+        self._limits = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        idle, self._idle = self._idle, collections.defaultdict(list)
+        for connections in idle.values():
+            for _, writer in connections:
+                writer.close()
+
+    async def request(self, method, url, data=None, headers=None):
+        """Make a request, sending data, if given, as a JSON body."""
+        if self.transport is not None:
+            kwargs = {} if data is None else {'json': data}
+            return await self.transport.request(method, url, **kwargs)
+        parts = urllib.parse.urlsplit(url)
+        secure = parts.scheme == 'https'
+        key = (parts.scheme, parts.hostname,
+               parts.port or (443 if secure else 80))
+        limit = self._limits.setdefault(
+            key, asyncio.Semaphore(max(1, self.pool_size)))
+        body = b''
+        request_headers = dict(self.headers, **(headers or {}))
+        if data is not None:
+            body = json.dumps(data).encode()
+            request_headers['Content-Type'] = 'application/json'
+        async with limit:
+            # A pooled connection may have been closed by the server, so a
+            # request on one that fails before any response is retried once
+            # on a new connection.
+            while True:
+                reused = bool(self._idle[key])
+                reader, writer = await self._connect(key, secure)
+                try:
+                    response, keep_alive = await self._send(
+                        reader, writer, method, parts, body, request_headers)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep_alive:
+                    self._idle[key].append((reader, writer))
+                else:
+                    writer.close()
+                return response
+
+    async def _connect(self, key, secure):
+        while self._idle[key]:
+            reader, writer = self._idle[key].pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        _, host, port = key
+        return await asyncio.wait_for(
+            asyncio.open_connection(
+                host, port, ssl=ssl.create_default_context() if secure
+                else None),
+            self.timeout[0])
+
+    async def _send(self, reader, writer, method, parts, body, headers):
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        lines = ['%s %s HTTP/1.1' % (method, path),
+                 'Host: %s' % parts.netloc,
+                 'Accept-Encoding: identity',
+                 'Connection: keep-alive']
+        if body or method in ('POST', 'PUT'):
+            lines.append('Content-Length: %d' % len(body))
+        lines.extend('%s: %s' % item for item in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') +
+                     body)
+        await writer.drain()
+        return await asyncio.wait_for(
+            self._read_response(reader, method), self.timeout[1])
+
+    async def _read_response(self, reader, method):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by server')
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        status = int(status)
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = (version == 'HTTP/1.1' and
+                      headers.get('connection', '').lower() != 'close')
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            content = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = await _read_chunked(reader)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            keep_alive = False
+        return apis.Response(status, headers, content), keep_alive
+
+
+async def _read_chunked(reader):
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b';')[0].strip(), 16)
+        if not size:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+    while (await reader.readline()).strip():  # Skip any trailers.
+        pass
+    return b''.join(chunks)
+
+
+_CLIENTS = {}
+
+
+def default_client():
+    """Return a shared AsyncClient for the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in _CLIENTS:
+        _CLIENTS.clear()
+        _CLIENTS[loop] = AsyncClient()
+    return _CLIENTS[loop]
+
+
+async def call_api(url, method="GET", output="json", data=None, client=None):
+    LOGGER.debug('[%s] [%s] [%s]', url, method, output)
+    client = client or default_client()
+    start = time.monotonic()
+    try:
+        req = await client.request(method, url, data=data)
+    except Exception as e:
+        metrics.METRICS.record(method, url, time.monotonic() - start,
+                               exception=e)
+        return {
+            'error': 'API call [%s] failed' % url,
+            'exception': e
+        }
+    metrics.METRICS.record(method, url, time.monotonic() - start,
+                           status_code=req.status_code,
+                           size=len(req.content or b''))
+    return apis.parse_response(url, req, output)
+
+
+async def local_server_info(client=None):
+    """Get server information for local Tablo servers."""
+    return await call_api(apis.TABLO_SERVERS_URL, client=client)
+
+
+async def server_settings(ip, client=None):
+    """Return the system settings for a Tablo server."""
+    url = apis.SETTINGS_URL.format(ip=ip)
+    return await call_api(url, client=client)
+
+
+async def server_information(ip, client=None):
+    """Return system information about a Tablo server."""
+    url = apis.SRVR_INFORMATION_URL.format(ip=ip)
+    return await call_api(url, client=client)
+
+
+async def server_capabilities(ip, client=None):
+    """Return the capabilities of a Tablo server."""
+    url = apis.SRVR_CAPABILITIES_URL.format(ip=ip)
+    return await call_api(url, client=client)
+
+
+async def server_channels(ip, client=None):
+    """Return the available channels for a Tablo server."""
+    url = apis.CHANNELS_URL.format(ip=ip)
+    return await call_api(url, client=client)
+
+
+async def server_recordings(ip, client=None):
+    """Get a list of recording IDs for a Tablo server."""
+    url = apis.RCRDS_LIST_URL.format(ip=ip)
+    return await call_api(url, client=client)
+
+
+async def server_series(ip, client=None):
+    """Return the recorded series paths for a Tablo server."""
+    url = apis.SERIES_LIST_URL.format(ip=ip)
+    return await call_api(url, client=client)
+
+
+async def delete_recording(ip, recording_id, client=None):
+    """Delete a recording from a Tablo server."""
+    url = apis.RCRD_DETAILS_URL.format(ip=ip, recording_id=recording_id)
+    return await call_api(url, method='DELETE', output='text', client=client)
+
+
+async def recording_details(ip, recording_id=None, client=None):
+    if not recording_id:  # Get an arbitrary recording ID.
+        recording_id = (await server_recordings(ip, client=client))[0]
+    url = apis.RCRD_DETAILS_URL.format(ip=ip, recording_id=recording_id)
+    return await call_api(url, client=client)
+
+
+async def batch_details(ip, paths, chunk_size=apis.BATCH_CHUNK_SIZE,
+                        client=None):
+    """Return details for many recording or series paths.
+
+    Like apis.batch_details, but the chunks are requested concurrently.
+    """
+    url = apis.BATCH_URL.format(ip=ip)
+    paths = list(paths)
+    chunks = await asyncio.gather(*[
+        call_api(url, method='POST', data=paths[start:start + chunk_size],
+                 client=client)
+        for start in range(0, len(paths), chunk_size)])
+    res = {}
+    for chunk in chunks:
+        if not isinstance(chunk, dict):
+            return {'error': 'API [%s] unexpected result [%s]' % (url, chunk)}
+        if 'error' in chunk:
+            return chunk
+        res.update(chunk)
+    return res
+
+
+async def series_details(ip, series_id=None, client=None):
+    if not series_id:  # Get an arbitrary series ID.
+        series = await server_series(ip, client=client)
+        series_id = series[0].rsplit('/', 1)[-1]
+    url = apis.SERIES_DETAILS_URL.format(ip=ip, series_id=series_id)
+    return await call_api(url, client=client)
+
+
+async def channel_details(ip, channel_id=None, client=None):
+    if not channel_id:  # Get an arbitrary channel ID.
+        channel_id = (await server_channels(ip, client=client))[0]
+    url = apis.CHANNEL_DETAILS_URL.format(ip=ip, channel_id=channel_id)
+    return await call_api(url, client=client)
+
+
+async def playlist_info(ip, id, client=None):
+    """id can be a recording ID or channel ID"""
+    url = apis.PLAYLIST_URL.format(ip=ip, id=id)
+    return await call_api(url, method="POST", client=client)
+
+
+async def playlist_m3u(pl_info, full_urls=True, quality=apis.DEFAULT_QUALITY,
+                       client=None):
+    if 'playlist_url' not in pl_info:
+        raise Exception(pl_info)
+    playlist_url = pl_info['playlist_url']
+    playlist_m3u = await call_api(playlist_url, output="text", client=client)
+    if not isinstance(playlist_m3u, str):
+        return playlist_m3u
+
+    variants = apis.playlist_variants(playlist_m3u, playlist_url)
+    if variants and quality is not None:
+        playlist_url = apis.select_variant(variants, quality).url
+        playlist_m3u = await call_api(playlist_url, output="text",
+                                      client=client)
+        if not isinstance(playlist_m3u, str):
+            return playlist_m3u
+
+    if full_urls:
+        playlist_m3u = apis.add_playlist_host(playlist_url, playlist_m3u)
+    return playlist_m3u
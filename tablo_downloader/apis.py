@@ -1,7 +1,14 @@
+import collections
+import hashlib
+import json
 import logging
-import requests
+import os
+import threading
+import time
 import urllib
 
+from tablo_downloader import metrics
+
 LOGGER = logging.getLogger(__name__)
 # LOGGER.setLevel(logging.DEBUG)
 
@@ -22,24 +29,318 @@ SERIES_DETAILS_URL = ('http://{ip}:%s/recordings/series/{series_id}' %
 
 PLAYLIST_URL = 'http://{ip}:%s{id}/watch' % TABLO_INFO_PORT
 
+BATCH_URL = 'http://{ip}:%s/batch' % TABLO_INFO_PORT
+BATCH_CHUNK_SIZE = 50
+
 SETTINGS_URL = 'http://{ip}:%s/settings/info' % TABLO_INFO_PORT
 
 SRVR_INFORMATION_URL = 'http://{ip}:%s/server/info' % TABLO_INFO_PORT
 SRVR_CAPABILITIES_URL = 'http://{ip}:%s/server/capabilities' % TABLO_INFO_PORT
 
-
-def call_api(url, method="GET", output="json"):
+# Seconds to cache responses from slow-changing endpoints for, when the
+# response cache is enabled with configure_cache.
+CACHE_TTLS = {
+    SETTINGS_URL: 3600,
+    SRVR_INFORMATION_URL: 3600,
+    SRVR_CAPABILITIES_URL: 86400,
+    CHANNELS_URL: 3600,
+    CHANNEL_DETAILS_URL: 86400,
+}
+CACHE_DIRECTORY = '.tablodlcache'
+DEFAULT_CACHE_BYTES = 10 * 1024 * 1024
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# The variant of a master playlist to download: 'highest' or 'lowest'
+# bandwidth, or the one nearest a bitrate in bits per second.
+DEFAULT_QUALITY = 'highest'
+Variant = collections.namedtuple('Variant', ['url', 'bandwidth', 'resolution'])
+
+
+class Client:
+    """The HTTP client used for all Tablo API calls.
+
+    Requests to each host share a keep-alive requests.Session whose
+    connection pool holds up to pool_size connections, which should be at
+    least the number of concurrent workers. timeout is a requests
+    (connect, read) timeout. A transport, any object with a requests.Session
+    style request(method, url, **kwargs) method, may be given to replace the
+    sessions, e.g. for testing.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+                 headers=None, transport=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.transport = transport
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        """Return the transport for a URL, creating a session if needed."""
+        if self.transport is not None:
+            return self.transport
+        # requests is slow to import, so it is only loaded once a session
+        # is needed.
+        import requests
+        import requests.adapters
+        host = urllib.parse.urlsplit(url)[:2]
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(self.headers)
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(url).request(method, url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            session.close()
+
+
+class Response:
+    """A minimal response with the attributes parse_response uses."""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ResponseCache:
+    """An on-disk cache of GET responses, one JSON file per URL.
+
+    Entries are fresh for the TTL given when they are looked up. Stale
+    entries with an ETag or Last-Modified validator are revalidated with a
+    conditional request. When the files total more than max_bytes the least
+    recently used are removed. With refresh, fresh entries are revalidated
+    anyway.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_BYTES,
+                 refresh=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url):
+        name = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def get(self, url):
+        """Return the cache entry for a URL, or None."""
+        path = self._path(url)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path)  # Mark as recently used.
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('url') == url else None
+
+    def put(self, url, req, fetched=None):
+        """Cache a response, returning its entry."""
+        headers = req.headers or {}
+        entry = {
+            'url': url,
+            'fetched': time.time() if fetched is None else fetched,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'content': req.content.decode('utf-8', errors='replace'),
+        }
+        path = self._path(url)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        self.evict()
+        return entry
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def cached_response(entry):
+    headers = {}
+    if entry.get('etag'):
+        headers['ETag'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['Last-Modified'] = entry['last_modified']
+    return Response(200, headers, entry['content'].encode())
+
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def client():
+    """Return the shared Client, creating one with defaults if needed."""
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = Client()
+        return _CLIENT
+
+
+def configure_client(**kwargs):
+    """Replace the shared Client with one created with kwargs."""
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is not None:
+            _CLIENT.close()
+        _CLIENT = Client(**kwargs)
+        return _CLIENT
+
+
+_CACHE = None
+
+
+def configure_cache(directory=None, max_bytes=DEFAULT_CACHE_BYTES,
+                    refresh=False, enabled=True):
+    """Enable, or with enabled=False disable, the response cache.
+
+    The cache is stored in directory, ~/{CACHE_DIRECTORY} by default.
+    """
+    global _CACHE
+    if not enabled:
+        _CACHE = None
+        return None
+    directory = directory or os.path.join(
+        os.path.expanduser('~'), CACHE_DIRECTORY)
+    _CACHE = ResponseCache(directory, max_bytes=max_bytes, refresh=refresh)
+    return _CACHE
+
+
+def call_api(url, method="GET", output="json", data=None, ttl=None):
+    """Call a Tablo API, returning its result or an error dict.
+
+    If ttl is given and the response cache is enabled, a GET response is
+    cached for ttl seconds.
+    """
     LOGGER.debug('[%s] [%s] [%s]', url, method, output)
-    requester = getattr(requests, method.lower())
 
+    cache = _CACHE if ttl and method == "GET" else None
+    entry = cache.get(url) if cache else None
+    kwargs = {} if data is None else {'json': data}
+    if entry:
+        if not cache.refresh and time.time() - entry['fetched'] < ttl:
+            LOGGER.debug('API [%s] cached', url)
+            metrics.METRICS.record_cache_hit(method, url)
+            return parse_response(url, cached_response(entry), output)
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        if headers:
+            kwargs['headers'] = headers
+
+    start = time.monotonic()
     try:
-        req = requester(url)
+        req = client().request(method, url, **kwargs)
     except Exception as e:
+        metrics.METRICS.record(method, url, time.monotonic() - start,
+                               exception=e)
         return {
             'error': 'API call [%s] failed' % url,
             'exception': e
         }
+    metrics.METRICS.record(method, url, time.monotonic() - start,
+                           status_code=req.status_code,
+                           size=len(req.content or b''))
+
+    if cache:
+        if req.status_code == 304 and entry:
+            LOGGER.debug('API [%s] not modified', url)
+            entry = cache.put(url, cached_response(entry))
+            return parse_response(url, cached_response(entry), output)
+        if req.status_code == 200:
+            cache.put(url, req)
+    return parse_response(url, req, output)
+
+
+def stream_content(url, on_chunk, chunk_size=STREAM_CHUNK_SIZE):
+    """Return the content of url, or an error dict, like
+    call_api(url, output="content").
+
+    The response is read chunk_size bytes at a time, calling on_chunk(size)
+    after each chunk, e.g. to limit bandwidth.
+    """
+    LOGGER.debug('[%s] [GET] [stream]', url)
+    start = time.monotonic()
+    chunks = []
+    try:
+        req = client().request('GET', url, stream=True)
+        try:
+            if req.status_code < 300:
+                for chunk in req.iter_content(chunk_size):
+                    chunks.append(chunk)
+                    on_chunk(len(chunk))
+        finally:
+            req.close()
+    except Exception as e:
+        metrics.METRICS.record('GET', url, time.monotonic() - start,
+                               exception=e)
+        return {
+            'error': 'API call [%s] failed' % url,
+            'exception': e
+        }
+    content = b''.join(chunks)
+    metrics.METRICS.record('GET', url, time.monotonic() - start,
+                           status_code=req.status_code, size=len(content))
+    if req.status_code >= 300:
+        return {
+            'error': 'API call [%s] failed' % url,
+            'status_code': req.status_code
+        }
+    return content
+
+
+def parse_response(url, req, output="json"):
+    """Return the result of an API call from its response.
 
+    req may be a requests.Response or anything with the same status_code,
+    json(), text and content attributes, such as a Response.
+    """
     if req.status_code >= 300:
         return {
             'error': 'API call [%s] failed' % url,
@@ -56,9 +357,12 @@ def call_api(url, method="GET", output="json"):
             }
     elif output == "text":
         res = req.text
+    elif output == "content":
+        res = req.content
     else:
         res = {'error': 'API [%s] unknown format [%s]' % (url, output)}
-    LOGGER.debug('API [%s] result:\n%s', url, res)
+    LOGGER.debug('API [%s] result:\n%s', url,
+                 '[%d bytes]' % len(res) if isinstance(res, bytes) else res)
     return res
 
 
@@ -70,25 +374,25 @@ def local_server_info():
 def server_settings(ip):
     """Return the system settings for a Tablo server."""
     url = SETTINGS_URL.format(ip=ip)
-    return call_api(url)
+    return call_api(url, ttl=CACHE_TTLS.get(SETTINGS_URL))
 
 
 def server_information(ip):
     """Return system information about a Tablo server."""
     url = SRVR_INFORMATION_URL.format(ip=ip)
-    return call_api(url)
+    return call_api(url, ttl=CACHE_TTLS.get(SRVR_INFORMATION_URL))
 
 
 def server_capabilities(ip):
     """Return the capabilities of a Tablo server."""
     url = SRVR_CAPABILITIES_URL.format(ip=ip)
-    return call_api(url)
+    return call_api(url, ttl=CACHE_TTLS.get(SRVR_CAPABILITIES_URL))
 
 
 def server_channels(ip):
     """Return the available channels for a Tablo server."""
     url = CHANNELS_URL.format(ip=ip)
-    return call_api(url)
+    return call_api(url, ttl=CACHE_TTLS.get(CHANNELS_URL))
 
 
 def server_recordings(ip):
@@ -110,11 +414,46 @@ def recording_details(ip, recording_id=None):
     return call_api(url)
 
 
+def batch_details(ip, paths, chunk_size=BATCH_CHUNK_SIZE):
+    """Return details for many recording or series paths.
+
+    The paths are POSTed to the Tablo /batch endpoint in chunks of at most
+    chunk_size. The result maps each path to its details; paths the device
+    doesn't know about are missing from it. If any chunk fails, its error
+    is returned instead.
+    """
+    url = BATCH_URL.format(ip=ip)
+    paths = list(paths)
+    res = {}
+    for start in range(0, len(paths), chunk_size):
+        chunk = call_api(url, method='POST',
+                         data=paths[start:start + chunk_size])
+        if not isinstance(chunk, dict):
+            return {'error': 'API [%s] unexpected result [%s]' % (url, chunk)}
+        if 'error' in chunk:
+            return chunk
+        res.update(chunk)
+    return res
+
+
+def server_series(ip):
+    """Return the recorded series paths for a Tablo server."""
+    url = SERIES_LIST_URL.format(ip=ip)
+    return call_api(url)
+
+
+def series_details(ip, series_id=None):
+    if not series_id:  # Get an arbitrary series ID.
+        series_id = server_series(ip)[0].rsplit('/', 1)[-1]
+    url = SERIES_DETAILS_URL.format(ip=ip, series_id=series_id)
+    return call_api(url)
+
+
 def channel_details(ip, channel_id=None):
     if not channel_id:  # Get an arbitrary channel ID.
         channel_id = server_channels(ip)[0]
     url = CHANNEL_DETAILS_URL.format(ip=ip, channel_id=channel_id)
-    return call_api(url)
+    return call_api(url, ttl=CACHE_TTLS.get(CHANNEL_DETAILS_URL))
 
 
 def playlist_info(ip, id):
@@ -123,8 +462,12 @@ def playlist_info(ip, id):
     return call_api(url, method="POST")
 
 
-# TODO: Grab hd version if available?
-def playlist_m3u(pl_info=None, full_urls=True):
+def playlist_m3u(pl_info=None, full_urls=True, quality=DEFAULT_QUALITY):
+    """Return the media playlist for a playlist_info result.
+
+    If the playlist is a master playlist, the media playlist of the variant
+    chosen by select_variant(quality) is returned, unless quality is None.
+    """
     if not pl_info:
         pl_info = playlist_info()
     if 'playlist_url' not in pl_info:
@@ -134,16 +477,110 @@ def playlist_m3u(pl_info=None, full_urls=True):
     if not isinstance(playlist_m3u, str):
         return playlist_m3u
 
+    variants = playlist_variants(playlist_m3u, playlist_url)
+    if variants and quality is not None:
+        variant = select_variant(variants, quality)
+        LOGGER.debug('Selected variant [%s] of [%s]', variant, playlist_url)
+        playlist_url = variant.url
+        playlist_m3u = call_api(playlist_url, output="text")
+        if not isinstance(playlist_m3u, str):
+            return playlist_m3u
+
     if full_urls:
-        # The m3u contains relative urls, add the host.
-        playlist_host = '://'.join(urllib.parse.urlsplit(playlist_url)[:2])
-        playlist_m3u = playlist_m3u.replace('/stream',
-                                            playlist_host + '/stream')
+        playlist_m3u = add_playlist_host(playlist_url, playlist_m3u)
     return playlist_m3u
 
 
+def recording_variants(ip, recording_id):
+    """Return the Variants of a recording's playlist, if it has several."""
+    pl_info = playlist_info(ip, recording_id)
+    if 'playlist_url' not in pl_info:
+        return pl_info
+    playlist_m3u = call_api(pl_info['playlist_url'], output="text")
+    if not isinstance(playlist_m3u, str):
+        return playlist_m3u
+    return playlist_variants(playlist_m3u, pl_info['playlist_url'])
+
+
+def add_playlist_host(playlist_url, playlist_m3u):
+    """The m3u contains relative urls, resolve them against playlist_url."""
+    lines = []
+    for line in playlist_m3u.splitlines():
+        stripped = line.strip()
+        if stripped and not stripped.startswith('#'):
+            line = urllib.parse.urljoin(playlist_url, stripped)
+        elif 'URI="' in line:  # E.g. #EXT-X-KEY or #EXT-X-MAP.
+            head, _, rest = line.partition('URI="')
+            uri, _, tail = rest.partition('"')
+            line = '%sURI="%s"%s' % (
+                head, urllib.parse.urljoin(playlist_url, uri), tail)
+        lines.append(line)
+    return '\n'.join(lines) + ('\n' if playlist_m3u.endswith('\n') else '')
+
+
+def parse_attributes(attributes):
+    """Parse an m3u8 attribute list, e.g. BANDWIDTH=1500000,CODECS="a,b"."""
+    res = {}
+    while attributes:
+        name, _, attributes = attributes.partition('=')
+        if attributes.startswith('"'):
+            value, _, attributes = attributes[1:].partition('"')
+            attributes = attributes.partition(',')[2]
+        else:
+            value, _, attributes = attributes.partition(',')
+        res[name.strip()] = value
+    return res
+
+
+def playlist_variants(playlist_m3u, playlist_url):
+    """Return the Variants of a master playlist, or [] for a media playlist.
+
+    Variant URLs are resolved against playlist_url.
+    """
+    variants = []
+    attributes = None
+    for line in playlist_m3u.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            attributes = parse_attributes(line[len('#EXT-X-STREAM-INF:'):])
+        elif line and not line.startswith('#') and attributes is not None:
+            try:
+                bandwidth = int(attributes.get('BANDWIDTH', 0))
+            except ValueError:
+                bandwidth = 0
+            variants.append(Variant(urllib.parse.urljoin(playlist_url, line),
+                                    bandwidth, attributes.get('RESOLUTION')))
+            attributes = None
+    return variants
+
+
+def parse_quality(quality):
+    """Return 'highest', 'lowest' or a bitrate in bits per second from a
+    string such as 'lowest' or '3M'."""
+    if quality in ('highest', 'lowest') or isinstance(quality, int):
+        return quality
+    quality = str(quality).strip().upper()
+    multiplier = 1
+    if quality[-1:] in ('K', 'M'):
+        multiplier = 1000 if quality[-1] == 'K' else 1000000
+        quality = quality[:-1]
+    return int(float(quality) * multiplier)
+
+
+def select_variant(variants, quality=DEFAULT_QUALITY):
+    """Return the variant with the highest or lowest bandwidth, or the one
+    nearest a bitrate in bits per second, preferring lower bitrates."""
+    if quality == 'highest':
+        return max(variants, key=lambda v: v.bandwidth)
+    if quality == 'lowest':
+        return min(variants, key=lambda v: v.bandwidth)
+    return min(variants, key=lambda v: (abs(v.bandwidth - quality),
+                                        v.bandwidth))
+
+
 def parse_args():
     import argparse
+    from tablo_downloader import discovery
     parser = argparse.ArgumentParser(description='Call a Tablo API.')
 
     parser.add_argument(
@@ -163,6 +600,22 @@ def parse_args():
         help='A Tablo recording ID',
     )
 
+    parser.add_argument(
+        '--series_id',
+        help='A Tablo series ID',
+    )
+
+    parser.add_argument(
+        '--quality',
+        type=parse_quality,
+        default=DEFAULT_QUALITY,
+        help=('The variant of a master playlist to get: highest, lowest or '
+              'the one nearest a bitrate such as 3M'),
+    )
+
+    add_cache_arguments(parser)
+    discovery.add_arguments(parser)
+
     apis = parser.add_subparsers(dest='api')
 
     api = apis.add_parser(
@@ -185,7 +638,8 @@ def parse_args():
 
     api = apis.add_parser(
         'servers',
-        help=('Get information about Tablo servers on a local network'),
+        help=('Get information about local Tablo servers from the Tablo '
+              'cloud service'),
     )
     api.set_defaults(func=local_server_info)
 
@@ -219,6 +673,18 @@ def parse_args():
     )
     api.set_defaults(func=recording_details)
 
+    api = apis.add_parser(
+        'series',
+        help=('Get recorded series for a Tablo server'),
+    )
+    api.set_defaults(func=server_series)
+
+    api = apis.add_parser(
+        'series_details',
+        help=('Get details about a recorded series'),
+    )
+    api.set_defaults(func=series_details)
+
     api = apis.add_parser(
         'recording_playlist',
         help=('Get playlist information for a recording'),
@@ -231,20 +697,53 @@ def parse_args():
     )
     api.set_defaults(func=playlist_m3u)
 
+    api = apis.add_parser(
+        'playlist_variants',
+        help=('Get the bandwidth and resolution of each variant of a '
+              'recording'),
+    )
+    api.set_defaults(func=recording_variants)
+
     return parser.parse_args()
 
 
+def add_cache_arguments(parser):
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help=('Cache responses from slow-changing Tablo APIs in '
+              '~/%s' % CACHE_DIRECTORY),
+    )
+    parser.add_argument(
+        '--no_cache',
+        action='store_true',
+        help='Disable the response cache, overriding --cache',
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='Revalidate cached responses even if they are fresh',
+    )
+
+
+def configure_cache_from_args(args):
+    if args.cache and not args.no_cache:
+        configure_cache(refresh=args.refresh)
+
+
 def main():
     """Only for testing of Tablo APIs."""
-    import inspect
     import pprint
+    from tablo_downloader import discovery
     args = parse_args()
+    configure_cache_from_args(args)
     if not args.api:
         print('Missing API. Run with "-h" for details')
         return
 
     api_func = args.func
-    api_args = {x: None for x in inspect.getfullargspec(api_func).args}
+    code = api_func.__code__
+    api_args = {x: None for x in code.co_varnames[:code.co_argcount]}
     args_args = vars(args)
     for arg in api_args:
         if args_args.get(arg):
@@ -255,17 +754,14 @@ def main():
         if args.tablo_ips:
             tablo_ips = args.tablo_ips.split(',')
         else:
-            tablo_ips = {x['private_ip'] for x in local_server_info()['cpes']}
+            tablo_ips = discovery.local_ips(args.rediscover,
+                                            timeout=args.discovery_timeout)
         if not tablo_ips:
             raise ValueError('Unable to determine any Tablo IPs')
 
     if tablo_ips:
         if len(api_args) == 1:
-            for ip in tablo_ips:
-                api_args['ip'] = ip
-                print('Tablo device [%s]' % ip)
-                pprint.pprint(args.func(**api_args))
-                print()
+            call_all_ips(api_func, sorted(tablo_ips))
             return
         else:
             api_args['ip'] = tablo_ips.pop()  # Arbitrarily pick one.
@@ -273,5 +769,27 @@ def main():
     pprint.pprint(args.func(**api_args))
 
 
+def call_all_ips(api_func, tablo_ips):
+    """Call api_func for each Tablo IP in parallel, printing in IP order."""
+    import concurrent.futures
+    import pprint
+
+    def timed_call(ip):
+        start = time.monotonic()
+        try:
+            res = api_func(ip=ip)
+        except Exception as e:
+            res = {'error': 'API call failed for [%s]' % ip, 'exception': e}
+        return res, time.monotonic() - start
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(tablo_ips))) as pool:
+        results = pool.map(timed_call, tablo_ips)
+        for ip, (res, seconds) in zip(tablo_ips, results):
+            print('Tablo device [%s] (%.2fs)' % (ip, seconds))
+            pprint.pprint(res)
+            print()
+
+
 if __name__ == '__main__':
     main()
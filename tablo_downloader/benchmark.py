@@ -0,0 +1,373 @@
+"""Benchmarks for syncing, dumping and downloading recordings.
+
+Each benchmark runs against an emulated Tablo (see emulator.py) for every
+combination of library size and latency profile, with HOME pointed at a
+scratch directory so the real database is never touched. Results are
+written as JSON lines, one per benchmark, so runs from different commits
+can be compared:
+
+    tldlbench --sizes 100,1000 --output before.jsonl
+    tldlbench --sizes 100,1000 --compare before.jsonl
+
+The startup benchmarks time the tldl and tldlapis entry points, each in a
+fresh interpreter, since scripts may run them thousands of times a day.
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from tablo_downloader import apis
+from tablo_downloader import database
+from tablo_downloader import discovery
+from tablo_downloader import emulator
+from tablo_downloader import hls
+from tablo_downloader import tablo
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (100, 1000, 10000)
+# Seconds of latency added to every request by the emulated device.
+LATENCY_PROFILES = {
+    'lan': 0.0,
+    'wifi': 0.005,
+    'slow': 0.05,
+}
+DEFAULT_PROFILES = ('lan', 'wifi')
+DEFAULT_REPEAT = 3
+DEFAULT_IP = '127.0.0.2'
+DEFAULT_DOWNLOADS = 2
+# Interpreter arguments for each startup benchmark.
+STARTUP_COMMANDS = {
+    'import_tablo': ['-c', 'import tablo_downloader.tablo'],
+    'import_apis': ['-c', 'import tablo_downloader.apis'],
+    'tldl_dump': ['-m', 'tablo_downloader.tablo', '--dump'],
+    'tldlapis_help': ['-m', 'tablo_downloader.apis', '--help'],
+}
+# Modules the entry points import only when a command needs them.
+LAZY_MODULES = ('requests', 'sqlite3', 'subprocess', 'pprint', 'inspect',
+                'asyncio')
+
+
+def sync_args(ip, **kwargs):
+    args = dict(
+        tablo_ips=ip, workers=tablo.DEFAULT_WORKERS,
+        workers_per_device=tablo.DEFAULT_WORKERS_PER_DEVICE,
+        fetch_retries=0, batch_size=apis.BATCH_CHUNK_SIZE, full_sync=False,
+        recordings_directory=None, segment_workers=hls.DEFAULT_SEGMENT_WORKERS,
+        segment_buffer=hls.DEFAULT_SEGMENT_BUFFER, progress_interval=0,
+        progress_events=None, stall_timeout=hls.DEFAULT_STALL_TIMEOUT,
+        quality=apis.DEFAULT_QUALITY, rediscover=False,
+        discovery_timeout=discovery.DEFAULT_TIMEOUT, dry_run=False,
+        overwrite=True, delete_originals_after_downloading=False,
+        delete_workers=tablo.DEFAULT_DELETE_WORKERS)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+@contextlib.contextmanager
+def scratch_home():
+    """Point HOME at a temporary directory."""
+    home = os.environ.get('HOME')
+    with tempfile.TemporaryDirectory(prefix='tldlbench') as directory:
+        os.environ['HOME'] = directory
+        try:
+            yield directory
+        finally:
+            if home is None:
+                del os.environ['HOME']
+            else:
+                os.environ['HOME'] = home
+
+
+def timed(func, repeat, setup=None):
+    """Run func repeat times, returning the durations in seconds."""
+    seconds = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def run_profile(device, home, repeat, downloads):
+    """Run each benchmark against a running device.
+
+    Returns a list of (benchmark, seconds, extra) tuples.
+    """
+    ip = device.ip
+    db_path = database.default_path()
+    args = sync_args(ip, recordings_directory=home)
+    results = []
+
+    def remove_db():
+        if os.path.exists(db_path):
+            os.remove(db_path)
+
+    results.append(('sync', timed(
+        lambda: tablo.create_or_update_recordings_database(args), repeat,
+        setup=remove_db), {}))
+    results.append(('resync', timed(
+        lambda: tablo.create_or_update_recordings_database(args), repeat),
+        {}))
+
+    def dump():
+        with tablo.open_recordings_db() as db:
+            tablo.dump_recordings(db, out=io.StringIO())
+
+    results.append(('dump', timed(dump, repeat), {}))
+
+    with tablo.open_recordings_db() as db:
+        metadata = {r: db.get(ip, r) for r in db.recording_ids(ip)}
+
+    def load():
+        with tablo.open_recordings_db() as db:
+            for _ in db.recordings():
+                pass
+
+    save_path = os.path.join(home, 'save.sqlite')
+
+    def remove_save_db():
+        if os.path.exists(save_path):
+            os.remove(save_path)
+
+    def save():
+        with database.RecordingsDB(save_path) as db:
+            db.put_many(ip, metadata, change=database.ADDED)
+
+    results.append(('db_load', timed(load, repeat), {}))
+    results.append(('db_save', timed(save, repeat, setup=remove_save_db),
+                    {}))
+
+    recordings = apis.server_recordings(ip)[:downloads]
+    segment_bytes = []
+
+    def fetch_segments():
+        for recording in recordings:
+            pl_info = apis.playlist_info(ip, recording)
+            segments = hls.playlist_segments(pl_info['playlist_url'])
+            segment_bytes.append(hls.fetch_segments(
+                segments, lambda data: None, args.segment_workers,
+                args.segment_buffer))
+
+    seconds = timed(fetch_segments, repeat)
+    results.append(('fetch_segments', seconds,
+                    {'bytes': segment_bytes[-1] * len(recordings)
+                     if segment_bytes else 0}))
+
+    if shutil.which('ffmpeg'):
+        def download():
+            for recording in recordings:
+                args.recording_id = recording
+                tablo.download_recording(args)
+
+        results.append(('download', timed(download, repeat), {}))
+    else:
+        LOGGER.warning('ffmpeg not found, skipping the download benchmark')
+    return results
+
+
+def run_python(arguments, env=None):
+    """Run a fresh interpreter with arguments, returning its stdout."""
+    return subprocess.run(
+        [sys.executable] + arguments, capture_output=True, text=True,
+        check=True, env=env,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    ).stdout
+
+
+def imported_modules(statement, env=None):
+    """Return the modules a statement imports beyond a bare interpreter."""
+    script = 'import sys; {}; print(" ".join(sys.modules))'
+    before = set(run_python(['-c', script.format('pass')], env).split())
+    return (set(run_python(['-c', script.format(statement)], env).split()) -
+            before)
+
+
+def import_times(module):
+    """Return the cumulative import time, in seconds, of module and each
+    tablo_downloader module it imports."""
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        capture_output=True, text=True, check=True).stderr
+    times = {}
+    for line in stderr.splitlines():
+        _, _, cumulative, name = (x.strip() for x in
+                                  line.replace('|', ':').split(':'))
+        if name.startswith('tablo_downloader'):
+            times[name] = int(cumulative) / 1e6
+    return times
+
+
+def run_startup(repeat):
+    """Run the startup benchmarks.
+
+    Returns a list of (benchmark, seconds, extra) tuples.
+    """
+    results = []
+    with scratch_home():
+        env = dict(os.environ)
+        for name, arguments in STARTUP_COMMANDS.items():
+            seconds = timed(lambda: run_python(arguments, env), repeat)
+            extra = {}
+            if arguments[0] == '-c':
+                module = arguments[1].split()[-1]
+                extra['imports'] = import_times(module)
+                extra['lazy_modules_loaded'] = sorted(
+                    set(LAZY_MODULES) & imported_modules(arguments[1]))
+            results.append((name, seconds, extra))
+    return results
+
+
+def run_suite(sizes=DEFAULT_SIZES, profiles=DEFAULT_PROFILES,
+              repeat=DEFAULT_REPEAT, ip=DEFAULT_IP,
+              downloads=DEFAULT_DOWNLOADS, startup=True):
+    """Run every benchmark, yielding a result dict for each."""
+    environment = environment_info()
+    if startup:
+        for name, seconds, extra in run_startup(repeat):
+            yield dict(
+                environment, benchmark=name, recordings=0,
+                profile='startup', latency=0.0, repeat=repeat,
+                min=min(seconds), median=statistics.median(seconds),
+                seconds=seconds, requests={}, **extra)
+    for size in sizes:
+        for profile in profiles:
+            LOGGER.info('Benchmarking [%d] recordings with the [%s] profile',
+                        size, profile)
+            device = emulator.Emulator(
+                ip, recordings=size, latency=LATENCY_PROFILES[profile])
+            apis.configure_client()
+            with scratch_home() as home, device:
+                results = run_profile(device, home, repeat, downloads)
+                requests = dict(device.stats)
+            for name, seconds, extra in results:
+                yield dict(
+                    environment, benchmark=name, recordings=size,
+                    profile=profile, latency=LATENCY_PROFILES[profile],
+                    repeat=repeat, min=min(seconds),
+                    median=statistics.median(seconds), seconds=seconds,
+                    requests=requests, **extra)
+
+
+def environment_info():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': datetime.datetime.now().isoformat(),
+    }
+
+
+def result_key(result):
+    return (result['benchmark'], result['recordings'], result['profile'])
+
+
+def compare(results, baseline):
+    """Print the change in median time of each result from a baseline to
+    stderr.
+    """
+    baseline = {result_key(r): r for r in baseline}
+    for result in results:
+        key = result_key(result)
+        if key not in baseline:
+            continue
+        before, after = baseline[key]['median'], result['median']
+        print('%-16s %6d %-6s %9.4fs -> %9.4fs %+7.1f%%' % (
+            key + (before, after,
+                   100 * (after - before) / before if before else 0)),
+              file=sys.stderr)
+
+
+def load_results(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark tldl against an emulated Tablo.')
+    parser.add_argument(
+        '--sizes',
+        default=','.join(str(s) for s in DEFAULT_SIZES),
+        help='Library sizes to benchmark, separated by commas',
+    )
+    parser.add_argument(
+        '--profiles',
+        default=','.join(DEFAULT_PROFILES),
+        help='Latency profiles to benchmark, separated by commas; one of '
+             '%s' % ', '.join(LATENCY_PROFILES),
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=DEFAULT_REPEAT,
+        help='Number of times to run each benchmark',
+    )
+    parser.add_argument(
+        '--downloads',
+        type=int,
+        default=DEFAULT_DOWNLOADS,
+        help='Number of recordings to download in the download benchmarks',
+    )
+    parser.add_argument(
+        '--no_startup',
+        action='store_true',
+        help='Skip the startup benchmarks',
+    )
+    parser.add_argument(
+        '--ip',
+        default=DEFAULT_IP,
+        help='The IP address for the emulated Tablo',
+    )
+    parser.add_argument(
+        '--output',
+        help='Write results to this file as JSON lines instead of stdout',
+    )
+    parser.add_argument(
+        '--compare',
+        help='Compare the results with those in this file',
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    tablo.LOGGER.setLevel(logging.WARNING)
+    results = list(run_suite(
+        sizes=[int(s) for s in args.sizes.split(',')],
+        profiles=args.profiles.split(','), repeat=args.repeat, ip=args.ip,
+        downloads=args.downloads, startup=not args.no_startup))
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for result in results:
+            out.write(json.dumps(result) + '\n')
+    finally:
+        if args.output:
+            out.close()
+    if args.compare:
+        compare(results, load_results(args.compare))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,539 @@
+"""An SQLite database of Tablo recording metadata.
+
+Recordings are keyed by (device, recording_id). The metadata blob for each
+recording is stored as JSON, and the fields used for lookups, listing and
+download planning are kept in indexed columns so callers never need to load
+the whole library.
+"""
+
+import datetime
+import json
+import logging
+import os
+import threading
+
+from tablo_downloader import filelock
+from tablo_downloader import summaries
+
+LOGGER = logging.getLogger(__name__)
+
+DATABASE_FILE = '.tablodldb.sqlite'
+LEGACY_DATABASE_FILE = '.tablodldb'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS recordings (
+    device TEXT NOT NULL,
+    recording_id TEXT NOT NULL,
+    category TEXT,
+    show_title TEXT,
+    show_time TEXT,
+    episode_season INTEGER,
+    episode_number INTEGER,
+    state TEXT,
+    summary TEXT,
+    title TEXT,
+    filename TEXT,
+    downloaded_at TEXT,
+    download_path TEXT,
+    verified INTEGER,
+    verification TEXT,
+    metadata TEXT NOT NULL,
+    PRIMARY KEY (device, recording_id)
+);
+CREATE INDEX IF NOT EXISTS recordings_category
+    ON recordings (category);
+CREATE INDEX IF NOT EXISTS recordings_show
+    ON recordings (device, show_title, episode_season, episode_number,
+                   show_time);
+CREATE INDEX IF NOT EXISTS recordings_show_time
+    ON recordings (show_time);
+CREATE INDEX IF NOT EXISTS recordings_downloaded_at
+    ON recordings (downloaded_at);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    device TEXT NOT NULL,
+    recording_id TEXT NOT NULL,
+    change TEXT NOT NULL,
+    changed_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS changes_device ON changes (device, seq);
+CREATE TABLE IF NOT EXISTS journal_cursors (
+    consumer TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS delete_queue (
+    device TEXT NOT NULL,
+    recording_id TEXT NOT NULL,
+    queued_at TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    PRIMARY KEY (device, recording_id)
+);
+'''
+
+# Columns computed from each recording's metadata when it is stored.
+DERIVED_COLUMNS = ('category', 'show_title', 'show_time', 'episode_season',
+                   'episode_number', 'state', 'summary', 'title', 'filename')
+
+# Columns added since the recordings table was first created. They are
+# added to, and filled in for, existing databases when opened.
+ADDED_COLUMNS = {
+    'state': 'TEXT',
+    'summary': 'TEXT',
+    'title': 'TEXT',
+    'filename': 'TEXT',
+    'verified': 'INTEGER',
+    'verification': 'TEXT',
+}
+CREATE_STATE_INDEX = (
+    'CREATE INDEX IF NOT EXISTS recordings_state ON recordings (state)')
+
+# Recording states whose metadata is still changing, so is re-fetched on
+# every sync.
+IN_PROGRESS_STATES = ('recording',)
+
+ADDED = 'added'
+UPDATED = 'updated'
+REMOVED = 'removed'
+
+# Order used when listing recordings, matching the recordings_show index.
+LISTING_ORDER = ('device, show_title, episode_season, episode_number, '
+                 'show_time')
+
+FETCH_SIZE = 500
+# Seconds to wait for another connection's write transaction to finish.
+BUSY_TIMEOUT = 30.0
+
+
+def default_path(filename=DATABASE_FILE):
+    return os.path.join(os.path.expanduser('~'), filename)
+
+
+def derived_fields(metadata):
+    """Return the DERIVED_COLUMNS values for a recording's metadata."""
+    summary = summaries.recording_summary(metadata)
+    title, filename = summaries.title_and_filename(summary)
+    details = metadata.get('details') or {}
+    season = summary['episode_season']
+    number = summary['episode_number']
+    return {
+        'category': metadata.get('category'),
+        'show_title': summary['show_title'],
+        'show_time': summary['show_time'],
+        'episode_season': season if isinstance(season, int) else None,
+        'episode_number': number if isinstance(number, int) else None,
+        'state': (details.get('video_details') or {}).get('state'),
+        'summary': json.dumps(summary),
+        'title': title,
+        'filename': filename,
+    }
+
+
+class RecordingsDB:
+    """Recording metadata for all Tablo devices, stored in SQLite.
+
+    The connection is shared by all threads and serialized with a lock.
+    Every write is a transaction and the database uses write-ahead logging,
+    so a crash never leaves it partly written, and other processes can read
+    it while it is written. Whenever a legacy JSON database exists at
+    legacy_path, its recordings are imported and it is renamed with a
+    .migrated suffix.
+    """
+
+    def __init__(self, path=None, legacy_path=None):
+        self.path = path or default_path()
+        self._lock = threading.RLock()
+        # sqlite3 is only loaded once a database is opened, so commands that
+        # don't use one start faster.
+        import sqlite3
+        self._conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                                     check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.execute('PRAGMA synchronous = NORMAL')
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+            self._add_columns()
+            self._conn.execute(CREATE_STATE_INDEX)
+        if legacy_path and os.path.exists(legacy_path):
+            self.migrate_json(legacy_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def sync_lock(self):
+        """Return a FileLock held while syncing, so that only one process
+        syncs the database at a time."""
+        return filelock.FileLock(self.path + '.lock')
+
+    def _add_columns(self):
+        columns = {row['name'] for row in self._conn.execute(
+            'PRAGMA table_info(recordings)')}
+        added = [c for c in ADDED_COLUMNS if c not in columns]
+        for column in added:
+            self._conn.execute('ALTER TABLE recordings ADD COLUMN %s %s'
+                               % (column, ADDED_COLUMNS[column]))
+        # Only derived columns need filling in for existing recordings.
+        if set(added) & set(DERIVED_COLUMNS):
+            self._refresh_derived_fields()
+
+    def _refresh_derived_fields(self):
+        """Recompute the derived columns of every recording."""
+        rows = self._conn.execute(
+            'SELECT device, recording_id, metadata FROM recordings').fetchall()
+        updates = []
+        for row in rows:
+            fields = derived_fields(json.loads(row['metadata']))
+            updates.append([fields[c] for c in DERIVED_COLUMNS] +
+                           [row['device'], row['recording_id']])
+        self._conn.executemany(
+            'UPDATE recordings SET %s WHERE device = ? AND recording_id = ?'
+            % ', '.join('%s = ?' % c for c in DERIVED_COLUMNS), updates)
+        LOGGER.info('Updated [%d] recordings in [%s]', len(rows), self.path)
+
+    def _execute(self, sql, params=()):
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params)
+
+    def migrate_json(self, legacy_path):
+        """Import a legacy JSON database of {device: {recording_id: ...}}."""
+        if os.path.getsize(legacy_path) > 0:
+            with open(legacy_path) as f:
+                recordings_by_ip = json.load(f)
+        else:
+            recordings_by_ip = {}
+        count = 0
+        for device, recordings in recordings_by_ip.items():
+            self.put_many(device, recordings)
+            count += len(recordings)
+        os.replace(legacy_path, legacy_path + '.migrated')
+        LOGGER.info('Migrated [%d] recordings from [%s] to [%s]',
+                    count, legacy_path, self.path)
+        return count
+
+    def devices(self):
+        """Return the devices with recordings in the database."""
+        rows = self._execute(
+            'SELECT DISTINCT device FROM recordings ORDER BY device')
+        return [row['device'] for row in rows.fetchall()]
+
+    def recording_ids(self, device, in_progress=False):
+        """Return the set of recording IDs stored for a device.
+
+        With in_progress, only recordings still being recorded are returned.
+        """
+        sql = 'SELECT recording_id FROM recordings WHERE device = ?'
+        params = [device]
+        if in_progress:
+            sql += ' AND state IN (%s)' % ', '.join('?' * len(
+                IN_PROGRESS_STATES))
+            params.extend(IN_PROGRESS_STATES)
+        rows = self._execute(sql, params)
+        return {row['recording_id'] for row in rows.fetchall()}
+
+    def count(self, device=None):
+        if device is None:
+            row = self._execute('SELECT COUNT(*) FROM recordings').fetchone()
+        else:
+            row = self._execute(
+                'SELECT COUNT(*) FROM recordings WHERE device = ?',
+                (device,)).fetchone()
+        return row[0]
+
+    def get(self, device, recording_id):
+        """Return the metadata for a recording, or None if not found."""
+        row = self._execute(
+            'SELECT metadata FROM recordings '
+            'WHERE device = ? AND recording_id = ?',
+            (device, recording_id)).fetchone()
+        return json.loads(row['metadata']) if row else None
+
+    def put_many(self, device, recordings, change=None):
+        """Add or replace recordings, a dict of metadata by recording ID.
+
+        The download state of existing recordings is preserved. If change is
+        given, e.g. ADDED or UPDATED, it is recorded in the change journal
+        for each recording in the same transaction.
+        """
+        rows = []
+        for recording_id, metadata in recordings.items():
+            fields = derived_fields(metadata)
+            rows.append([device, recording_id] +
+                        [fields[c] for c in DERIVED_COLUMNS] +
+                        [json.dumps(metadata)])
+        columns = ('device', 'recording_id') + DERIVED_COLUMNS + ('metadata',)
+        updates = DERIVED_COLUMNS + ('metadata',)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT INTO recordings (%s) VALUES (%s) '
+                'ON CONFLICT (device, recording_id) DO UPDATE SET %s' % (
+                    ', '.join(columns), ', '.join('?' * len(columns)),
+                    ', '.join('%s = excluded.%s' % (c, c) for c in updates)),
+                rows)
+            if change:
+                self._journal(device, change, recordings)
+
+    def put(self, device, recording_id, metadata):
+        self.put_many(device, {recording_id: metadata})
+
+    def delete_many(self, device, recording_ids, change=None):
+        """Remove recordings, recording change in the journal if given."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'DELETE FROM recordings WHERE device = ? AND recording_id = ?',
+                [(device, r) for r in recording_ids])
+            if change:
+                self._journal(device, change, recording_ids)
+
+    def _journal(self, device, change, recording_ids):
+        now = datetime.datetime.now().isoformat()
+        self._conn.executemany(
+            'INSERT INTO changes (device, recording_id, change, changed_at) '
+            'VALUES (?, ?, ?, ?)',
+            [(device, r, change, now) for r in sorted(recording_ids)])
+
+    def changes(self, since=0, device=None):
+        """Return journal entries after sequence number since, in order.
+
+        Each entry is a dict with seq, device, recording_id, change (ADDED,
+        UPDATED or REMOVED) and changed_at.
+        """
+        sql = 'SELECT * FROM changes WHERE seq > ?'
+        params = [since]
+        if device is not None:
+            sql += ' AND device = ?'
+            params.append(device)
+        rows = self._execute(sql + ' ORDER BY seq', params).fetchall()
+        return [dict(row) for row in rows]
+
+    def last_change(self):
+        """Return the sequence number of the latest journal entry, or 0."""
+        row = self._execute('SELECT MAX(seq) FROM changes').fetchone()
+        return row[0] or 0
+
+    def journal_cursor(self, consumer):
+        """Return the last journal entry a consumer has processed, or 0."""
+        row = self._execute(
+            'SELECT seq FROM journal_cursors WHERE consumer = ?',
+            (consumer,)).fetchone()
+        return row['seq'] if row else 0
+
+    def set_journal_cursor(self, consumer, seq):
+        self._execute(
+            'INSERT INTO journal_cursors (consumer, seq) VALUES (?, ?) '
+            'ON CONFLICT (consumer) DO UPDATE SET seq = excluded.seq',
+            (consumer, seq))
+
+    def prune_changes(self):
+        """Remove journal entries every consumer has processed."""
+        self._execute(
+            'DELETE FROM changes WHERE seq <= '
+            '(SELECT COALESCE(MIN(seq), 0) FROM journal_cursors)')
+
+    def mark_downloaded(self, device, recording_id, path, when,
+                        verification=None):
+        """Record that a recording was downloaded to path at ISO time when.
+
+        verification, if given, is a dict such as hls.Verifier.result
+        whose verified key says whether the download was verified.
+        """
+        verified = None
+        if verification is not None:
+            verified = int(bool(verification.get('verified')))
+            verification = json.dumps(verification)
+        self._execute(
+            'UPDATE recordings SET downloaded_at = ?, download_path = ?, '
+            'verified = ?, verification = ? '
+            'WHERE device = ? AND recording_id = ?',
+            (when, path, verified, verification, device, recording_id))
+
+    def set_verification(self, device, recording_id, verification):
+        """Record the verification of a download that failed it, leaving
+        the recording not downloaded."""
+        self._execute(
+            'UPDATE recordings SET verified = ?, verification = ? '
+            'WHERE device = ? AND recording_id = ?',
+            (int(bool(verification.get('verified'))),
+             json.dumps(verification), device, recording_id))
+
+    def get_verification(self, device, recording_id):
+        """Return the verification recorded for a download, or None."""
+        row = self._execute(
+            'SELECT verification FROM recordings '
+            'WHERE device = ? AND recording_id = ?',
+            (device, recording_id)).fetchone()
+        if not row or row['verification'] is None:
+            return None
+        return json.loads(row['verification'])
+
+    def downloads(self, **filters):
+        """Yield (device, recording_id, download_path, verification) tuples
+        for downloaded recordings in listing order.
+
+        verification is the dict given to mark_downloaded, or None. Takes
+        the same filters as recordings.
+        """
+        filters['downloaded'] = True
+        for row in self._select(('device', 'recording_id', 'download_path',
+                                 'verification'), **filters):
+            yield (row['device'], row['recording_id'], row['download_path'],
+                   json.loads(row['verification'])
+                   if row['verification'] else None)
+
+    def queue_deletes(self, device, recording_ids):
+        """Add recordings to the delete queue.
+
+        Recordings already queued are retried from scratch.
+        """
+        now = datetime.datetime.now().isoformat()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT INTO delete_queue (device, recording_id, queued_at) '
+                'VALUES (?, ?, ?) ON CONFLICT (device, recording_id) DO '
+                'UPDATE SET attempts = 0, next_attempt = 0, last_error = NULL',
+                [(device, r, now) for r in recording_ids])
+
+    def queued_deletes(self, max_attempts=None, due=None):
+        """Return delete queue entries in the order queued.
+
+        Each is a dict with device, recording_id, queued_at, attempts,
+        next_attempt (a time.time() value) and last_error. Entries can be
+        restricted to those with fewer than max_attempts attempts and to
+        those whose next attempt is due at time due.
+        """
+        sql, params = 'SELECT * FROM delete_queue WHERE 1', []
+        if max_attempts is not None:
+            sql += ' AND attempts < ?'
+            params.append(max_attempts)
+        if due is not None:
+            sql += ' AND next_attempt <= ?'
+            params.append(due)
+        rows = self._execute(sql + ' ORDER BY queued_at, device, recording_id',
+                             params).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete_finished(self, device, recording_id):
+        """Remove a recording deleted from its device from the delete queue
+        and the recordings table."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM delete_queue WHERE device = ? AND '
+                'recording_id = ?', (device, recording_id))
+        self.delete_many(device, [recording_id], change=REMOVED)
+
+    def delete_failed(self, device, recording_id, error, next_attempt):
+        """Record a failed delete, to be retried at time next_attempt."""
+        self._execute(
+            'UPDATE delete_queue SET attempts = attempts + 1, '
+            'next_attempt = ?, last_error = ? '
+            'WHERE device = ? AND recording_id = ?',
+            (next_attempt, error, device, recording_id))
+
+    def get_summary(self, device, recording_id):
+        """Return a recording's precomputed summary, title and filename.
+
+        The result is a dict with summary, title, filename and state keys,
+        or None if the recording is not found.
+        """
+        row = self._execute(
+            'SELECT summary, title, filename, state FROM recordings '
+            'WHERE device = ? AND recording_id = ?',
+            (device, recording_id)).fetchone()
+        if not row:
+            return None
+        return {'summary': json.loads(row['summary']), 'title': row['title'],
+                'filename': row['filename'], 'state': row['state']}
+
+    def _select(self, columns, device=None, category=None, show_title=None,
+                downloaded=None, in_progress=None, aired_after=None,
+                aired_before=None):
+        """Yield rows of columns matching the filters in listing order.
+
+        Rows are read from the database in batches as they are consumed.
+        """
+        where, params = [], []
+        if device is not None:
+            where.append('device = ?')
+            params.append(device)
+        if category is not None:
+            where.append('category = ?')
+            params.append(category)
+        if show_title is not None:
+            where.append('show_title = ?')
+            params.append(show_title)
+        if downloaded is not None:
+            where.append('downloaded_at IS %s NULL' % (
+                'NOT' if downloaded else ''))
+        if in_progress is not None:
+            where.append("COALESCE(state, '') %s IN (%s)" % (
+                '' if in_progress else 'NOT',
+                ', '.join('?' * len(IN_PROGRESS_STATES))))
+            params.extend(IN_PROGRESS_STATES)
+        if aired_after is not None:
+            where.append('show_time >= ?')
+            params.append(aired_after)
+        if aired_before is not None:
+            where.append('show_time < ?')
+            params.append(aired_before)
+        sql = 'SELECT %s FROM recordings' % ', '.join(columns)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ' + LISTING_ORDER
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def recordings(self, **filters):
+        """Yield (device, recording_id, metadata) tuples in listing order.
+
+        Results can be restricted to a device, a category, a show_title, to
+        recordings that have (downloaded=True) or haven't (downloaded=False)
+        been downloaded, to recordings that are (in_progress=True) or
+        aren't (in_progress=False) still being recorded, and to recordings
+        aired at or after aired_after and before aired_before, ISO 8601
+        dates or times compared with show_time.
+        """
+        for row in self._select(('device', 'recording_id', 'metadata'),
+                                **filters):
+            yield (row['device'], row['recording_id'],
+                   json.loads(row['metadata']))
+
+    def summaries(self, **filters):
+        """Yield dicts of precomputed recording fields in listing order.
+
+        Each has device, recording_id, summary, title, filename, state,
+        downloaded_at and download_path keys. Takes the same filters as
+        recordings.
+        """
+        for row in self._select(('device', 'recording_id', 'summary',
+                                 'title', 'filename', 'state',
+                                 'downloaded_at', 'download_path'),
+                                **filters):
+            yield {'device': row['device'],
+                   'recording_id': row['recording_id'],
+                   'summary': json.loads(row['summary']),
+                   'title': row['title'], 'filename': row['filename'],
+                   'state': row['state'],
+                   'downloaded_at': row['downloaded_at'],
+                   'download_path': row['download_path']}
+
+    def recording_ids_matching(self, **filters):
+        """Yield (device, recording_id) tuples in listing order.
+
+        Takes the same filters as recordings.
+        """
+        for row in self._select(('device', 'recording_id'), **filters):
+            yield row['device'], row['recording_id']
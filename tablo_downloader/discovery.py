@@ -0,0 +1,199 @@
+"""Discovery of Tablo devices on the local network.
+
+Devices are found without the Tablo cloud service by broadcasting a UDP
+discovery probe and, at the same time, scanning port 8885 of every
+address on the local subnets for /server/info. Every candidate is
+confirmed with /server/info, so a stray UDP reply is never reported.
+Discovered IPs are cached in ~/.tablodlips for CACHE_TTL seconds, so later
+runs skip discovery entirely.
+"""
+
+import concurrent.futures
+import ipaddress
+import json
+import logging
+import os
+import socket
+import time
+
+from tablo_downloader import apis
+
+LOGGER = logging.getLogger(__name__)
+
+DISCOVERY_PORT = 8881
+# The probe legacy Tablo devices answer on DISCOVERY_PORT. Replies are
+# only used as candidates for the /server/info check, so their contents
+# are ignored.
+DISCOVERY_PROBE = b'BnGr' + b'\x00' * 140
+BROADCAST_ADDRESS = '255.255.255.255'
+# Subnets of local addresses are assumed to be this size, since the
+# netmask is not available portably.
+DEFAULT_PREFIX = 24
+# Seconds to wait for each /server/info request and for UDP replies.
+DEFAULT_TIMEOUT = 0.5
+DEFAULT_SCAN_WORKERS = 64
+CACHE_FILE = '.tablodlips'
+CACHE_TTL = 86400
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--rediscover',
+        action='store_true',
+        help='Discover local Tablo devices even if their IPs are cached',
+    )
+    parser.add_argument(
+        '--discovery_timeout',
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help='Seconds to wait for each device while discovering devices',
+    )
+
+
+def default_cache_path():
+    return os.path.join(os.path.expanduser('~'), CACHE_FILE)
+
+
+def local_addresses():
+    """Return the IPv4 addresses of this host, other than loopback."""
+    addresses = set()
+    # Connecting a UDP socket sends nothing, but picks the address of the
+    # interface with the default route.
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try:
+            s.connect(('10.255.255.255', 1))
+            addresses.add(s.getsockname()[0])
+        except OSError:
+            pass
+    try:
+        addresses.update(
+            info[4][0] for info in socket.getaddrinfo(
+                socket.gethostname(), None, socket.AF_INET))
+    except OSError:
+        pass
+    return {a for a in addresses if not ipaddress.ip_address(a).is_loopback}
+
+
+def local_networks(prefix=DEFAULT_PREFIX):
+    """Return the subnets of this host's addresses."""
+    return sorted({ipaddress.ip_network('%s/%d' % (a, prefix), strict=False)
+                   for a in local_addresses()})
+
+
+def server_info(ip, timeout=DEFAULT_TIMEOUT):
+    """Return /server/info for ip, or None if it is not a Tablo device.
+
+    Each probe uses its own Client, with the shared Client's transport, so
+    scanning a subnet neither leaves a session open per address nor adds
+    every address to the API metrics.
+    """
+    url = apis.SRVR_INFORMATION_URL.format(ip=ip)
+    client = apis.Client(pool_size=1, timeout=timeout,
+                         transport=apis.client().transport)
+    try:
+        info = apis.parse_response(url, client.request('GET', url))
+    except Exception:
+        return None
+    finally:
+        client.close()
+    if not isinstance(info, dict) or 'server_id' not in info:
+        return None
+    return info
+
+
+def broadcast_probe(addresses=(BROADCAST_ADDRESS,), timeout=DEFAULT_TIMEOUT,
+                    port=DISCOVERY_PORT):
+    """Send the discovery probe to addresses and return the IPs that reply
+    within timeout seconds."""
+    replies = set()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        for address in addresses:
+            try:
+                s.sendto(DISCOVERY_PROBE, (address, port))
+            except OSError as e:
+                LOGGER.debug('Unable to send a discovery probe to [%s]: %s',
+                             address, e)
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            s.settimeout(remaining)
+            try:
+                _, (ip, _) = s.recvfrom(1024)
+            except socket.timeout:
+                break
+            except OSError as e:
+                LOGGER.debug('Discovery probe failed: %s', e)
+                break
+            replies.add(ip)
+    return replies
+
+
+def scan(hosts, timeout=DEFAULT_TIMEOUT, workers=DEFAULT_SCAN_WORKERS):
+    """Check hosts concurrently, returning {ip: server info} for each Tablo
+    device."""
+    hosts = [str(h) for h in hosts]
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(workers, len(hosts)))) as pool:
+        infos = pool.map(lambda ip: server_info(ip, timeout), hosts)
+        return {ip: info for ip, info in zip(hosts, infos) if info}
+
+
+def discover(networks=None, broadcast=(BROADCAST_ADDRESS,),
+             timeout=DEFAULT_TIMEOUT, workers=DEFAULT_SCAN_WORKERS):
+    """Return {ip: server info} for the Tablo devices on networks.
+
+    networks defaults to the local subnets. The discovery probe is sent to
+    each address in broadcast while the subnets are scanned.
+    """
+    if networks is None:
+        networks = local_networks()
+    hosts = {str(h) for network in networks for h in network.hosts()}
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        replies = pool.submit(broadcast_probe, broadcast, timeout)
+        found = scan(sorted(hosts), timeout, workers)
+        others = replies.result() - set(found)
+    found.update(scan(others, timeout, workers))
+    LOGGER.debug('Found Tablo devices [%s] on [%s] in %.2fs',
+                 ' '.join(sorted(found)),
+                 ' '.join(str(n) for n in networks),
+                 time.monotonic() - start)
+    return found
+
+
+def cached_ips(ttl=CACHE_TTL, path=None):
+    """Return the cached IPs if they are less than ttl seconds old."""
+    path = path or default_cache_path()
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        if time.time() - cache['time'] < ttl:
+            return set(cache['ips'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def save_ips(ips, path=None):
+    path = path or default_cache_path()
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'time': time.time(), 'ips': sorted(ips)}, f)
+    os.replace(path + '.tmp', path)
+
+
+def local_ips(refresh=False, ttl=CACHE_TTL, timeout=DEFAULT_TIMEOUT,
+              path=None):
+    """Return the IPs of local Tablo devices, from the cache if it is
+    fresh and refresh is False."""
+    if not refresh:
+        ips = cached_ips(ttl, path)
+        if ips:
+            LOGGER.debug('Using cached Tablo IPs [%s]', ' '.join(sorted(ips)))
+            return ips
+    ips = set(discover(timeout=timeout))
+    if ips:
+        save_ips(ips, path)
+    return ips
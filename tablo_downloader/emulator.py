@@ -0,0 +1,450 @@
+"""An emulated Tablo device for integration and load testing.
+
+The emulator serves the Tablo APIs used by this package from a synthetic
+library of recordings, including HLS playlists and MPEG-TS segments, with
+configurable per-request latency, a bandwidth cap and error injection. The
+Tablo APIs always use port 8885, so each emulated device listens on its own
+address, e.g. one of the 127.0.0.0/8 loopback addresses:
+
+    tldlemu --ip 127.0.0.2 --recordings 1000 --latency 0.02
+
+or, from Python:
+
+    with emulator.Emulator('127.0.0.2', recordings=1000) as device:
+        apis.server_recordings(device.ip)
+"""
+
+import argparse
+import collections
+import http.server
+import json
+import logging
+import random
+import socket
+import threading
+import time
+import urllib.parse
+
+from tablo_downloader import apis
+from tablo_downloader import discovery
+
+LOGGER = logging.getLogger(__name__)
+
+CATEGORIES = (('series', 'episodes'), ('movies', 'airings'),
+              ('sports', 'events'))
+FIRST_RECORDING_ID = 100000
+TS_PACKET_SIZE = 188
+WRITE_CHUNK_SIZE = 64 * 1024
+
+DEFAULT_RECORDINGS = 100
+DEFAULT_SEGMENTS = 10
+DEFAULT_SEGMENT_BYTES = 188 * 1000
+DEFAULT_SEGMENT_DURATION = 10.0
+DEFAULT_TUNERS = 2
+
+
+def ts_segment(size):
+    """Return size bytes, rounded up to whole packets, of MPEG-TS null
+    packets."""
+    packet = bytes([0x47, 0x1F, 0xFF, 0x10]) + b'\xff' * (TS_PACKET_SIZE - 4)
+    return packet * max(1, -(-size // TS_PACKET_SIZE))
+
+
+class Library:
+    """A synthetic library of recordings, generated deterministically."""
+
+    def __init__(self, size=DEFAULT_RECORDINGS, segments=DEFAULT_SEGMENTS,
+                 segment_duration=DEFAULT_SEGMENT_DURATION, in_progress=0,
+                 seed=0):
+        self.segments = segments
+        self.segment_duration = segment_duration
+        self._lock = threading.Lock()
+        self._recordings = collections.OrderedDict()
+        rng = random.Random(seed)
+        for i in range(size):
+            category, kind = CATEGORIES[i % len(CATEGORIES)]
+            object_id = FIRST_RECORDING_ID + i
+            path = '/recordings/%s/%s/%d' % (category, kind, object_id)
+            self._recordings[path] = self._details(
+                rng, i, category, object_id, path,
+                'recording' if i < in_progress else 'finished')
+
+    def _details(self, rng, i, category, object_id, path, state):
+        show = i // 10
+        duration = int(self.segments * self.segment_duration)
+        details = {
+            'object_id': object_id,
+            'path': path,
+            'airing_details': {
+                'channel_path': '/recordings/channels/%d' % (200000 + i % 5),
+                'datetime': '2021-%02d-%02dT%02d:00Z' % (
+                    1 + i % 12, 1 + i % 28, i % 24),
+                'duration': duration,
+                'show_title': 'Show %d' % show,
+            },
+            'user_info': {'position': 0, 'protected': False,
+                          'watched': False},
+            'video_details': {
+                'duration': duration,
+                'size': rng.randint(100, 1000) * 1000000,
+                'state': state,
+                'height': 720,
+                'width': 1280,
+            },
+        }
+        if category == 'series':
+            details['episode'] = {
+                'title': 'Episode %d' % i,
+                'description': 'Description of episode %d' % i,
+                'season_number': 1 + i % 3,
+                'number': 1 + i % 20,
+                'orig_air_date': '2020-01-01',
+            }
+            details['series_path'] = '/recordings/series/%d' % (
+                90000 + show)
+        elif category == 'movies':
+            details['movie_airing'] = {'release_year': 1950 + i % 70}
+        else:
+            details['event'] = {'title': 'Event %d' % i,
+                                'description': 'Description of event %d' % i,
+                                'season': '2021'}
+        return details
+
+    def paths(self):
+        with self._lock:
+            return list(self._recordings)
+
+    def details(self, path):
+        with self._lock:
+            return self._recordings.get(path)
+
+    def delete(self, path):
+        with self._lock:
+            return self._recordings.pop(path, None) is not None
+
+    def series(self):
+        with self._lock:
+            return sorted({d['series_path'] for d in self._recordings.values()
+                           if 'series_path' in d})
+
+
+class Emulator:
+    """An emulated Tablo device listening on ip:8885.
+
+    latency is a delay in seconds before each response. bandwidth caps the
+    bytes per second sent over all connections, if given. error_rate is
+    the fraction of requests answered with a 500 error. stats counts the
+    requests served by kind.
+    """
+
+    def __init__(self, ip='127.0.0.1', recordings=DEFAULT_RECORDINGS,
+                 segments=DEFAULT_SEGMENTS,
+                 segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 segment_duration=DEFAULT_SEGMENT_DURATION, in_progress=0,
+                 latency=0.0, bandwidth=None, error_rate=0.0,
+                 tuners=DEFAULT_TUNERS, seed=0, port=apis.TABLO_INFO_PORT):
+        self.ip = ip
+        self.port = port
+        self.library = Library(recordings, segments, segment_duration,
+                               in_progress, seed)
+        self.segment = ts_segment(segment_bytes)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.tuners = tuners
+        self.stats = collections.Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_send = 0.0
+        self._server = None
+        self._thread = None
+        self._discovery = None
+        self._discovery_thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        emulator = self
+
+        class Handler(RequestHandler):
+            device = emulator
+
+        self._server = http.server.ThreadingHTTPServer(
+            (self.ip, self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        self.start_discovery()
+        LOGGER.info('Emulating a Tablo with [%d] recordings at [%s:%d]',
+                    len(self.library.paths()), self.ip, self.port)
+
+    def start_discovery(self):
+        """Answer discovery probes on ip:DISCOVERY_PORT, if it is free."""
+        try:
+            self._discovery = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._discovery.bind((self.ip, discovery.DISCOVERY_PORT))
+        except OSError as e:
+            LOGGER.info('Not answering discovery probes: %s', e)
+            self._discovery.close()
+            self._discovery = None
+            return
+        self._discovery.settimeout(0.05)
+        self._discovery_thread = threading.Thread(
+            target=self._answer_probes, args=(self._discovery,), daemon=True)
+        self._discovery_thread.start()
+
+    def _answer_probes(self, sock):
+        while self._discovery is sock:
+            try:
+                data, address = sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if data.startswith(discovery.DISCOVERY_PROBE[:4]):
+                self.stats['discovery'] += 1
+                sock.sendto(discovery.DISCOVERY_PROBE[:4] +
+                            self.ip.encode(), address)
+
+    def stop(self):
+        if self._discovery:
+            sock, self._discovery = self._discovery, None
+            self._discovery_thread.join()
+            sock.close()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def throttle(self, size):
+        """Wait until size more bytes may be sent under the bandwidth cap."""
+        if not self.bandwidth:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_send)
+            self._next_send = start + size / self.bandwidth
+        if start > now:
+            time.sleep(start - now)
+
+    def server_info(self):
+        return {
+            'availability': 'ready',
+            'build_number': 1234567,
+            'local_address': self.ip,
+            'model': {'device': 'emulator', 'name': 'Tablo Emulator',
+                      'tuners': self.tuners, 'type': 'emulator',
+                      'wifi': False},
+            'name': 'Tablo Emulator %s' % self.ip,
+            'product': 'tablo',
+            'server_id': 'SID_EMULATOR_%s' % self.ip.replace('.', '_'),
+            'setup_completed': True,
+            'timezone': '',
+            'version': '2.2.22',
+        }
+
+    def playlist(self, path):
+        segments = ['#EXTM3U', '#EXT-X-VERSION:3',
+                    '#EXT-X-TARGETDURATION:%d' % self.library.segment_duration,
+                    '#EXT-X-MEDIA-SEQUENCE:1']
+        object_id = path.rsplit('/', 1)[-1]
+        for i in range(self.library.segments):
+            segments.append('#EXTINF:%.3f,' % self.library.segment_duration)
+            segments.append('segs/%s/%05d.ts' % (object_id, i + 1))
+        segments.append('#EXT-X-ENDLIST')
+        return '\n'.join(segments) + '\n'
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    device = None
+
+    def log_message(self, format, *args):
+        LOGGER.debug('%s: ' + format, self.device.ip, *args)
+
+    def send_body(self, body, status=200, content_type='application/json'):
+        if isinstance(body, str):
+            body = body.encode()
+        elif not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        for start in range(0, len(body), WRITE_CHUNK_SIZE):
+            chunk = body[start:start + WRITE_CHUNK_SIZE]
+            self.device.throttle(len(chunk))
+            self.wfile.write(chunk)
+
+    def handle_request(self, method):
+        device = self.device
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+        if device.latency:
+            time.sleep(device.latency)
+        if device.should_fail():
+            device.stats['error'] += 1
+            return self.send_body({'error': 'injected'}, status=500)
+
+        library = device.library
+        if method == 'GET' and path == '/server/info':
+            kind, res = 'server_info', device.server_info()
+        elif method == 'GET' and path == '/server/capabilities':
+            kind, res = 'capabilities', {'capabilities': ['recordings_keep']}
+        elif method == 'GET' and path == '/settings/info':
+            kind, res = 'settings', {'recording_quality':
+                                     '/settings/recording_qualities/5'}
+        elif method == 'GET' and path == '/guide/channels':
+            kind = 'channels'
+            res = ['/guide/channels/%d' % (200000 + i) for i in range(5)]
+        elif method == 'GET' and path.startswith('/guide/channels/'):
+            kind = 'channel_details'
+            res = {'path': path, 'channel': {'call_sign': 'EMU'}}
+        elif method == 'GET' and path == '/recordings/airings':
+            kind, res = 'airings', library.paths()
+        elif method == 'GET' and path == '/recordings/series':
+            kind, res = 'series', library.series()
+        elif method == 'GET' and path.startswith('/recordings/series/') and \
+                path.count('/') == 3:
+            kind, res = 'series_details', {'path': path}
+        elif method == 'POST' and path == '/batch':
+            kind = 'batch'
+            res = {p: library.details(p) for p in json.loads(body or '[]')
+                   if library.details(p)}
+        elif method == 'POST' and path.endswith('/watch'):
+            kind = 'watch'
+            if not library.details(path[:-len('/watch')]):
+                return self.send_body({'error': 'not found'}, status=404)
+            res = {'playlist_url': 'http://%s:%d/stream/pl.m3u8?%s' % (
+                device.ip, device.port,
+                urllib.parse.urlencode({'path': path[:-len('/watch')]}))}
+        elif method == 'GET' and path == '/stream/pl.m3u8':
+            device.stats['playlist'] += 1
+            query = urllib.parse.parse_qs(url.query)
+            return self.send_body(device.playlist(query['path'][0]),
+                                  content_type='application/x-mpegURL')
+        elif method == 'GET' and path.startswith('/stream/segs/'):
+            device.stats['segment'] += 1
+            return self.send_body(device.segment, content_type='video/MP2T')
+        elif method == 'GET' and library.details(path):
+            kind, res = 'recording_details', library.details(path)
+        elif method == 'DELETE' and library.delete(path):
+            device.stats['delete'] += 1
+            return self.send_body(b'', content_type='text/plain')
+        else:
+            device.stats['not_found'] += 1
+            return self.send_body({'error': 'not found'}, status=404)
+        device.stats[kind] += 1
+        self.send_body(res)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Emulate a Tablo device.')
+    parser.add_argument(
+        '--ip',
+        default='127.0.0.1',
+        help='The IP address to listen on, at port %d' % apis.TABLO_INFO_PORT,
+    )
+    parser.add_argument(
+        '--recordings',
+        type=int,
+        default=DEFAULT_RECORDINGS,
+        help='Number of recordings in the library',
+    )
+    parser.add_argument(
+        '--in_progress',
+        type=int,
+        default=0,
+        help='Number of recordings still being recorded',
+    )
+    parser.add_argument(
+        '--segments',
+        type=int,
+        default=DEFAULT_SEGMENTS,
+        help='Number of HLS segments per recording',
+    )
+    parser.add_argument(
+        '--segment_bytes',
+        type=int,
+        default=DEFAULT_SEGMENT_BYTES,
+        help='Size of each HLS segment',
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.0,
+        help='Seconds to wait before answering each request',
+    )
+    parser.add_argument(
+        '--bandwidth',
+        type=float,
+        help='Maximum bytes per second sent by the device',
+    )
+    parser.add_argument(
+        '--error_rate',
+        type=float,
+        default=0.0,
+        help='Fraction of requests to fail with a 500 error',
+    )
+    parser.add_argument(
+        '--tuners',
+        type=int,
+        default=DEFAULT_TUNERS,
+        help='Number of tuners reported by the device',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed for the generated library and error injection',
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    Emulator(args.ip, recordings=args.recordings, segments=args.segments,
+             segment_bytes=args.segment_bytes, in_progress=args.in_progress,
+             latency=args.latency, bandwidth=args.bandwidth,
+             error_rate=args.error_rate, tuners=args.tuners,
+             seed=args.seed).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
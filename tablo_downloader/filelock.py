@@ -0,0 +1,100 @@
+"""Advisory file locks shared between tldl processes.
+
+RecordingsDB.sync_lock keeps two processes from syncing the same database
+at once, and downloads lock their destination so two processes never
+write the same file. Locks use fcntl.flock, so they are released if a
+process dies. Where fcntl is unavailable, e.g. on Windows, locks always
+succeed.
+"""
+
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds between attempts to take a lock held by another process.
+POLL_INTERVAL = 0.1
+
+
+class FileLock:
+    """An exclusive lock on path, created if needed.
+
+    With remove, path is removed when the lock is released, e.g. for locks
+    next to each download.
+    """
+
+    def __init__(self, path, remove=False):
+        self.path = path
+        self.remove = remove
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def _try_lock(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # The file may have been removed by the previous holder after we
+        # opened it, in which case the lock is on an orphan.
+        try:
+            same = os.stat(self.path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            same = False
+        if not same:
+            os.close(fd)
+            return self._try_lock()
+        self._fd = fd
+        return True
+
+    def acquire(self, blocking=True, timeout=None):
+        """Take the lock, returning False if it is held elsewhere and
+        blocking is False.
+
+        When blocking, waits up to timeout seconds, or forever if timeout
+        is None, then raises TimeoutError.
+        """
+        if fcntl is None:
+            self._fd = -1
+            return True
+        if self._try_lock():
+            return True
+        if not blocking:
+            return False
+        LOGGER.info('Waiting for another process to release [%s]', self.path)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._try_lock():
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError('Timed out waiting for [%s]' % self.path)
+            time.sleep(POLL_INTERVAL)
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        fd, self._fd = self._fd, None
+        if fd < 0:
+            return
+        if self.remove:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        os.close(fd)
@@ -0,0 +1,673 @@
+"""Download HLS recordings by fetching segments concurrently.
+
+Segments of a media playlist are fetched by a pool of workers through the
+shared apis client and written, in playlist order, to ffmpeg's stdin so it
+can remux the transport stream without fetching anything itself.
+
+Segments are also appended to a spool file next to the destination, with
+a sidecar state file recording how many segments it holds. An interrupted
+download is resumed from the spool by fetching only the missing segments
+and then remuxing the spool; both files are removed once ffmpeg succeeds.
+
+ffmpeg reports its progress on stdout, which is combined with the segments
+fetched into progress events: bytes, media time against the recording's
+duration, throughput and an ETA. A download that makes no progress for a
+while is cancelled and its ffmpeg killed.
+
+Downloads are verified as they are written, so multi-GB files never need
+to be read again: the segment count is checked against the playlist, the
+stream is hashed and each segment checked for MPEG-TS sync bytes, and the
+duration ffmpeg reports for the output is compared with the recording's.
+"""
+
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+from tablo_downloader import apis
+from tablo_downloader import ratelimit
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_WORKERS = 4
+# Maximum number of segments fetched or waiting to be written at a time,
+# which bounds the memory used to reorder them.
+DEFAULT_SEGMENT_BUFFER = 16
+DEFAULT_SEGMENT_RETRIES = 3
+SEGMENT_RETRY_DELAY = 1.0
+# Seconds without any segment fetched or media remuxed before a download
+# is considered stalled.
+DEFAULT_STALL_TIMEOUT = 120
+DEFAULT_PROGRESS_INTERVAL = 10
+# Seconds of history used to compute the throughput and ETA.
+THROUGHPUT_WINDOW = 10.0
+# Seconds between checks that a download has been cancelled.
+CANCEL_POLL_INTERVAL = 0.5
+# Seconds to wait for the last of ffmpeg's progress after it exits.
+PROGRESS_READ_TIMEOUT = 5.0
+
+# How far the output duration may be from the expected duration, the
+# larger of a number of seconds and a fraction of the expected duration.
+DURATION_TOLERANCE_SECONDS = 10
+DURATION_TOLERANCE_FRACTION = 0.01
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+
+SPOOL_SUFFIX = '.ts.part'
+STATE_SUFFIX = '.tldl-state'
+
+Segment = collections.namedtuple('Segment', ['url', 'duration'])
+
+
+class SegmentError(Exception):
+    """A segment couldn't be fetched."""
+
+
+def parse_playlist(m3u, base_url):
+    """Parse an m3u8 playlist.
+
+    Returns a tuple (segments, variants). For a media playlist segments is
+    a list of Segments and variants is empty; for a master playlist
+    variants is a list of apis.Variants. Relative URIs are resolved against
+    base_url.
+    """
+    variants = apis.playlist_variants(m3u, base_url)
+    if variants:
+        return [], variants
+    segments = []
+    duration = None
+    for line in m3u.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#EXTINF:'):
+            try:
+                duration = float(line[len('#EXTINF:'):].split(',')[0])
+            except ValueError:
+                duration = None
+        elif not line.startswith('#'):
+            segments.append(
+                Segment(urllib.parse.urljoin(base_url, line), duration))
+            duration = None
+    return segments, []
+
+
+def playlist_segments(playlist_url, quality=apis.DEFAULT_QUALITY):
+    """Return the Segments of a playlist, following a master playlist to
+    the variant chosen by apis.select_variant(quality).
+    """
+    return select_playlist(playlist_url, quality)[0]
+
+
+def select_playlist(playlist_url, quality=apis.DEFAULT_QUALITY):
+    """Return (segments, variant) for a playlist, like playlist_segments.
+
+    variant is the apis.Variant followed, or None for a media playlist.
+    """
+    variant = None
+    for _ in range(2):
+        m3u = apis.call_api(playlist_url, output='text')
+        if not isinstance(m3u, str):
+            raise SegmentError(m3u)
+        segments, variants = parse_playlist(m3u, playlist_url)
+        if not variants:
+            return segments, variant
+        variant = apis.select_variant(variants, quality)
+        LOGGER.debug('Selected variant [%s] of [%s]', variant, playlist_url)
+        playlist_url = variant.url
+    raise SegmentError('Nested master playlists at [%s]' % playlist_url)
+
+
+def fetch_segment(segment, retries=DEFAULT_SEGMENT_RETRIES):
+    """Return the bytes of a segment, retrying failed fetches.
+
+    Fetches are throttled to the bandwidth limits of ratelimit.LIMITS.
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(SEGMENT_RETRY_DELAY * attempt)
+        ip = urllib.parse.urlsplit(segment.url).hostname
+        if ratelimit.LIMITS.limited(ip):
+            data = apis.stream_content(
+                segment.url, lambda size: ratelimit.LIMITS.consume(ip, size))
+        else:
+            data = apis.call_api(segment.url, output='content')
+        if isinstance(data, bytes):
+            return data
+        LOGGER.debug('Attempt [%d] to fetch segment [%s] failed: %s',
+                     attempt + 1, segment.url, data)
+    raise SegmentError(data)
+
+
+def fetch_segments(segments, write, workers=DEFAULT_SEGMENT_WORKERS,
+                   buffer_size=DEFAULT_SEGMENT_BUFFER, cancel=None):
+    """Fetch segments concurrently and call write(data) for each in order.
+
+    At most buffer_size segments are in flight or waiting to be written.
+    Raises SegmentError if a segment can't be fetched, or once the
+    threading.Event cancel is set; later segments are not written. Returns
+    the number of bytes written.
+    """
+    buffer_size = max(1, buffer_size, workers)
+    written = 0
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers))
+    pending = collections.deque()
+    next_segment = 0
+    try:
+        while pending or next_segment < len(segments):
+            while (len(pending) < buffer_size and
+                   next_segment < len(segments)):
+                pending.append(
+                    pool.submit(fetch_segment, segments[next_segment]))
+                next_segment += 1
+            future = pending.popleft()
+            while cancel is not None:
+                if cancel.is_set():
+                    raise SegmentError('Cancelled')
+                try:
+                    future.result(timeout=CANCEL_POLL_INTERVAL)
+                    break
+                except concurrent.futures.TimeoutError:
+                    pass
+            data = future.result()
+            write(data)
+            written += len(data)
+    finally:
+        # Don't wait for segments still being fetched, which may be stuck
+        # if the download was cancelled.
+        pool.shutdown(wait=False, cancel_futures=True)
+    return written
+
+
+def parse_progress(lines):
+    """Parse ffmpeg -progress output, yielding a dict per progress block."""
+    fields = {}
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        key, _, value = line.strip().partition('=')
+        if not key:
+            continue
+        fields[key] = value
+        if key == 'progress':
+            yield fields
+            fields = {}
+
+
+class Progress:
+    """Tracks the progress of a download and reports it as events.
+
+    Events are dicts whose 'event' is 'progress', 'stalled', 'finished' or
+    'failed', passed to on_event(event) every interval seconds while the
+    download runs and when it ends. If neither a segment is fetched nor
+    ffmpeg's media time advances for stall_timeout seconds, the download
+    is cancelled and its ffmpeg killed.
+    """
+
+    def __init__(self, filename, duration=None, on_event=None,
+                 interval=DEFAULT_PROGRESS_INTERVAL,
+                 stall_timeout=DEFAULT_STALL_TIMEOUT):
+        self.filename = filename
+        self.duration = duration
+        self.on_event = on_event
+        self.interval = interval
+        self.stall_timeout = stall_timeout
+        self.phase = 'fetching'
+        self.segments = 0
+        self.completed = 0
+        self.bytes = 0
+        self.fetched_seconds = 0.0
+        self.media_seconds = None
+        self.process = None
+        self._reader = None
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last_change = self._start
+        self._samples = collections.deque([(self._start, 0, 0.0)])
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _changed(self):
+        now = time.monotonic()
+        self._last_change = now
+        self._samples.append((now, self.bytes, self.position()))
+        while now - self._samples[0][0] > THROUGHPUT_WINDOW:
+            self._samples.popleft()
+
+    def position(self):
+        """Return the seconds of media downloaded or remuxed."""
+        if self.media_seconds is not None:
+            return self.media_seconds
+        return self.fetched_seconds
+
+    def add_segment(self, size, duration):
+        with self._lock:
+            self.completed += 1
+            self.bytes += size
+            self.fetched_seconds += duration or 0
+            self._changed()
+
+    def set_phase(self, phase):
+        with self._lock:
+            self.phase = phase
+            if phase == 'remuxing':
+                self.media_seconds = 0.0
+            elif phase == 'fetching':
+                self.media_seconds = None
+            self._changed()
+
+    def update_media(self, fields):
+        """Update the media time from a block of ffmpeg progress."""
+        try:
+            seconds = int(fields.get('out_time_us', '')) / 1e6
+        except ValueError:
+            return
+        with self._lock:
+            if seconds != self.media_seconds:
+                self.media_seconds = seconds
+                self._changed()
+
+    def watch(self, process):
+        """Follow the progress of an ffmpeg started with -progress pipe:1.
+
+        Returns the thread reading its progress.
+        """
+        self.process = process
+
+        def read():
+            for fields in parse_progress(process.stdout):
+                self.update_media(fields)
+
+        thread = threading.Thread(target=read, daemon=True)
+        thread.start()
+        self._reader = thread
+        return thread
+
+    def wait(self, process):
+        """Wait for ffmpeg to exit and its progress to be read, returning
+        its exit code."""
+        returncode = process.wait()
+        if self._reader:
+            self._reader.join(PROGRESS_READ_TIMEOUT)
+        return returncode
+
+    def snapshot(self, event='progress'):
+        with self._lock:
+            now = time.monotonic()
+            position = self.position()
+            first = self._samples[0]
+            elapsed = now - first[0]
+            rate = (position - first[2]) / elapsed if elapsed else 0
+            res = {
+                'event': event,
+                'filename': self.filename,
+                'phase': self.phase,
+                'segments': self.segments,
+                'completed': self.completed,
+                'bytes': self.bytes,
+                'media_seconds': position,
+                'duration': self.duration,
+                'fraction': None,
+                'bytes_per_second': (
+                    (self.bytes - first[1]) / elapsed if elapsed else 0),
+                'eta': None,
+                'elapsed': now - self._start,
+            }
+        if self.duration:
+            res['fraction'] = min(1.0, position / self.duration)
+            if rate > 0:
+                res['eta'] = max(0.0, self.duration - position) / rate
+        return res
+
+    def emit(self, event='progress'):
+        if self.on_event:
+            self.on_event(self.snapshot(event))
+
+    def stall(self):
+        """Cancel the download and kill its ffmpeg."""
+        LOGGER.warning('Download of [%s] stalled for %ds, cancelling',
+                       self.filename, self.stall_timeout)
+        self.cancelled.set()
+        self.emit('stalled')
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.kill()
+
+    def _run(self):
+        tick = min(1.0, self.interval or 1.0,
+                   (self.stall_timeout or 4) / 4)
+        next_event = time.monotonic() + self.interval if self.interval \
+            else None
+        while not self._stop.wait(tick):
+            now = time.monotonic()
+            if (self.stall_timeout and not self.cancelled.is_set() and
+                    now - self._last_change > self.stall_timeout):
+                self.stall()
+            if next_event is not None and now >= next_event:
+                self.emit()
+                next_event = now + self.interval
+
+
+def format_progress(event):
+    """Return a one line description of a progress event."""
+    line = '[%s] %s' % (event['filename'], event['event'])
+    if event['event'] == 'progress':
+        line += ' (%s)' % event['phase']
+    if event['fraction'] is not None:
+        line += ' %.0f%%' % (100 * event['fraction'])
+    line += ' %.0f' % event['media_seconds']
+    if event['duration']:
+        line += '/%.0f' % event['duration']
+    line += 's, %.1f MB, %.2f MB/s' % (event['bytes'] / 1e6,
+                                       event['bytes_per_second'] / 1e6)
+    if event['eta'] is not None and event['event'] == 'progress':
+        line += ', ETA %s' % datetime.timedelta(seconds=int(event['eta']))
+    return line
+
+
+class Verifier:
+    """Verifies a download from the segments written and ffmpeg's output.
+
+    Segments are counted, hashed in order with SHA-256 and checked for
+    MPEG-TS sync bytes as they are written.
+    """
+
+    def __init__(self, expected_segments, expected_duration=None):
+        self.expected_segments = expected_segments
+        self.expected_duration = expected_duration
+        self.sha256 = hashlib.sha256()
+        self.segments = 0
+        self.bytes = 0
+        self.bad_segments = 0
+
+    def add(self, data):
+        self.sha256.update(data)
+        self.segments += 1
+        self.bytes += len(data)
+        if (not data or data[0] != TS_SYNC_BYTE or
+                len(data) % TS_PACKET_SIZE):
+            self.bad_segments += 1
+
+    def add_spool(self, spool, size, segments):
+        """Hash the first size bytes, holding segments segments, of the
+        spool of a download being resumed."""
+        spool.seek(0)
+        remaining = size
+        while remaining > 0:
+            data = spool.read(min(remaining, 1024 * 1024))
+            if not data:
+                break
+            self.sha256.update(data)
+            remaining -= len(data)
+        self.segments += segments
+        self.bytes += size - remaining
+
+    def result(self, duration):
+        """Return a dict describing the download, given the duration of the
+        output in seconds, if known.
+
+        verified is True if there were no problems, a list of strings.
+        """
+        problems = []
+        if self.segments != self.expected_segments:
+            problems.append('Got [%d] of [%d] segments' % (
+                self.segments, self.expected_segments))
+        if self.bad_segments:
+            problems.append('[%d] segments are not MPEG-TS' %
+                            self.bad_segments)
+        if duration is None:
+            problems.append('Unknown output duration')
+        elif self.expected_duration:
+            tolerance = max(
+                DURATION_TOLERANCE_SECONDS,
+                DURATION_TOLERANCE_FRACTION * self.expected_duration)
+            if abs(duration - self.expected_duration) > tolerance:
+                problems.append('Output is %.1fs, expected %.1fs' % (
+                    duration, self.expected_duration))
+        return {
+            'verified': not problems,
+            'problems': problems,
+            'segments': self.segments,
+            'expected_segments': self.expected_segments,
+            'bytes': self.bytes,
+            'sha256': self.sha256.hexdigest(),
+            'duration': duration,
+            'expected_duration': self.expected_duration,
+        }
+
+
+def spool_filename(mp4_filename):
+    return mp4_filename + SPOOL_SUFFIX
+
+
+def state_filename(mp4_filename):
+    return mp4_filename + STATE_SUFFIX
+
+
+def load_state(mp4_filename):
+    """Return the saved state of a partial download, or None."""
+    try:
+        with open(state_filename(mp4_filename)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(mp4_filename, state):
+    filename = state_filename(mp4_filename)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(filename + '.tmp', filename)
+
+
+def partial_key(recording_id, variant, segments):
+    """Return what a partial download must match to be resumed: the
+    recording, the variant followed and the number of segments.
+
+    The variant URL's query, which may hold a per-session token, is left
+    out.
+    """
+    return {
+        'recording_id': recording_id,
+        'variant': variant and {
+            'url': urllib.parse.urlsplit(variant.url).path,
+            'bandwidth': variant.bandwidth,
+            'resolution': variant.resolution,
+        },
+        'segments': len(segments),
+    }
+
+
+def has_partial(mp4_filename):
+    """Return True if a download to mp4_filename can be resumed."""
+    return (load_state(mp4_filename) is not None and
+            os.path.exists(spool_filename(mp4_filename)))
+
+
+def clear_partial(mp4_filename):
+    """Remove the spool and state of a partial download."""
+    for filename in (spool_filename(mp4_filename),
+                     state_filename(mp4_filename)):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def remux_command(source, mp4_filename, title):
+    return [
+        'ffmpeg', '-hide_banner', '-loglevel', 'warning', '-nostats',
+        '-progress', 'pipe:1', '-y',
+        '-f', 'mpegts', '-i', source, '-c', 'copy',
+        '-metadata', f'title={title}', mp4_filename
+    ]
+
+
+def start_ffmpeg(cmd, progress, pipe_input=False):
+    """Start ffmpeg, following its progress, and return the process.
+
+    With pipe_input, the process's stdin is a pipe for the input stream.
+    """
+    import subprocess
+    LOGGER.debug('Running [%s]', ' '.join(cmd))
+    process = subprocess.Popen(
+        cmd, stdin=subprocess.PIPE if pipe_input else None,
+        stdout=subprocess.PIPE)
+    progress.watch(process)
+    return process
+
+
+def remux_spool(mp4_filename, title, progress=None):
+    progress = progress or Progress(mp4_filename)
+    progress.set_phase('remuxing')
+    cmd = remux_command(spool_filename(mp4_filename), mp4_filename, title)
+    process = start_ffmpeg(cmd, progress)
+    return progress.wait(process) == 0 and not progress.cancelled.is_set()
+
+
+def download(playlist_url, mp4_filename, title,
+             workers=DEFAULT_SEGMENT_WORKERS,
+             buffer_size=DEFAULT_SEGMENT_BUFFER, duration=None,
+             on_event=None, progress_interval=DEFAULT_PROGRESS_INTERVAL,
+             stall_timeout=DEFAULT_STALL_TIMEOUT,
+             quality=apis.DEFAULT_QUALITY, recording_id=None):
+    """Download the HLS stream at playlist_url to mp4_filename.
+
+    Resumes a partial download to mp4_filename if there is one for the
+    same recording_id, variant and number of segments; any other partial
+    download there is discarded. duration,
+    the length of the recording in seconds, defaults to the length of the
+    playlist. Progress events are passed to on_event, see Progress. quality
+    chooses the variant of a master playlist, see apis.select_variant.
+    If every segment was fetched and ffmpeg succeeded, returns the
+    Verifier.result for the download, else None.
+    """
+    with Progress(mp4_filename, duration, on_event, progress_interval,
+                  stall_timeout) as progress:
+        res = _download(playlist_url, mp4_filename, title, workers,
+                        buffer_size, progress, quality, recording_id)
+    progress.emit('finished' if res else 'failed')
+    return res
+
+
+def _download(playlist_url, mp4_filename, title, workers, buffer_size,
+              progress, quality, recording_id):
+    try:
+        segments, variant = select_playlist(playlist_url, quality)
+    except SegmentError as e:
+        LOGGER.error('Unable to get playlist [%s]: %s', playlist_url, e)
+        return None
+    if not progress.duration:
+        progress.duration = sum(s.duration or 0 for s in segments) or None
+
+    key = partial_key(recording_id, variant, segments)
+    state = load_state(mp4_filename)
+    if (state is None or not os.path.exists(spool_filename(mp4_filename)) or
+            any(state.get(k) != v for k, v in key.items()) or
+            state['completed'] > len(segments)):
+        if state is not None:
+            LOGGER.info('Discarding partial download [%s], which is of '
+                        'another recording or variant or is incomplete',
+                        mp4_filename)
+        clear_partial(mp4_filename)
+        state = dict(key, completed=0, bytes=0)
+    else:
+        LOGGER.info('Resuming [%s] from segment [%d] of [%d]', mp4_filename,
+                    state['completed'] + 1, len(segments))
+    save_state(mp4_filename, state)
+    progress.segments = len(segments)
+    progress.completed = state['completed']
+    progress.bytes = state['bytes']
+    progress.fetched_seconds = sum(
+        s.duration or 0 for s in segments[:state['completed']])
+    remaining = segments[state['completed']:]
+    verifier = Verifier(len(segments), progress.duration)
+    LOGGER.debug('Fetching [%d] segments for [%s]', len(remaining),
+                 mp4_filename)
+
+    # A fresh download is streamed to ffmpeg as it is fetched. A resumed
+    # one, or one whose ffmpeg fails while streaming, is remuxed from the
+    # spool once all segments are there.
+    ffmpeg = None
+    if not state['completed']:
+        progress.set_phase('streaming')
+        ffmpeg = start_ffmpeg(remux_command('pipe:0', mp4_filename, title),
+                              progress, pipe_input=True)
+
+    def write(data):
+        nonlocal ffmpeg
+        spool.write(data)
+        spool.flush()
+        state['completed'] += 1
+        state['bytes'] += len(data)
+        save_state(mp4_filename, state)
+        verifier.add(data)
+        progress.add_segment(len(data),
+                             segments[state['completed'] - 1].duration)
+        if ffmpeg:
+            try:
+                ffmpeg.stdin.write(data)
+            except BrokenPipeError:
+                if progress.cancelled.is_set():
+                    raise SegmentError('Cancelled')
+                LOGGER.warning('ffmpeg exited early for [%s], will remux '
+                               'after fetching', mp4_filename)
+                ffmpeg.wait()
+                ffmpeg = None
+                progress.set_phase('fetching')
+
+    start = time.monotonic()
+    mode = 'r+b' if os.path.exists(spool_filename(mp4_filename)) else 'wb'
+    with open(spool_filename(mp4_filename), mode) as spool:
+        spool.truncate(state['bytes'])
+        if state['completed']:
+            verifier.add_spool(spool, state['bytes'], state['completed'])
+        spool.seek(state['bytes'])
+        try:
+            size = fetch_segments(remaining, write, workers, buffer_size,
+                                  cancel=progress.cancelled)
+        except SegmentError as e:
+            LOGGER.error('Download of [%s] failed after [%d] of [%d] '
+                         'segments: %s', mp4_filename, state['completed'],
+                         len(segments), e)
+            if ffmpeg:
+                ffmpeg.kill()
+                ffmpeg.wait()
+            return None
+    seconds = time.monotonic() - start
+    LOGGER.debug('Fetched %.1f MB for [%s] in %.1fs (%.2f MB/s)', size / 1e6,
+                 mp4_filename, seconds, size / 1e6 / seconds if seconds else 0)
+
+    ok = False
+    if ffmpeg:
+        try:
+            ffmpeg.stdin.close()
+        except BrokenPipeError:
+            pass
+        ok = progress.wait(ffmpeg) == 0
+    if progress.cancelled.is_set():
+        return None
+    if not ok:
+        ok = remux_spool(mp4_filename, title, progress)
+    if not ok:
+        return None
+    clear_partial(mp4_filename)
+    res = verifier.result(progress.media_seconds)
+    if not res['verified']:
+        LOGGER.warning('Download of [%s] failed verification: %s',
+                       mp4_filename, '; '.join(res['problems']))
+    return res
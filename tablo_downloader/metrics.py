@@ -0,0 +1,230 @@
+"""Per-endpoint metrics for Tablo API calls.
+
+apis.call_api and aioapis.call_api record every request in METRICS: call
+counts, a latency histogram, bytes received, status codes and exception
+types, labelled by device, method and endpoint. Endpoints are URL paths
+with recording, series and channel IDs and segment names replaced by
+placeholders, so e.g. every recording detail request is counted together.
+
+A snapshot can be written as JSON or in the Prometheus text format, e.g.
+for node_exporter's textfile collector.
+"""
+
+import collections
+import json
+import logging
+import os
+import re
+import threading
+import urllib.parse
+
+LOGGER = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+PROMETHEUS_PREFIX = 'tablo_api'
+
+_ID_RE = re.compile(r'^\d+$')
+
+
+def endpoint(url):
+    """Return (device, endpoint) labels for a URL."""
+    parts = urllib.parse.urlsplit(url)
+    components = parts.path.split('/')
+    if components[-1].endswith('.ts'):
+        path = '/stream/{segment}.ts'
+    else:
+        path = '/'.join('{id}' if _ID_RE.match(c) else c for c in components)
+    return parts.hostname or '', path or '/'
+
+
+class EndpointStats:
+    """Counters for one (device, method, endpoint)."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.status_codes = collections.Counter()
+        self.exceptions = collections.Counter()
+
+    def snapshot(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'cache_hits': self.cache_hits,
+            'seconds': self.seconds,
+            'bytes': self.bytes,
+            'latency_buckets': dict(zip(
+                [str(b) for b in LATENCY_BUCKETS], self.buckets)),
+            'status_codes': {str(k): v for k, v in
+                             sorted(self.status_codes.items())},
+            'exceptions': dict(sorted(self.exceptions.items())),
+        }
+
+
+class Metrics:
+    """A thread-safe collection of EndpointStats."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _endpoint_stats(self, method, url):
+        device, path = endpoint(url)
+        key = (device, method, path)
+        if key not in self._stats:
+            self._stats[key] = EndpointStats()
+        return self._stats[key]
+
+    def record(self, method, url, seconds, status_code=None, size=0,
+               exception=None):
+        """Record a request that got a response or raised an exception."""
+        with self._lock:
+            stats = self._endpoint_stats(method, url)
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.bytes += size
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats.buckets[i] += 1
+                    break
+            if exception is not None:
+                stats.errors += 1
+                stats.exceptions[type(exception).__name__] += 1
+            else:
+                stats.status_codes[status_code] += 1
+                if status_code >= 400:
+                    stats.errors += 1
+
+    def record_cache_hit(self, method, url):
+        with self._lock:
+            self._endpoint_stats(method, url).cache_hits += 1
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def snapshot(self):
+        """Return the metrics as a list of dicts, one per endpoint."""
+        with self._lock:
+            return [dict(device=device, method=method, endpoint=path,
+                         **stats.snapshot())
+                    for (device, method, path), stats in
+                    sorted(self._stats.items())]
+
+    def summary(self):
+        """Return a one line summary of the calls made so far."""
+        snapshot = self.snapshot()
+        calls = sum(s['calls'] for s in snapshot)
+        errors = sum(s['errors'] for s in snapshot)
+        seconds = sum(s['seconds'] for s in snapshot)
+        size = sum(s['bytes'] for s in snapshot)
+        slowest = max(snapshot, default=None,
+                      key=lambda s: s['seconds'] / s['calls']
+                      if s['calls'] else 0)
+        line = ('[%d] API calls, [%d] errors, %.1f MB, mean latency %.3fs' %
+                (calls, errors, size / 1e6, seconds / calls if calls else 0))
+        if slowest and slowest['calls']:
+            line += ', slowest [%s %s %s] %.3fs' % (
+                slowest['device'], slowest['method'], slowest['endpoint'],
+                slowest['seconds'] / slowest['calls'])
+        return line
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        p = PROMETHEUS_PREFIX
+        lines = [
+            '# HELP %s_requests_total Tablo API requests.' % p,
+            '# TYPE %s_requests_total counter' % p,
+        ]
+        snapshot = self.snapshot()
+
+        def labels(s, **extra):
+            items = [('device', s['device']), ('method', s['method']),
+                     ('endpoint', s['endpoint'])] + sorted(extra.items())
+            return '{%s}' % ','.join(
+                '%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                             .replace('"', '\\"')) for k, v in items)
+
+        for s in snapshot:
+            for code, count in s['status_codes'].items():
+                lines.append('%s_requests_total%s %d' % (
+                    p, labels(s, status=code), count))
+            for name, count in s['exceptions'].items():
+                lines.append('%s_requests_total%s %d' % (
+                    p, labels(s, exception=name), count))
+        for name, key, help_text in (
+                ('errors_total', 'errors', 'Failed Tablo API requests.'),
+                ('cache_hits_total', 'cache_hits',
+                 'Tablo API responses served from the cache.'),
+                ('response_bytes_total', 'bytes',
+                 'Bytes received from Tablo APIs.')):
+            lines.append('# HELP %s_%s %s' % (p, name, help_text))
+            lines.append('# TYPE %s_%s counter' % (p, name))
+            for s in snapshot:
+                lines.append('%s_%s%s %d' % (p, name, labels(s), s[key]))
+        lines.append('# HELP %s_request_seconds Tablo API request latency.'
+                     % p)
+        lines.append('# TYPE %s_request_seconds histogram' % p)
+        for s in snapshot:
+            cumulative = 0
+            for bound in LATENCY_BUCKETS:
+                cumulative += s['latency_buckets'][str(bound)]
+                lines.append('%s_request_seconds_bucket%s %d' % (
+                    p, labels(s, le=bound), cumulative))
+            lines.append('%s_request_seconds_bucket%s %d' % (
+                p, labels(s, le='+Inf'), s['calls']))
+            lines.append('%s_request_seconds_sum%s %f' % (
+                p, labels(s), s['seconds']))
+            lines.append('%s_request_seconds_count%s %d' % (
+                p, labels(s), s['calls']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, output_format=None):
+        """Atomically write the metrics to filename.
+
+        output_format is 'json' or 'prometheus'; by default it is JSON for
+        .json files and Prometheus otherwise.
+        """
+        if output_format is None:
+            output_format = ('json' if filename.endswith('.json')
+                             else 'prometheus')
+        if output_format == 'json':
+            text = json.dumps(self.snapshot(), indent=2) + '\n'
+        else:
+            text = self.prometheus()
+        with open(filename + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(filename + '.tmp', filename)
+
+
+METRICS = Metrics()
+
+
+class Reporter:
+    """Periodically log METRICS.summary() with log(msg) from a thread."""
+
+    def __init__(self, interval, log=LOGGER.info, metrics=METRICS):
+        self.interval = interval
+        self.log = log
+        self.metrics = metrics
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.log(self.metrics.summary())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.log(self.metrics.summary())
@@ -0,0 +1,168 @@
+"""Bandwidth limits for downloads.
+
+LIMITS holds a global limit and per-device limits, in bytes per second,
+enforced with token buckets on the HLS segments fetched by hls. Limited
+segments are read in chunks as tokens become available, so the transfer
+itself slows down rather than arriving in bursts.
+
+Limits can be changed while downloads run with LIMITS.configure, or by
+rewriting a JSON limits file given to LIMITS.watch_file, e.g.
+
+    {"global": "20M", "device": "8M", "devices": {"192.168.1.25": "4M"}}
+
+Rates are bytes per second, optionally with a K, M or G suffix; a missing,
+null or zero rate is unlimited.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# Bytes a bucket may accumulate while idle, in seconds of its rate.
+BURST_SECONDS = 1.0
+# Seconds between checks for changes to a watched limits file.
+FILE_CHECK_INTERVAL = 5.0
+
+_UNITS = {'K': 1e3, 'M': 1e6, 'G': 1e9}
+
+
+def parse_rate(value):
+    """Return a rate in bytes per second, or None for unlimited."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = value.strip().upper().rstrip('B')
+        multiplier = 1
+        if value and value[-1] in _UNITS:
+            multiplier = _UNITS[value[-1]]
+            value = value[:-1]
+        value = float(value) * multiplier
+    return value if value > 0 else None
+
+
+class TokenBucket:
+    """A token bucket of bytes refilled at rate bytes per second.
+
+    consume blocks until the bytes can be sent. A rate of None is
+    unlimited. The rate may be changed at any time.
+    """
+
+    def __init__(self, rate=None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self.tokens = 0.0
+        self._last = time.monotonic()
+        self.set_rate(rate)
+
+    def _burst(self):
+        return self.rate * BURST_SECONDS
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self._burst(),
+                              self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(time.monotonic())
+            if rate and not self.rate:
+                self.tokens = rate * BURST_SECONDS
+            self.rate = rate
+            if rate:
+                self.tokens = min(self.tokens, self._burst())
+
+    def consume(self, size):
+        # Tokens may go negative, so concurrent consumers queue up behind
+        # each other, each sleeping until its share has been refilled.
+        with self._lock:
+            if not self.rate:
+                return
+            self._refill(time.monotonic())
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class BandwidthLimits:
+    """A global bandwidth limit and per-device limits."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.global_bucket = TokenBucket()
+        self.device_rate = None
+        self.device_rates = {}
+        self._buckets = {}
+        self._file = None
+        self._file_mtime = None
+        self._next_check = 0.0
+
+    def configure(self, global_rate=None, device_rate=None, devices=None):
+        """Replace the limits.
+
+        device_rate applies to each device not in devices, a dict of rates
+        by device IP.
+        """
+        with self._lock:
+            self.device_rate = device_rate
+            self.device_rates = dict(devices or {})
+            self.global_bucket.set_rate(global_rate)
+            for ip, bucket in self._buckets.items():
+                bucket.set_rate(self.device_rates.get(ip, device_rate))
+        LOGGER.info('Bandwidth limits: global [%s], per device [%s], %s',
+                    global_rate, device_rate, self.device_rates)
+
+    def watch_file(self, filename):
+        """Load limits from filename, and again whenever it changes.
+
+        A filename of None stops watching.
+        """
+        self._file = filename
+        self._file_mtime = None
+        self._next_check = 0.0
+        self.check_file()
+
+    def check_file(self):
+        if not self._file or time.monotonic() < self._next_check:
+            return
+        self._next_check = time.monotonic() + FILE_CHECK_INTERVAL
+        try:
+            mtime = os.path.getmtime(self._file)
+            if mtime == self._file_mtime:
+                return
+            self._file_mtime = mtime
+            with open(self._file) as f:
+                limits = json.load(f)
+            self.configure(
+                parse_rate(limits.get('global')),
+                parse_rate(limits.get('device')),
+                {ip: parse_rate(rate)
+                 for ip, rate in limits.get('devices', {}).items()})
+        except (OSError, ValueError, AttributeError) as e:
+            LOGGER.warning('Unable to load bandwidth limits from [%s]: %s',
+                           self._file, e)
+
+    def _bucket(self, ip):
+        with self._lock:
+            if ip not in self._buckets:
+                self._buckets[ip] = TokenBucket(
+                    self.device_rates.get(ip, self.device_rate))
+            return self._buckets[ip]
+
+    def limited(self, ip):
+        """Return True if downloads from a device are limited."""
+        self.check_file()
+        return bool(self.global_bucket.rate or self._bucket(ip).rate)
+
+    def consume(self, ip, size):
+        """Wait until size bytes from a device are within the limits."""
+        self.global_bucket.consume(size)
+        self._bucket(ip).consume(size)
+
+
+LIMITS = BandwidthLimits()
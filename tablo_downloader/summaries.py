@@ -0,0 +1,94 @@
+"""Summaries, titles and filenames of Tablo recordings.
+
+These are computed from a recording's metadata when it is stored in the
+recordings database, so listing and download planning can read them
+without recomputing anything.
+"""
+
+
+def recording_summary(metadata):
+    dtls = metadata['details']
+    res = {
+        'category': metadata['category'],
+        'episode_date': None,
+        'episode_description': None,
+        'episode_number': None,
+        'episode_season': None,
+        'episode_title': None,
+        'event_description': None,
+        'event_season': None,
+        'event_title': None,
+        'movie_year': None,
+        'path': dtls.get('path'),
+        'show_time': dtls.get('airing_details', {}).get('datetime'),
+        'show_title': dtls.get('airing_details', {}).get('show_title'),
+    }
+    if metadata['category'] == 'movies':
+        res['movie_year'] = dtls.get('movie_airing', {}).get('release_year')
+    elif metadata['category'] == 'series':
+        res['episode_title'] = dtls.get('episode', {}).get('title')
+        res['episode_date'] = dtls.get('episode', {}).get('orig_air_date')
+        res['episode_description'] = dtls.get('episode', {}).get('description')
+        res['episode_season'] = dtls.get('episode', {}).get('season_number')
+        res['episode_number'] = dtls.get('episode', {}).get('number')
+    elif metadata['category'] == 'sports':
+        res['event_title'] = dtls.get('event', {}).get('title')
+        res['event_description'] = dtls.get('event', {}).get('description')
+        res['event_season'] = dtls.get('event', {}).get('season')
+    return res
+
+
+def recording_duration(metadata):
+    """Return the length of a recording in seconds, or None if unknown."""
+    dtls = metadata.get('details', {})
+    for section in ('video_details', 'airing_details'):
+        duration = dtls.get(section, {}).get('duration')
+        if isinstance(duration, (int, float)) and duration > 0:
+            return duration
+    return None
+
+
+def title_and_filename(summary):
+    show_title = summary['show_title']
+    if not show_title:
+        show_title = 'UNKNOWN'  # TODO: Give better default?
+    filename, title = show_title, show_title
+    if summary['category'] == 'movies':
+        year = summary['movie_year']
+        if isinstance(year, int):
+            filename += f' ({year})'
+    elif summary['category'] == 'series':
+        episode_title = summary['episode_title']
+        if episode_title:
+            filename += f'_-_{episode_title}'
+            title += f' - {episode_title}'
+
+        season = summary['episode_season']
+        if isinstance(season, int) and season > 0:
+            season = '%02d' % int(season)
+        number = summary['episode_number']
+        if isinstance(number, int) and number > 0:
+            number = '%02d' % int(number)
+            if not season:
+                season = '00'
+        if season:
+            filename += f'_-_S{season}E{number}'
+            if not episode_title:
+                title += f' - S{season}E{number}'
+
+        if not episode_title and not season and summary['show_time']:
+            filename += ' %s' % summary['show_time'][:10]
+
+    elif summary['category'] == 'sports':
+        event_title = summary['event_title']
+        if event_title:
+            filename += f'_-_{event_title}'
+            title += f' - {event_title}'
+        show_time = summary['show_time']
+        if show_time:
+            filename += f'_-_{show_time[:10]}'
+            title += f' - {show_time[:10]}'
+    else:
+        return None, None
+    filename = ('%s.mp4' % filename).replace(' ', '_')
+    return title, filename
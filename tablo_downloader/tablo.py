@@ -1,15 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import datetime
 import json
 import logging
 import os
-import pprint
-import subprocess
 import sys
-import tempfile
+import threading
+import time
 
 from tablo_downloader import apis
+from tablo_downloader import database
+from tablo_downloader import discovery
+from tablo_downloader import filelock
+from tablo_downloader import hls
+from tablo_downloader import metrics
+from tablo_downloader import ratelimit
+from tablo_downloader import summaries
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
@@ -20,7 +31,51 @@ HANDLER.setFormatter(
 LOGGER.addHandler(HANDLER)
 
 SETTINGS_FILE = '.tablodlrc'
-DATABASE_FILE = '.tablodldb'
+
+# Limits on concurrent recording detail fetches, across all devices and per
+# device, so a Tablo isn't overwhelmed during an initial --updatedb.
+DEFAULT_WORKERS = 8
+DEFAULT_WORKERS_PER_DEVICE = 4
+DEFAULT_FETCH_RETRIES = 2
+FETCH_RETRY_DELAY = 1.0
+# Fetched recording metadata is written to the DB once this many
+# recordings or seconds have accumulated, so an interrupted sync keeps
+# most of its work.
+CHECKPOINT_SIZE = 500
+CHECKPOINT_INTERVAL = 30.0
+
+DEFAULT_MAX_DOWNLOADS = 4
+
+# --watch polls devices every DEFAULT_ACTIVE_POLL_INTERVAL seconds while
+# anything is recording, backing off to DEFAULT_POLL_INTERVAL when idle.
+DEFAULT_POLL_INTERVAL = 300
+DEFAULT_ACTIVE_POLL_INTERVAL = 60
+WATCH_DOWNLOAD_ATTEMPTS = 3
+WATCH_JOURNAL_CONSUMER = 'watch'
+
+# Recordings queued for deletion are deleted DEFAULT_DELETE_WORKERS at a
+# time. A failed delete is retried after DELETE_RETRY_DELAY seconds,
+# doubling after each failure, up to DELETE_ATTEMPTS attempts.
+DEFAULT_DELETE_WORKERS = 4
+DELETE_ATTEMPTS = 5
+DELETE_RETRY_DELAY = 1.0
+DELETE_POLL_INTERVAL = 1.0
+
+# Commands that talk to Tablo devices. Without any of them, main skips
+# setting up the API client, bandwidth limits and metrics, so commands that
+# only read the recordings DB, such as --dump, start quickly.
+NETWORK_COMMANDS = ('local_ips', 'updatedb', 'recording_details',
+                    'download_recording', 'download_all', 'watch',
+                    'purge_downloaded')
+
+# Output formats for --dump, and the fields of each recording written in
+# the jsonl and csv formats.
+DUMP_FORMATS = ('table', 'jsonl', 'csv')
+DUMP_FIELDS = ('device', 'recording_id', 'category', 'show_title',
+               'show_time', 'season', 'episode', 'episode_title', 'title',
+               'filename', 'description', 'state', 'downloaded_at',
+               'download_path')
+DOWNLOAD_STATES = {'downloaded': True, 'not_downloaded': False}
 
 
 def load_settings():
@@ -34,125 +89,154 @@ def load_settings():
     return settings
 
 
-def load_recordings_db():
-    recordings = {}
-    rfile = os.path.join(os.path.expanduser("~"), DATABASE_FILE)
-    if os.path.exists(rfile) and os.path.getsize(rfile) > 0:
-        with open(rfile) as f:
-            recordings = json.load(f)
-    return recordings
+def open_recordings_db():
+    """Open the recordings DB, migrating a legacy JSON DB if one exists."""
+    return database.RecordingsDB(
+        database.default_path(),
+        legacy_path=database.default_path(database.LEGACY_DATABASE_FILE))
 
 
-def save_recordings_db(recordings):
-    recordings_file = os.path.join(os.path.expanduser("~"), DATABASE_FILE)
-    with open(recordings_file, 'w') as f:
-        f.write(json.dumps(recordings))
+def local_ips(refresh=False, timeout=discovery.DEFAULT_TIMEOUT):
+    """Get a list of IPs of local Tablo servers.
 
-
-def local_ips():
-    """Get a list of IPs of local Tablo servers."""
-    info = apis.local_server_info()
-    LOGGER.debug('Local server info [%s]', info)
-    ips = {cpe['private_ip'] for cpe in info['cpes']}
+    IPs discovered within the last discovery.CACHE_TTL seconds are reused
+    unless refresh is set.
+    """
+    ips = discovery.local_ips(refresh=refresh, timeout=timeout)
+    LOGGER.debug('Local Tablo IPs [%s]', ' '.join(sorted(ips)))
     return ips
 
 
-def recording_metadata(ip, recording):
-    """Return metadata for a recording."""
+def recording_metadata(ip, recording, details=None):
+    """Return metadata for a recording.
+
+    If the recording details were already fetched, e.g. with
+    apis.batch_details, pass them in details to avoid another API call.
+    """
     res = {}
     res['category'] = recording.split('/')[2]
-    res['details'] = apis.recording_details(ip, recording)
+    if details is None:
+        details = apis.recording_details(ip, recording)
+    res['details'] = details
     return res
 
 
-def recording_summary(metadata):
-    dtls = metadata['details']
-    res = {
-        'category': metadata['category'],
-        'episode_date': None,
-        'episode_description': None,
-        'episode_number': None,
-        'episode_season': None,
-        'episode_title': None,
-        'event_description': None,
-        'event_season': None,
-        'event_title': None,
-        'movie_year': None,
-        'path': dtls.get('path'),
-        'show_time': dtls.get('airing_details', {}).get('datetime'),
-        'show_title': dtls.get('airing_details', {}).get('show_title'),
-    }
-    if metadata['category'] == 'movies':
-        res['movie_year'] = dtls.get('movie_airing', {}).get('release_year')
-    elif metadata['category'] == 'series':
-        res['episode_title'] = dtls.get('episode', {}).get('title')
-        res['episode_date'] = dtls.get('episode', {}).get('orig_air_date')
-        res['episode_description'] = dtls.get('episode', {}).get('description')
-        res['episode_season'] = dtls.get('episode', {}).get('season_number')
-        res['episode_number'] = dtls.get('episode', {}).get('number')
-    elif metadata['category'] == 'sports':
-        res['event_title'] = dtls.get('event', {}).get('title')
-        res['event_description'] = dtls.get('event', {}).get('description')
-        res['event_season'] = dtls.get('event', {}).get('season')
+def fetch_recordings_chunk(ip, recordings, global_limit,
+                           retries=DEFAULT_FETCH_RETRIES):
+    """Return metadata for a chunk of recordings, retrying failed fetches.
+
+    Uses a single call to the Tablo /batch endpoint per attempt. If every
+    attempt fails, each recording is fetched on its own instead, and a
+    RuntimeError with the last API error is raised if none of those
+    succeed either. Recordings the device returns no details for are
+    missing from the result.
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(FETCH_RETRY_DELAY * attempt)
+        with global_limit:
+            details = apis.batch_details(
+                ip, recordings, chunk_size=max(1, len(recordings)))
+        if 'error' not in details:
+            return {r: recording_metadata(ip, r, details[r])
+                    for r in recordings if details.get(r)}
+        LOGGER.debug('Attempt [%d] to get metadata for [%d] recordings on '
+                     '[%s] failed: %s', attempt + 1, len(recordings), ip,
+                     details)
+    LOGGER.debug('Getting metadata for [%d] recordings on [%s] one at a '
+                 'time', len(recordings), ip)
+    res = {}
+    for recording in recordings:
+        with global_limit:
+            recording_details = apis.recording_details(ip, recording)
+        if 'error' in recording_details:
+            LOGGER.debug('Unable to get metadata for [%s] on [%s]: %s',
+                         recording, ip, recording_details)
+        else:
+            res[recording] = recording_metadata(ip, recording,
+                                                recording_details)
+    if not res:
+        raise RuntimeError(details)
     return res
 
 
-def title_and_filename(summary):
-    show_title = summary['show_title']
-    if not show_title:
-        show_title = 'UNKNOWN'  # TODO: Give better default?
-    filename, title = show_title, show_title
-    if summary['category'] == 'movies':
-        year = summary['movie_year']
-        if isinstance(year, int):
-            filename += f' ({year})'
-    elif summary['category'] == 'series':
-        episode_title = summary['episode_title']
-        if episode_title:
-            filename += f'_-_{episode_title}'
-            title += f' - {episode_title}'
-
-        season = summary['episode_season']
-        if isinstance(season, int) and season > 0:
-            season = '%02d' % int(season)
-        number = summary['episode_number']
-        if isinstance(number, int) and number > 0:
-            number = '%02d' % int(number)
-            if not season:
-                season = '00'
-        if season:
-            filename += f'_-_S{season}E{number}'
-            if not episode_title:
-                title += f' - S{season}E{number}'
-
-        if not episode_title and not season:
-            filename += ' %s' % summary['show_time'][:10]
-
-    elif summary['category'] == 'sports':
-        event_title = summary['event_title']
-        if event_title:
-            filename += f'_-_{event_title}'
-            title += f' - {event_title}'
-        show_time = summary['show_time']
-        if show_time:
-            filename += f'_-_{show_time[:10]}'
-            title += f' - {show_time[:10]}'
-    else:
-        return None, None
-    filename = ('%s.mp4' % filename).replace(' ', '_')
-    return title, filename
+def fetch_recordings_metadata(ip, recordings, global_limit,
+                              workers_per_device=DEFAULT_WORKERS_PER_DEVICE,
+                              retries=DEFAULT_FETCH_RETRIES,
+                              batch_size=apis.BATCH_CHUNK_SIZE,
+                              on_chunk=None, stopping=None):
+    """Fetch metadata for recordings on a Tablo device concurrently.
+
+    Recordings are fetched in batches of batch_size. At most
+    workers_per_device batches are fetched from the device at a time, and
+    each fetch also holds global_limit, a semaphore shared by all devices.
+    Returns a tuple (metadata, failures) of dicts keyed by recording ID, both
+    ordered as in recordings. on_chunk(metadata), if given, is called with
+    the metadata of each batch as it arrives. Once stopping, a
+    threading.Event, is set, batches not yet started are skipped and count
+    as failures.
+    """
+    batch_size = max(1, batch_size)
+    chunks = [recordings[i:i + batch_size]
+              for i in range(0, len(recordings), batch_size)]
+    results = {}
+
+    def fetch(chunk):
+        if stopping is not None and stopping.is_set():
+            return None
+        return fetch_recordings_chunk(ip, chunk, global_limit, retries)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, workers_per_device)) as pool:
+        futures = {pool.submit(fetch, chunk): chunk for chunk in chunks}
+        for future in concurrent.futures.as_completed(futures):
+            chunk = futures[future]
+            try:
+                metadata = future.result()
+            except Exception as e:
+                LOGGER.error('Unable to get metadata for [%d] recordings on '
+                             'device [%s]: %s', len(chunk), ip, e)
+                metadata = {}
+            if metadata is None:  # Skipped once stopping was set.
+                results.update((r, RuntimeError('Sync stopped'))
+                               for r in chunk)
+                continue
+            if on_chunk and metadata:
+                on_chunk(metadata)
+            for recording in chunk:
+                if recording in metadata:
+                    results[recording] = metadata[recording]
+                else:
+                    results[recording] = RuntimeError(
+                        'No details for recording [%s]' % recording)
+            LOGGER.info('Got metadata for [%d] of [%d] new recordings on '
+                        'device [%s]', len(results), len(recordings), ip)
+    metadata = {r: results[r] for r in recordings
+                if not isinstance(results[r], Exception)}
+    failures = {r: results[r] for r in recordings
+                if isinstance(results[r], Exception)}
+    return metadata, failures
 
 
 def download_recording(args):
+    if not args.recordings_directory:
+        LOGGER.error('--download_recording requires --recordings_directory')
+        return
     ip = args.tablo_ips.split(',')[0]
     recording_id = args.recording_id
 
-    recordings = load_recordings_db()
-    if not recordings:
-        LOGGER.error('No recordings database. Run with --updatedb to create.')
-        return
+    with open_recordings_db() as db:
+        if not db.count():
+            LOGGER.error(
+                'No recordings database. Run with --updatedb to create.')
+            return
+        with delete_worker(db, args):
+            download_from_db(db, ip, recording_id, args)
 
-    recording = recordings.get(ip, {}).get(recording_id)
+
+def download_from_db(db, ip, recording_id, args):
+    """Download a recording, returning the local filename on success."""
+    recording = db.get_summary(ip, recording_id)
     if not recording:
         LOGGER.error(
                 'Recording [%s] on device [%s] not found', recording_id, ip)
@@ -163,7 +247,7 @@ def download_recording(args):
         LOGGER.error('Recording [%s] on device [%s] failed', recording_id, ip)
         return
 
-    title, filename = title_and_filename(recording_summary(recording))
+    title, filename = recording['title'], recording['filename']
     if not title:
         LOGGER.error('Unable to generate title for recording [%s] on '
                      'device [%s]', ip, recording_id)
@@ -171,84 +255,756 @@ def download_recording(args):
 
     mp4_filename = os.path.join(args.recordings_directory, filename)
     if args.dry_run:
-        if os.path.exists(mp4_filename):
-            if args.overwrite:
-                LOGGER.info('Dry run - Would overwrite existing download [%s]',
-                            mp4_filename)
-            else:
-                LOGGER.info('Dry run - Would skip existing download [%s]',
-                            mp4_filename)
-        if args.delete_originals_after_downloading:
-            LOGGER.info('Dry run - Would delete Tablo recording after '
-                        'successful download of [%s]', mp4_filename)
-        return
+        return dry_run_download(mp4_filename, args)
+    if not os.path.isdir(args.recordings_directory):
+        LOGGER.error('Recordings directory [%s] does not exist',
+                     args.recordings_directory)
+        return None
+
+    # Another process downloading the same recording would clobber the
+    # destination, so each download holds a lock next to it.
+    lock = filelock.FileLock(download_lock_filename(mp4_filename),
+                             remove=True)
+    if not lock.acquire(blocking=False):
+        LOGGER.info('[%s] is being downloaded by another process',
+                    mp4_filename)
+        return None
+    try:
+        return _download_from_db(db, ip, recording_id, args, playlist,
+                                 recording, mp4_filename)
+    finally:
+        lock.release()
+
+
+def download_lock_filename(mp4_filename):
+    directory, name = os.path.split(mp4_filename)
+    return os.path.join(directory, '.%s.lock' % name)
+
+
+def dry_run_download(mp4_filename, args):
+    if args.overwrite and hls.has_partial(mp4_filename):
+        LOGGER.info('Dry run - Would discard partial download [%s]',
+                    mp4_filename)
+    elif hls.has_partial(mp4_filename):
+        LOGGER.info('Dry run - Would resume partial download [%s]',
+                    mp4_filename)
+    elif os.path.exists(mp4_filename):
+        if args.overwrite:
+            LOGGER.info('Dry run - Would overwrite existing download [%s]',
+                        mp4_filename)
+        else:
+            LOGGER.info('Dry run - Would skip existing download [%s]',
+                        mp4_filename)
+    if args.delete_originals_after_downloading:
+        LOGGER.info('Dry run - Would delete Tablo recording after '
+                    'successful download of [%s]', mp4_filename)
 
+
+def _download_from_db(db, ip, recording_id, args, playlist, recording,
+                      mp4_filename):
+    if args.overwrite:
+        hls.clear_partial(mp4_filename)
     if os.path.exists(mp4_filename):
         if args.overwrite:
             os.remove(mp4_filename)
+        elif hls.has_partial(mp4_filename):
+            LOGGER.info('Resuming partial download [%s]', mp4_filename)
         else:
             LOGGER.info('Cannot create destination [%s] exists.',
                         mp4_filename)
             return
 
-    m3u_data = apis.playlist_m3u(playlist)
-    if not isinstance(m3u_data, str):  # Some error occurred.
-        LOGGER.error(m3u_data)
-        return
+    metadata = db.get(ip, recording_id)
+    verification = hls.download(
+        playlist['playlist_url'], mp4_filename, recording['title'],
+        workers=args.segment_workers, buffer_size=args.segment_buffer,
+        duration=summaries.recording_duration(metadata),
+        on_event=progress_reporter(args, ip, recording_id),
+        progress_interval=args.progress_interval,
+        stall_timeout=args.stall_timeout, quality=args.quality,
+        recording_id=recording_id)
+    if not verification:
+        LOGGER.info('Failed to download [%s]', mp4_filename)
+        if os.path.exists(mp4_filename):
+            os.remove(mp4_filename)
+        return None
+
+    if not verify_download(mp4_filename, verification):
+        # Left undownloaded, so it is retried by later runs.
+        LOGGER.warning('Unable to verify [%s], removing it: %s',
+                       mp4_filename, '; '.join(verification['problems']) or
+                       'empty file')
+        db.set_verification(ip, recording_id, verification)
+        if os.path.exists(mp4_filename):
+            os.remove(mp4_filename)
+        return None
+
+    LOGGER.info('Successfully Downloaded [%s]', mp4_filename)
+    db.mark_downloaded(ip, recording_id, mp4_filename,
+                       datetime.datetime.now().isoformat(), verification)
+    if args.delete_originals_after_downloading:
+        if recording['state'] in database.IN_PROGRESS_STATES:
+            # The download is missing whatever is still to be recorded.
+            LOGGER.warning('Not deleting Tablo recording [%s] on device '
+                           '[%s], it is still being recorded',
+                           recording_id, ip)
+        else:
+            LOGGER.info('Queueing Tablo recording [%s] on device [%s] for '
+                        'deletion', recording_id, ip)
+            db.queue_deletes(ip, [recording_id])
+    return mp4_filename
+
+
+def verify_download(mp4_filename, verification):
+    """Return True if a download was verified as it was written, so its
+    original can be deleted."""
+    return (verification['verified'] and os.path.exists(mp4_filename) and
+            os.path.getsize(mp4_filename) > 0)
+
 
-    m3u_file = tempfile.NamedTemporaryFile(mode='w', delete=False)
-    m3u_filename = m3u_file.name
-    m3u_file.write(m3u_data)
-    m3u_file.close()
-
-    cmd = [
-        'ffmpeg', '-hide_banner', '-loglevel', 'warning',
-        '-protocol_whitelist', 'file,http,https,tcp,tls,crypto', '-i',
-        m3u_filename, '-c', 'copy', '-metadata', f'title={title}',
-        mp4_filename
-    ]
-    LOGGER.debug('Running [%s]', ' '.join(cmd))
-
-    status = subprocess.run(cmd)
-    if status.returncode == 0:
-        LOGGER.info('Successfully Downloaded [%s]', mp4_filename)
-        if args.delete_originals_after_downloading:
-            LOGGER.info('Deleting Tablo recording [%s] on device [%s]',
+class DeleteWorker:
+    """Deletes the recordings in a DB's delete queue from their devices.
+
+    Deletes run in a background thread, up to workers at a time, so they
+    never wait behind downloads. The queue is kept in the DB, so deletes
+    still pending when tldl exits are resumed by the next run. close waits
+    until every queued delete has succeeded or used all its attempts.
+    """
+
+    def __init__(self, db, workers=DEFAULT_DELETE_WORKERS,
+                 poll_interval=DELETE_POLL_INTERVAL):
+        self.db = db
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self.deleted = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._closing.set()
+        self._thread.join()
+        LOGGER.info('Deleted [%d] Tablo recordings, [%d] failed',
+                    self.deleted, self.failed)
+
+    def _run(self):
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as pool:
+            while True:
+                due = self.db.queued_deletes(max_attempts=DELETE_ATTEMPTS,
+                                             due=time.time())
+                if due:
+                    list(pool.map(self.delete, due))
+                    continue
+                closing = self._closing.is_set()
+                pending = self.db.queued_deletes(max_attempts=DELETE_ATTEMPTS)
+                if closing and not pending:
+                    return
+                wait = min([self.poll_interval] +
+                           [e['next_attempt'] - time.time() for e in pending])
+                if closing:
+                    time.sleep(max(0, wait))
+                else:
+                    self._closing.wait(max(0, wait))
+
+    def delete(self, entry):
+        ip, recording_id = entry['device'], entry['recording_id']
+        res = apis.delete_recording(ip, recording_id)
+        # A recording that is already gone needs no further attempts.
+        if not isinstance(res, dict) or res.get('status_code') == 404:
+            LOGGER.info('Deleted Tablo recording [%s] on device [%s]',
                         recording_id, ip)
-            apis.delete_recording(ip, recording_id)
+            self.db.delete_finished(ip, recording_id)
+            with self._lock:
+                self.deleted += 1
+            return
+        attempts = entry['attempts'] + 1
+        error = str(res.get('exception') or res.get('status_code'))
+        self.db.delete_failed(
+            ip, recording_id, error,
+            time.time() + DELETE_RETRY_DELAY * 2 ** (attempts - 1))
+        if attempts < DELETE_ATTEMPTS:
+            LOGGER.warning('Unable to delete Tablo recording [%s] on device '
+                           '[%s], will retry: %s', recording_id, ip, error)
+        else:
+            with self._lock:
+                self.failed += 1
+            LOGGER.error('Giving up on deleting Tablo recording [%s] on '
+                         'device [%s] after [%d] attempts: %s', recording_id,
+                         ip, attempts, error)
+
+
+def delete_worker(db, args):
+    """Return a DeleteWorker for the DB if downloaded originals are to be
+    deleted, else a null context."""
+    if args.delete_originals_after_downloading and not args.dry_run:
+        return DeleteWorker(db, args.delete_workers)
+    return contextlib.nullcontext()
+
+
+def purge_downloaded(args):
+    """Queue every verified download matching the command line filters for
+    deletion from its device, then delete everything queued."""
+    with open_recordings_db() as db:
+        queued, unverified = 0, 0
+        for ip, recording_id, path, verification in db.downloads(
+                category=args.category, show_title=args.show_title):
+            if not verification or not verify_download(path, verification):
+                unverified += 1
+                LOGGER.debug('Not deleting Tablo recording [%s] on device '
+                             '[%s], [%s] is not verified', recording_id, ip,
+                             path)
+                continue
+            if args.dry_run:
+                LOGGER.info('Dry run - Would delete Tablo recording [%s] on '
+                            'device [%s], downloaded to [%s]', recording_id,
+                            ip, path)
+            else:
+                db.queue_deletes(ip, [recording_id])
+            queued += 1
+        if unverified:
+            LOGGER.info('Keeping [%d] Tablo recordings whose downloads are '
+                        'not verified', unverified)
+        pending = db.queued_deletes(max_attempts=None if args.dry_run
+                                    else DELETE_ATTEMPTS)
+        if args.dry_run:
+            LOGGER.info('Dry run - Would delete [%d] downloaded recordings '
+                        'and [%d] already queued', queued, len(pending))
+            return
+        LOGGER.info('Deleting [%d] queued Tablo recordings', len(pending))
+        with DeleteWorker(db, args.delete_workers):
+            pass
+
+
+_PROGRESS_EVENTS_LOCK = threading.Lock()
+
+
+def progress_reporter(args, ip, recording_id):
+    """Return an hls.download on_event callback for a recording.
+
+    Each event is logged and, with --progress_events, appended to that file
+    as a JSON line.
+    """
+    def on_event(event):
+        if event['event'] == 'progress':
+            LOGGER.info(hls.format_progress(event))
+        if args.progress_events:
+            event = dict(event, ip=ip, recording_id=recording_id,
+                         time=datetime.datetime.now().isoformat())
+            with _PROGRESS_EVENTS_LOCK:
+                with open(args.progress_events, 'a') as f:
+                    f.write(json.dumps(event) + '\n')
+
+    return on_event
+
+
+def device_download_limit(ip, override=None):
+    """Return how many recordings can be downloaded from a device at once.
+
+    This is the device's tuner count, each of which can stream one
+    recording, unless override is given.
+    """
+    if override:
+        return override
+    info = apis.server_information(ip)
+    tuners = None
+    if isinstance(info, dict) and not info.get('error'):
+        tuners = info.get('model', {}).get('tuners')
+    if not isinstance(tuners, int) or tuners < 1:
+        LOGGER.warning('Unable to get tuner count for device [%s], '
+                       'downloading one recording at a time', ip)
+        return 1
+    return tuners
+
+
+def plan_downloads(db, args):
+    """Return a list of (ip, recording_id) jobs for recordings to download.
+
+    Recordings still being recorded are skipped, as are those already
+    downloaded unless --overwrite is given.
+    """
+    if args.tablo_ips:
+        ips = [x for x in args.tablo_ips.split(',') if x]
     else:
-        LOGGER.info('Failed to download [%s]', mp4_filename)
-    os.remove(m3u_filename)
+        ips = db.devices()
+    downloaded = None if args.overwrite else False
+    jobs = []
+    for ip in ips:
+        jobs.extend(db.recording_ids_matching(
+            device=ip, category=args.category, show_title=args.show_title,
+            downloaded=downloaded, in_progress=False))
+    return jobs
+
+
+class DownloadQueue:
+    """Runs download(ip, recording_id) for queued jobs with bounded
+    concurrency.
+
+    Jobs are started in the order queued, round robin across devices, with
+    at most device_limit(ip) downloads running per device and max_downloads
+    overall. download returns a local filename on success, else None. A job
+    already queued or running is not queued again. on_result(result), if
+    given, is called with each result dict as its download finishes.
+    Closing the queue drops jobs not yet started and waits for the rest.
+    """
+
+    def __init__(self, download, device_limit, max_downloads,
+                 on_result=None):
+        self.download = download
+        self.device_limit = device_limit
+        self.max_downloads = max(1, max_downloads)
+        self.on_result = on_result
+        self.results = {}
+        self._pending = collections.OrderedDict()
+        self._jobs = set()
+        self._running = collections.Counter()
+        self._limits = {}
+        self._closed = False
+        self._lock = threading.Condition()
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_downloads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def put(self, ip, recording_id):
+        """Queue a job, returning False if it is already queued or running,
+        or the queue is closed."""
+        job = (ip, recording_id)
+        # Resolved before taking the lock, since device_limit may make an
+        # API call.
+        limit = self._limits.get(ip) or self.device_limit(ip)
+        with self._lock:
+            if self._closed or job in self._jobs:
+                return False
+            self._limits.setdefault(ip, limit)
+            self._jobs.add(job)
+            self._pending.setdefault(ip, collections.deque()).append(job)
+            self._start_jobs()
+        return True
+
+    def pending(self):
+        """Return the number of jobs queued or running."""
+        with self._lock:
+            return len(self._jobs)
+
+    def join(self):
+        """Wait until every queued job has finished."""
+        with self._lock:
+            while self._jobs:
+                self._lock.wait()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            dropped = [job for jobs in self._pending.values() for job in jobs]
+            self._pending.clear()
+            self._jobs.difference_update(dropped)
+            running = sum(self._running.values())
+            self._lock.notify_all()
+        if dropped:
+            LOGGER.info('Dropped [%d] queued downloads', len(dropped))
+        if running:
+            LOGGER.info('Waiting for [%d] downloads to finish', running)
+        self._pool.shutdown(wait=True)
+
+    def _start_jobs(self):
+        if self._closed:
+            return
+        started = True
+        while started and sum(self._running.values()) < self.max_downloads:
+            started = False
+            for ip in list(self._pending):
+                if sum(self._running.values()) >= self.max_downloads:
+                    break
+                if self._running[ip] >= self._limits[ip]:
+                    continue
+                job = self._pending[ip].popleft()
+                if not self._pending[ip]:
+                    del self._pending[ip]
+                else:  # Round robin: move this device to the back.
+                    self._pending.move_to_end(ip)
+                self._running[ip] += 1
+                self._pool.submit(self._run, *job)
+                started = True
+
+    def _run(self, ip, recording_id):
+        start = time.monotonic()
+        try:
+            filename = self.download(ip, recording_id)
+        except Exception:
+            LOGGER.exception('Download of [%s] on device [%s] failed',
+                             recording_id, ip)
+            filename = None
+        size = 0
+        if filename and os.path.exists(filename):
+            size = os.path.getsize(filename)
+        result = {'ip': ip, 'recording_id': recording_id,
+                  'filename': filename, 'bytes': size,
+                  'seconds': time.monotonic() - start}
+        if self.on_result:
+            self.on_result(result)
+        with self._lock:
+            self.results[(ip, recording_id)] = result
+            self._running[ip] -= 1
+            self._jobs.discard((ip, recording_id))
+            self._start_jobs()
+            self._lock.notify_all()
+
+
+def run_download_jobs(jobs, download, device_limits, max_downloads):
+    """Run download(ip, recording_id) for each job with bounded concurrency.
+
+    Jobs are started in order, round robin across devices, with at most
+    device_limits[ip] downloads running per device and max_downloads
+    overall. download returns a local filename on success, else None.
+    Returns a list of result dicts in job order.
+    """
+    with DownloadQueue(download, lambda ip: device_limits.get(ip, 1),
+                       max_downloads) as queue:
+        for ip, recording_id in jobs:
+            queue.put(ip, recording_id)
+        queue.join()
+    return [queue.results[job] for job in jobs]
+
+
+def log_download_summary(results, seconds):
+    succeeded = [r for r in results if r['filename']]
+    total_bytes = sum(r['bytes'] for r in succeeded)
+    LOGGER.info('Downloaded [%d] of [%d] recordings, %.1f MB in %.1fs '
+                '(%.2f MB/s)', len(succeeded), len(results), total_bytes / 1e6,
+                seconds, total_bytes / 1e6 / seconds if seconds else 0)
+    for ip in sorted({r['ip'] for r in results}):
+        device = [r for r in succeeded if r['ip'] == ip]
+        device_bytes = sum(r['bytes'] for r in device)
+        device_seconds = sum(r['seconds'] for r in device)
+        LOGGER.info('Device [%s]: [%d] recordings, %.1f MB, %.2f MB/s per '
+                    'download', ip, len(device), device_bytes / 1e6,
+                    device_bytes / 1e6 / device_seconds
+                    if device_seconds else 0)
+
+
+def download_all_recordings(args):
+    """Download every recording in the DB matching the command line filters."""
+    if not args.recordings_directory:
+        LOGGER.error('--download_all requires --recordings_directory')
+        return []
+    with open_recordings_db() as db:
+        jobs = plan_downloads(db, args)
+        if not jobs:
+            LOGGER.info('No recordings to download')
+            return []
+        ips = sorted({ip for ip, _ in jobs})
+        device_limits = {
+            ip: device_download_limit(ip, args.downloads_per_device)
+            for ip in ips}
+        LOGGER.info('Downloading [%d] recordings from devices %s',
+                    len(jobs), device_limits)
+        start = time.monotonic()
+        with delete_worker(db, args):
+            results = run_download_jobs(
+                jobs, lambda ip, r: download_from_db(db, ip, r, args),
+                device_limits, args.max_downloads)
+        log_download_summary(results, time.monotonic() - start)
+        return results
+
+
+class Watcher:
+    """Keeps the recordings DB in sync and downloads new recordings.
+
+    Each poll syncs the devices, then queues finished recordings that were
+    added or updated since the last poll, found from the change journal,
+    for download. The open DB, device download limits and journal position
+    are kept between polls so each poll is cheap. Polls are
+    active_poll_interval seconds apart while anything is recording or
+    changing; otherwise the interval doubles after each poll, up to
+    poll_interval.
+    """
+
+    def __init__(self, db, args):
+        self.db = db
+        self.args = args
+        self.interval = args.active_poll_interval
+        self.stopped = threading.Event()
+        self.cursor = None
+        self.attempts = collections.Counter()
+        self.failed = set()
+        # Guards attempts and failed, which downloads update as they finish.
+        self._lock = threading.Lock()
+        self.queue = DownloadQueue(
+            lambda ip, r: download_from_db(db, ip, r, args),
+            lambda ip: device_download_limit(ip, args.downloads_per_device),
+            args.max_downloads, on_result=self.download_finished)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.queue.close()
+
+    def run(self, cycles=None):
+        """Poll until stop() is called or after cycles polls."""
+        while not self.stopped.is_set():
+            self.poll()
+            if cycles is not None:
+                cycles -= 1
+                if cycles <= 0:
+                    break
+            LOGGER.debug('Next poll in %ds', self.interval)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+    def download_finished(self, result):
+        job = (result['ip'], result['recording_id'])
+        if result['filename']:
+            LOGGER.info('Downloaded [%s]', result['filename'])
+            return
+        with self._lock:
+            self.attempts[job] += 1
+            attempts = self.attempts[job]
+            if attempts < WATCH_DOWNLOAD_ATTEMPTS:
+                self.failed.add(job)
+        if attempts >= WATCH_DOWNLOAD_ATTEMPTS:
+            LOGGER.error('Giving up on recording [%s] on device [%s] after '
+                         '[%d] attempts', job[1], job[0], attempts)
+
+    def downloadable(self, device):
+        """Return the set of recording IDs on a device to download."""
+        return {recording_id for _, recording_id in
+                self.db.recording_ids_matching(
+                    device=device, category=self.args.category,
+                    show_title=self.args.show_title, downloaded=False,
+                    in_progress=False)}
+
+    def poll(self):
+        device_summaries = update_recordings_db(self.db, self.args)
+        changed = collections.defaultdict(set)
+        if self.cursor is None:
+            # Queue everything not yet downloaded on the first poll.
+            for device in self.db.devices():
+                changed[device] = self.downloadable(device)
+            self.cursor = self.db.last_change()
+        else:
+            for change in self.db.changes(since=self.cursor):
+                self.cursor = change['seq']
+                if change['change'] != database.REMOVED:
+                    changed[change['device']].add(change['recording_id'])
+        self.db.set_journal_cursor(WATCH_JOURNAL_CONSUMER, self.cursor)
+        self.db.prune_changes()
+
+        with self._lock:
+            retries, self.failed = self.failed, set()
+        queued = 0
+        for device, recording_ids in sorted(changed.items()):
+            for recording_id in sorted(
+                    recording_ids & self.downloadable(device)):
+                queued += self.queue.put(device, recording_id)
+        for device, recording_id in sorted(retries):
+            queued += self.queue.put(device, recording_id)
+
+        in_progress = any(self.db.recording_ids(device, in_progress=True)
+                          for device in self.db.devices())
+        active = in_progress or any(
+            s.get('added') or s.get('updated') or s.get('removed')
+            for s in device_summaries)
+        if active:
+            self.interval = self.args.active_poll_interval
+        else:
+            self.interval = min(self.args.poll_interval,
+                                max(self.args.active_poll_interval,
+                                    self.interval * 2))
+        LOGGER.info('Queued [%d] downloads, [%d] pending; %s', queued,
+                    self.queue.pending(),
+                    'recordings in progress' if in_progress else 'idle')
+
+
+def watch(args):
+    """Sync and download recordings until interrupted."""
+    if not args.recordings_directory:
+        LOGGER.error('--watch requires --recordings_directory')
+        return
+    with open_recordings_db() as db, delete_worker(db, args), \
+            Watcher(db, args) as watcher:
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            LOGGER.info('Stopping')
 
 
 def create_or_update_recordings_database(args):
-    recordings_by_ip = load_recordings_db()
-    tablo_ips = {ip for ip in recordings_by_ip}
+    with open_recordings_db() as db:
+        try:
+            return update_recordings_db(db, args)
+        except KeyboardInterrupt:
+            LOGGER.info('Stopping')
+            return None
+
+
+def update_recordings_db(db, args):
+    """Sync the DB with every known Tablo, returning a summary per device.
+
+    Holds the DB's sync lock, waiting for any other process syncing it.
+    """
+    lock = db.sync_lock()
+    if not lock.acquire(blocking=False):
+        LOGGER.info('Waiting for another tldl process to finish syncing')
+        lock.acquire()
+    try:
+        return _update_recordings_db(db, args)
+    finally:
+        lock.release()
+
+
+def _update_recordings_db(db, args):
+    tablo_ips = set(db.devices())
     if args.tablo_ips:
         tablo_ips |= {x for x in args.tablo_ips.split(',') if x}
     elif tablo_ips:
-        tablo_ips |= local_ips()
+        tablo_ips |= local_ips(args.rediscover, args.discovery_timeout)
     LOGGER.info('Creating/Updating recording database for Tablo IPs [%s]',
                 ' '.join(tablo_ips))
 
-    for ip in tablo_ips:
-        LOGGER.info('Getting recordings for IP [%s]', ip)
-        if ip not in recordings_by_ip:
-            recordings_by_ip[ip] = {}
-        server_recordings = apis.server_recordings(ip)
-        # Remove any items no longer present on the Tablo device.
-        obsolete_db_recordings = {
-                r for r in recordings_by_ip[ip] if r not in server_recordings}
-        for recording in obsolete_db_recordings:
-            LOGGER.debug('Removing deleted recording [%s %s]', ip, recording)
-            del recordings_by_ip[ip][recording]
-        # Add new recordings.
-        for recording in server_recordings:
-            if recording not in recordings_by_ip[ip]:
-                LOGGER.info('Getting metadata for new recording [%s]', recording)
-                recordings_by_ip[ip][recording] = recording_metadata(
-                    ip, recording)
-    save_recordings_db(recordings_by_ip)
+    global_limit = threading.BoundedSemaphore(max(1, args.workers))
+    stopping = threading.Event()
+    device_summaries = []
+    pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, len(tablo_ips)))
+    futures = {
+        pool.submit(sync_device, ip, db, global_limit, args, stopping): ip
+        for ip in tablo_ips
+    }
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            ip = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                LOGGER.exception('Unexpected error syncing IP [%s]', ip)
+                summary = {'ip': ip, 'error': str(e)}
+            device_summaries.append(summary)
+    except KeyboardInterrupt:
+        # Devices being synced stop after the batches they are fetching
+        # and save them; nothing else is fetched.
+        LOGGER.info('Interrupted, saving recordings fetched so far')
+        stopping.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+        raise
+    pool.shutdown()
+    log_sync_summaries(device_summaries)
+    return device_summaries
+
+
+def sync_device(ip, db, global_limit, args, stopping=None):
+    """Sync the recordings database entries for one Tablo device.
+
+    Recordings are diffed as sets of IDs. Only new recordings and those
+    still in progress, or every recording with --full_sync, are fetched;
+    fetched recordings whose metadata changed are updated. Additions,
+    updates and removals are recorded in the DB's change journal.
+
+    If the device can't be listed its existing entries are kept. Returns a
+    summary dict with counts of added, updated, removed and failed
+    recordings and the time taken. Once stopping is set, only the
+    recordings already being fetched are saved.
+    """
+    start = time.monotonic()
+    summary = {'ip': ip, 'added': 0, 'updated': 0, 'removed': 0,
+               'failed': 0, 'error': None}
+    LOGGER.info('Getting recordings for IP [%s]', ip)
+    server_recordings = apis.server_recordings(ip)
+    if isinstance(server_recordings, dict):  # Some error occurred.
+        LOGGER.error('Unable to get recordings for IP [%s]: %s',
+                     ip, server_recordings)
+        summary['error'] = server_recordings.get('error')
+        summary['seconds'] = time.monotonic() - start
+        return summary
+
+    server_ids = set(server_recordings)
+    db_ids = db.recording_ids(ip)
+    # Remove any items no longer present on the Tablo device.
+    obsolete_db_recordings = db_ids - server_ids
+    for recording in sorted(obsolete_db_recordings):
+        LOGGER.debug('Removing deleted recording [%s %s]', ip, recording)
+    db.delete_many(ip, obsolete_db_recordings, change=database.REMOVED)
+    summary['removed'] = len(obsolete_db_recordings)
+
+    # Fetch new recordings and re-fetch ones that may have changed.
+    if args.full_sync:
+        stale_ids = db_ids & server_ids
+    else:
+        stale_ids = db.recording_ids(ip, in_progress=True) & server_ids
+    to_fetch = [r for r in server_recordings
+                if r not in db_ids or r in stale_ids]
+    LOGGER.info('Getting metadata for [%d] new and [%d] changing recordings '
+                'on IP [%s]', len(to_fetch) - len(stale_ids), len(stale_ids),
+                ip)
+    pending = {}
+    last_checkpoint = time.monotonic()
+
+    def checkpoint():
+        nonlocal last_checkpoint
+        added = {r: m for r, m in pending.items() if r not in db_ids}
+        updated = {r: m for r, m in pending.items()
+                   if r in db_ids and db.get(ip, r) != m}
+        db.put_many(ip, added, change=database.ADDED)
+        db.put_many(ip, updated, change=database.UPDATED)
+        summary['added'] += len(added)
+        summary['updated'] += len(updated)
+        pending.clear()
+        last_checkpoint = time.monotonic()
+
+    def on_chunk(metadata):
+        pending.update(metadata)
+        if (len(pending) >= CHECKPOINT_SIZE or
+                time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL):
+            LOGGER.debug('Saving [%d] recordings for IP [%s]', len(pending),
+                         ip)
+            checkpoint()
+
+    try:
+        _, failures = fetch_recordings_metadata(
+            ip, to_fetch, global_limit,
+            workers_per_device=args.workers_per_device,
+            retries=args.fetch_retries, batch_size=args.batch_size,
+            on_chunk=on_chunk, stopping=stopping)
+    finally:
+        checkpoint()
+    summary['failed'] = len(failures)
+    if failures:
+        LOGGER.warning('Failed to get metadata for [%d] recordings on IP '
+                       '[%s]; they will be retried on the next update',
+                       len(failures), ip)
+    summary['seconds'] = time.monotonic() - start
+    return summary
+
+
+def log_sync_summaries(device_summaries):
+    for summary in sorted(device_summaries, key=lambda k: k['ip']):
+        if summary['error']:
+            LOGGER.info('IP [%s] failed after %.1fs: %s', summary['ip'],
+                        summary.get('seconds', 0), summary['error'])
+        else:
+            LOGGER.info('IP [%s] synced in %.1fs: [%d] added, [%d] updated, '
+                        '[%d] removed, [%d] failed', summary['ip'],
+                        summary['seconds'], summary['added'],
+                        summary['updated'], summary['removed'],
+                        summary['failed'])
 
 
 def truncate_string(s, length):
@@ -258,26 +1014,84 @@ def truncate_string(s, length):
     return s[:sp] + ' ...'
 
 
-def dump_recordings(recordings):
-    summaries = {ip: {} for ip in recordings}
-    for ip, recs in recordings.items():
-        summaries[ip] = {r: recording_summary(recs[r]) for r in recs}
-    for ip in sorted(summaries):
-        for smry in sorted(summaries[ip].values(),
-                           key=lambda k: (k['show_title'],
-                                          k['episode_season'],
-                                          k['episode_number'],
-                                          k['show_time'])):
-            titletag, filename = title_and_filename(smry)
-            print('Filename : %s' % filename)
-            print('Title Tag: %s' % titletag)
-
-            if smry['episode_description']:
-                print('Desc:      %s' % truncate_string(smry['episode_description'], 70))
-            if smry['event_description']:
-                print('Desc:      %s' % truncate_string(smry['event_description'], 70))
-            print('Path:      %s' % smry['path'])
-            print()
+def dump_row(row):
+    """Return the DUMP_FIELDS of a row from RecordingsDB.summaries."""
+    smry = row['summary']
+    return {
+        'device': row['device'],
+        'recording_id': row['recording_id'],
+        'category': smry['category'],
+        'show_title': smry['show_title'],
+        'show_time': smry['show_time'],
+        'season': smry['episode_season'] or smry['event_season'],
+        'episode': smry['episode_number'],
+        'episode_title': smry['episode_title'] or smry['event_title'],
+        'title': row['title'],
+        'filename': row['filename'],
+        'description': (smry['episode_description'] or
+                        smry['event_description']),
+        'state': row['state'],
+        'downloaded_at': row['downloaded_at'],
+        'download_path': row['download_path'],
+    }
+
+
+def dump_filters(args):
+    """Return RecordingsDB filters for the --dump filter flags."""
+    filters = {
+        'category': args.category,
+        'show_title': args.show_title,
+        'device': args.device,
+        'aired_after': args.aired_after,
+        'aired_before': args.aired_before,
+        'downloaded': DOWNLOAD_STATES.get(args.download_state),
+    }
+    return {k: v for k, v in filters.items() if v is not None}
+
+
+def iso_date(value):
+    """Return value if it is an ISO 8601 date or date and time."""
+    try:
+        datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid date [%s]' % value)
+    return value
+
+
+def dump_recordings(db, out=None, output_format='table', **filters):
+    """Write each recording matching filters, ordered by device and show,
+    as it is read.
+
+    output_format is 'table' for a human-readable block per recording,
+    'jsonl' for a JSON object per line or 'csv' for CSV with a header.
+    filters are RecordingsDB.summaries filters. Reads only the fields
+    precomputed at sync time.
+    """
+    out = out or sys.stdout
+    rows = db.summaries(**filters)
+    if output_format == 'jsonl':
+        for row in rows:
+            out.write(json.dumps(dump_row(row)) + '\n')
+        return
+    if output_format == 'csv':
+        writer = csv.DictWriter(out, DUMP_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dump_row(row))
+        return
+    for row in rows:
+        smry = row['summary']
+        out.write('Filename : %s\n' % row['filename'])
+        out.write('Title Tag: %s\n' % row['title'])
+
+        if smry['episode_description']:
+            out.write('Desc:      %s\n' % truncate_string(
+                smry['episode_description'], 70))
+        if smry['event_description']:
+            out.write('Desc:      %s\n' % truncate_string(
+                smry['event_description'], 70))
+        out.write('Path:      %s\n' % smry['path'])
+        out.write('\n')
 
 
 def parse_args_and_settings():
@@ -298,6 +1112,7 @@ def parse_args_and_settings():
         '--local_ips',
         action='store_true',
         help='Display the IPs of Tablo devices on a local network')
+    discovery.add_arguments(parser)
     parser.add_argument(
         '--tablo_ips',
         '--ips',
@@ -317,11 +1132,78 @@ def parse_args_and_settings():
         action='store_true',
         help='Create/Update Tablo recordings DB.',
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help='Maximum concurrent Tablo API requests across all devices.',
+    )
+    parser.add_argument(
+        '--workers_per_device',
+        type=int,
+        default=DEFAULT_WORKERS_PER_DEVICE,
+        help='Maximum concurrent Tablo API requests per device.',
+    )
+    parser.add_argument(
+        '--full_sync',
+        action='store_true',
+        help=('With --updatedb, re-fetch metadata for every recording, not '
+              'just new and in progress ones.'),
+    )
+    parser.add_argument(
+        '--connect_timeout',
+        type=float,
+        default=apis.DEFAULT_CONNECT_TIMEOUT,
+        help='Seconds to wait when connecting to a Tablo device.',
+    )
+    parser.add_argument(
+        '--read_timeout',
+        type=float,
+        default=apis.DEFAULT_READ_TIMEOUT,
+        help='Seconds to wait for a Tablo device to respond.',
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=apis.BATCH_CHUNK_SIZE,
+        help='Number of recordings to fetch per Tablo /batch request.',
+    )
+    parser.add_argument(
+        '--fetch_retries',
+        type=int,
+        default=DEFAULT_FETCH_RETRIES,
+        help='Number of times to retry a failed recording metadata fetch.',
+    )
     parser.add_argument(
         '--dump',
         action='store_true',
         help='Dump Tablo recordings DB.',
     )
+    parser.add_argument(
+        '--format',
+        choices=DUMP_FORMATS,
+        default='table',
+        help='Output format for --dump.',
+    )
+    parser.add_argument(
+        '--aired_after',
+        type=iso_date,
+        help='Only dump recordings aired on or after this date (YYYY-MM-DD).',
+    )
+    parser.add_argument(
+        '--aired_before',
+        type=iso_date,
+        help='Only dump recordings aired before this date (YYYY-MM-DD).',
+    )
+    parser.add_argument(
+        '--device',
+        help='Only dump recordings on the Tablo with this IP.',
+    )
+    parser.add_argument(
+        '--download_state',
+        choices=sorted(DOWNLOAD_STATES),
+        help='Only dump recordings that have or have not been downloaded.',
+    )
     parser.add_argument(
         '--recording_details',
         action='store_true',
@@ -333,6 +1215,103 @@ def parse_args_and_settings():
         action='store_true',
         help='Download a Tablo recording.',
     )
+    parser.add_argument(
+        '--download_all',
+        action='store_true',
+        help=('Download all recordings not yet downloaded, optionally '
+              'limited by --category and --show_title.'),
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help=('Keep syncing the database and downloading new recordings to '
+              '--recordings_directory until interrupted.'),
+    )
+    parser.add_argument(
+        '--poll_interval',
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help='Maximum seconds between polls of idle devices with --watch.',
+    )
+    parser.add_argument(
+        '--active_poll_interval',
+        type=float,
+        default=DEFAULT_ACTIVE_POLL_INTERVAL,
+        help='Seconds between polls with --watch while recording.',
+    )
+    parser.add_argument(
+        '--category',
+        choices=['movies', 'series', 'sports'],
+        help='Only dump or download recordings in this category.',
+    )
+    parser.add_argument(
+        '--show_title',
+        help='Only dump or download recordings of this show.',
+    )
+    parser.add_argument(
+        '--max_downloads',
+        type=int,
+        default=DEFAULT_MAX_DOWNLOADS,
+        help='Maximum concurrent downloads across all devices.',
+    )
+    parser.add_argument(
+        '--downloads_per_device',
+        type=int,
+        help=('Maximum concurrent downloads per device. Defaults to the '
+              'number of tuners on the device.'),
+    )
+    parser.add_argument(
+        '--segment_workers',
+        type=int,
+        default=hls.DEFAULT_SEGMENT_WORKERS,
+        help='Number of video segments to fetch at once per download.',
+    )
+    parser.add_argument(
+        '--segment_buffer',
+        type=int,
+        default=hls.DEFAULT_SEGMENT_BUFFER,
+        help=('Maximum video segments in flight or waiting to be written '
+              'per download.'),
+    )
+    parser.add_argument(
+        '--quality',
+        type=apis.parse_quality,
+        default=apis.DEFAULT_QUALITY,
+        help=('Which variant to download when a recording has several: '
+              'highest, lowest, or the one nearest a bitrate such as 3M.'),
+    )
+    parser.add_argument(
+        '--max_bandwidth',
+        help=('Maximum download bandwidth across all devices, in bytes per '
+              'second with an optional K, M or G suffix, e.g. 20M.'),
+    )
+    parser.add_argument(
+        '--device_bandwidth',
+        help='Maximum download bandwidth per device, e.g. 8M.',
+    )
+    parser.add_argument(
+        '--bandwidth_file',
+        help=('A JSON file of bandwidth limits, reloaded when it changes, '
+              'e.g. {"global": "20M", "device": "8M", '
+              '"devices": {"192.168.1.25": "4M"}}.'),
+    )
+    parser.add_argument(
+        '--progress_interval',
+        type=float,
+        default=hls.DEFAULT_PROGRESS_INTERVAL,
+        help='Seconds between download progress lines; 0 to disable.',
+    )
+    parser.add_argument(
+        '--progress_events',
+        help='Append download progress events to this file as JSON lines.',
+    )
+    parser.add_argument(
+        '--stall_timeout',
+        type=float,
+        default=hls.DEFAULT_STALL_TIMEOUT,
+        help=('Cancel a download that makes no progress for this many '
+              'seconds; 0 to wait forever.'),
+    )
     parser.add_argument(
         '--dry_run',
         action='store_true',
@@ -343,45 +1322,117 @@ def parse_args_and_settings():
         action='store_true',
         help='Overwrite existing downloads.',
     )
+    parser.add_argument(
+        '--purge_downloaded',
+        action='store_true',
+        help=('Delete every recording with a verified download from its '
+              'Tablo, with any deletes still queued. Honors --category, '
+              '--show_title and --dry_run.'),
+    )
+    parser.add_argument(
+        '--delete_workers',
+        type=int,
+        default=DEFAULT_DELETE_WORKERS,
+        help='Maximum concurrent deletes of Tablo recordings.',
+    )
     parser.add_argument(
         '--delete_originals_after_downloading',
         action='store_true',
         help='Delete Tablo recordings after successfully downloading them',
     )
+    parser.add_argument(
+        '--metrics_file',
+        help=('Write API call metrics to this file at exit, as JSON if it '
+              'ends in .json and in the Prometheus text format otherwise.'),
+    )
+    parser.add_argument(
+        '--metrics_format',
+        choices=['prometheus', 'json'],
+        help='Override the format of --metrics_file.',
+    )
+    parser.add_argument(
+        '--metrics_interval',
+        type=float,
+        help='Log a summary of API calls every this many seconds.',
+    )
+    apis.add_cache_arguments(parser)
     args = parser.parse_args()
     args_dict = vars(args)
     settings = load_settings()
     for setting in settings:
         if setting in args_dict:
             args_dict[setting] = settings[setting]
+    # Settings bypass argparse's type conversion.
+    try:
+        args.quality = apis.parse_quality(args.quality)
+    except ValueError:
+        parser.error('invalid quality [%s]' % args.quality)
     return args
 
 
-def main():
-    args = parse_args_and_settings()
-    if args.dry_run or args.verbose:
-        vars(args)['log_level'] = 'debug'
-    LOGGER.setLevel(getattr(logging, args.log_level.upper()))
-    LOGGER.debug('Log level [%s]', args.log_level)
-
+def run_commands(args):
     if args.local_ips:
-        print(','.join(local_ips()))
+        print(','.join(sorted(local_ips(args.rediscover,
+                                        args.discovery_timeout))))
 
     if args.updatedb:
         create_or_update_recordings_database(args)
 
     if args.recording_details:
+        import pprint
         pprint.pprint(apis.recording_details(
                 recording_id=args.recording_id, ip=args.tablo_ips))
 
     if args.dump:
-        recordings = load_recordings_db()
-        dump_recordings(recordings)
+        with open_recordings_db() as db:
+            dump_recordings(db, output_format=args.format,
+                            **dump_filters(args))
 
     if args.download_recording:
         download_recording(args)
         return
 
+    if args.download_all:
+        download_all_recordings(args)
+
+    if args.watch:
+        watch(args)
+
+    if args.purge_downloaded:
+        purge_downloaded(args)
+
+
+def main():
+    args = parse_args_and_settings()
+    if args.dry_run or args.verbose:
+        vars(args)['log_level'] = 'debug'
+    LOGGER.setLevel(getattr(logging, args.log_level.upper()))
+    LOGGER.debug('Log level [%s]', args.log_level)
+    if not any(getattr(args, command) for command in NETWORK_COMMANDS):
+        run_commands(args)
+        return
+    apis.configure_client(
+        pool_size=max(args.workers, args.workers_per_device,
+                      args.segment_workers * args.max_downloads,
+                      apis.DEFAULT_POOL_SIZE),
+        timeout=(args.connect_timeout, args.read_timeout))
+    apis.configure_cache_from_args(args)
+    if args.max_bandwidth or args.device_bandwidth:
+        ratelimit.LIMITS.configure(
+            ratelimit.parse_rate(args.max_bandwidth),
+            ratelimit.parse_rate(args.device_bandwidth))
+    if args.bandwidth_file:
+        ratelimit.LIMITS.watch_file(args.bandwidth_file)
+
+    reporter = (metrics.Reporter(args.metrics_interval, log=LOGGER.info)
+                if args.metrics_interval else contextlib.nullcontext())
+    try:
+        with reporter:
+            run_commands(args)
+    finally:
+        if args.metrics_file:
+            metrics.METRICS.write(args.metrics_file, args.metrics_format)
+
 
 if __name__ == '__main__':
     main()
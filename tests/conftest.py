@@ -0,0 +1,26 @@
+import pytest
+
+from tablo_downloader import apis
+from tablo_downloader import metrics
+from tablo_downloader import ratelimit
+from tests import mock_api_responses
+
+
+@pytest.fixture
+def transport():
+    """Route all Tablo API calls to a MockTransport."""
+    mock_transport = mock_api_responses.MockTransport()
+    apis.configure_client(transport=mock_transport)
+    return mock_transport
+
+
+@pytest.fixture(autouse=True)
+def reset_client():
+    """Restore the default apis.Client, disable caching and reset metrics
+    and bandwidth limits after each test."""
+    yield
+    metrics.METRICS.reset()
+    ratelimit.LIMITS.watch_file(None)
+    ratelimit.LIMITS.configure()
+    apis.configure_client()
+    apis.configure_cache(enabled=False)
@@ -1,17 +1,39 @@
+import json as json_module
+
+from unittest.mock import MagicMock
+
 PRIVATE_IP = '192.168.1.1'
 PUBLIC_IP = '192.168.233.1'
 SERVER_ID = 'SID_012345678901'
 
 
 class MockResponse:
-    def __init__(self, json, text):
+    def __init__(self, json, text, status_code=200):
         self._json = json
         self.text = text
+        self.status_code = status_code
+        self.headers = {}
+
+    @property
+    def content(self):
+        return self.text.encode() if self._json is None else \
+            json_module.dumps(self._json).encode()
 
     def json(self):
         return self._json
 
 
+class MockTransport:
+    """An apis.Client transport dispatching on method to mock handlers."""
+    def __init__(self):
+        self.get = MagicMock()
+        self.post = MagicMock()
+        self.delete = MagicMock()
+
+    def request(self, method, url, timeout=None, **kwargs):
+        return getattr(self, method.lower())(url, **kwargs)
+
+
 def local_server_info(url):
     return MockResponse(json={
         'cpes': [{
@@ -173,3 +195,34 @@ def recording_details(url):
         }
     },
                         text='')
+
+
+def batch_details(url, json=None):
+    details = recording_details(url).json()
+    res = {}
+    for path in json or []:
+        if path.startswith('/recordings/'):
+            res[path] = dict(details, path=path,
+                             object_id=int(path.rsplit('/', 1)[-1]))
+    return MockResponse(json=res, text='')
+
+
+MEDIA_PLAYLIST = '''#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:10
+#EXT-X-MEDIA-SEQUENCE:1
+#EXTINF:10.000,
+segs/00001.ts
+#EXTINF:10.000,
+segs/00002.ts
+#EXTINF:4.500,
+/stream/00003.ts
+#EXT-X-ENDLIST
+'''
+
+MASTER_PLAYLIST = '''#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=1500000,RESOLUTION=720x480
+low.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=6000000,RESOLUTION=1920x1080
+/stream/high.m3u8
+'''
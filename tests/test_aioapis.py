@@ -0,0 +1,110 @@
+import asyncio
+import http.server
+import json
+import random
+import threading
+
+import pytest
+
+from tablo_downloader import aioapis
+from tablo_downloader import apis
+from tests import mock_api_responses
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, status=200, chunked=False):
+        Handler.connections.add(self.client_address)
+        self.send_response(status)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(body), 7):
+                chunk = body[i:i + 7]
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/server/info':
+            info = mock_api_responses.server_information(self.path).json()
+            self.send_body(json.dumps(info).encode())
+        elif self.path == '/recordings/airings':
+            recordings = mock_api_responses.server_recordings(self.path)
+            self.send_body(json.dumps(recordings.json()).encode(),
+                           chunked=True)
+        else:
+            self.send_body(b'Not found', status=404)
+
+    def do_POST(self):
+        paths = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])))
+        res = mock_api_responses.batch_details(self.path, paths).json()
+        self.send_body(json.dumps(res).encode())
+
+    def do_DELETE(self):
+        self.send_body(b'')
+
+
+@pytest.fixture
+def server():
+    Handler.connections = set()
+    # The Tablo APIs always use port 8885, so the server gets its own
+    # loopback address.
+    ip = '127.0.0.%d' % random.randint(2, 254)
+    try:
+        httpd = http.server.ThreadingHTTPServer(
+            (ip, apis.TABLO_INFO_PORT), Handler)
+    except OSError as e:
+        pytest.skip('Unable to listen on [%s]: %s' % (ip, e))
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,),
+                              daemon=True)
+    thread.start()
+    yield ip
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_server_information(server):
+    async def run():
+        async with aioapis.AsyncClient(pool_size=2) as client:
+            return await asyncio.gather(*[
+                aioapis.server_information(server, client=client)
+                for _ in range(10)])
+
+    for res in asyncio.run(run()):
+        assert res['model']['tuners'] == 2
+    # Connections are kept alive and reused.
+    assert len(Handler.connections) <= 2
+
+
+def test_chunked_response(server):
+    res = asyncio.run(aioapis.server_recordings(server))
+    assert res == mock_api_responses.server_recordings('').json()
+
+
+def test_batch_details(server):
+    paths = ['/recordings/series/episodes/%d' % i for i in range(5)]
+    res = asyncio.run(aioapis.batch_details(server, paths, chunk_size=2))
+    assert sorted(res) == sorted(paths)
+
+
+def test_delete_recording(server):
+    res = asyncio.run(aioapis.delete_recording(
+        server, '/recordings/series/episodes/1'))
+    assert res == ''
+
+
+def test_errors(server):
+    res = asyncio.run(aioapis.recording_details(server, '/missing'))
+    assert res['status_code'] == 404
+    res = asyncio.run(aioapis.server_information('127.0.0.1'))
+    assert 'exception' in res
@@ -1,64 +1,56 @@
 from tablo_downloader import apis
 from tests import mock_api_responses
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 
-@patch('tablo_downloader.apis.requests.get')
-def test_local_server_info(mock_request):
-    mock_request.side_effect = mock_api_responses.local_server_info
+def test_local_server_info(transport):
+    transport.get.side_effect = mock_api_responses.local_server_info
     res = apis.local_server_info()
     assert res['cpes'][0]['private_ip'] == mock_api_responses.PRIVATE_IP
     assert res['cpes'][0]['public_ip'] == mock_api_responses.PUBLIC_IP
 
 
-@patch('tablo_downloader.apis.requests.get')
-def test_server_settings(mock_request):
-    mock_request.side_effect = mock_api_responses.server_settings
+def test_server_settings(transport):
+    transport.get.side_effect = mock_api_responses.server_settings
     res = apis.server_settings(mock_api_responses.PRIVATE_IP)
     assert res['audio'] == 'ac3'
 
 
-@patch('tablo_downloader.apis.requests.get')
-def test_server_information(mock_request):
-    mock_request.side_effect = mock_api_responses.server_information
+def test_server_information(transport):
+    transport.get.side_effect = mock_api_responses.server_information
     res = apis.server_information(mock_api_responses.PRIVATE_IP)
     assert res['local_address'] == mock_api_responses.PRIVATE_IP
     assert res['model']['tuners'] == 2
 
 
-@patch('tablo_downloader.apis.requests.get')
-def test_server_capabilities(mock_request):
-    mock_request.side_effect = mock_api_responses.server_capabilities
+def test_server_capabilities(transport):
+    transport.get.side_effect = mock_api_responses.server_capabilities
     res = apis.server_capabilities(mock_api_responses.PRIVATE_IP)
     assert 'recording_options' in res['capabilities']
 
 
-@patch('tablo_downloader.apis.requests.get')
-def test_server_channels(mock_request):
-    mock_request.side_effect = mock_api_responses.server_channels
+def test_server_channels(transport):
+    transport.get.side_effect = mock_api_responses.server_channels
     res = apis.server_channels(mock_api_responses.PRIVATE_IP)
     for channel in res:
         assert channel.startswith('/guide/channels/')
 
 
-@patch('tablo_downloader.apis.requests.get')
-def test_server_recordings(mock_request):
-    mock_request.side_effect = mock_api_responses.server_recordings
+def test_server_recordings(transport):
+    transport.get.side_effect = mock_api_responses.server_recordings
     res = apis.server_recordings(mock_api_responses.PRIVATE_IP)
     for channel in res:
         assert channel.startswith('/recordings/')
 
 
-@patch('tablo_downloader.apis.requests.delete')
-def test_delete_recording(mock_request):
-    mock_request.return_value = mock_api_responses.MockResponse([], '')
+def test_delete_recording(transport):
+    transport.delete.return_value = mock_api_responses.MockResponse([], '')
     res = apis.delete_recording(mock_api_responses.PRIVATE_IP, '')
     assert not res
 
 
-@patch('tablo_downloader.apis.requests.get')
-def test_recording_details(mock_request):
-    mock_request.side_effect = mock_api_responses.recording_details
+def test_recording_details(transport):
+    transport.get.side_effect = mock_api_responses.recording_details
     res = apis.recording_details(
         mock_api_responses.PRIVATE_IP,
         '/recording/123456')
@@ -66,3 +58,142 @@ def test_recording_details(mock_request):
     assert 'episode' in res
     assert 'user_info' in res
     assert 'video_details' in res
+
+
+def test_batch_details(transport):
+    transport.post.side_effect = mock_api_responses.batch_details
+    paths = [
+        '/recordings/series/episodes/567890',
+        '/recordings/movies/airings/548091',
+        '/recordings/sports/events/548117',
+        '/unknown/123',
+    ]
+    res = apis.batch_details(mock_api_responses.PRIVATE_IP, paths,
+                             chunk_size=2)
+    assert transport.post.call_count == 2
+    assert sorted(res) == sorted(paths[:3])
+    assert res[paths[1]]['object_id'] == 548091
+
+
+def test_batch_details_error(transport):
+    transport.post.return_value = mock_api_responses.MockResponse(
+        None, '', status_code=500)
+    res = apis.batch_details(mock_api_responses.PRIVATE_IP, ['/a', '/b'])
+    assert res['status_code'] == 500
+
+
+def test_client_sessions_per_host():
+    client = apis.Client(pool_size=4, timeout=(1, 2))
+    session = client.session('http://192.168.1.1:8885/server/info')
+    assert session is client.session('http://192.168.1.1:8885/guide/channels')
+    assert session is not client.session('http://192.168.1.2:8885/server/info')
+    assert session.get_adapter('http://192.168.1.1')._pool_maxsize == 4
+    client.close()
+
+
+def test_client_timeout():
+    transport = MagicMock()
+    client = apis.Client(timeout=(1, 2), transport=transport)
+    client.request('GET', 'http://192.168.1.1:8885/server/info')
+    transport.request.assert_called_once_with(
+        'GET', 'http://192.168.1.1:8885/server/info', timeout=(1, 2))
+
+
+@patch('requests.Session.request')
+def test_call_api_exception(mock_request):
+    mock_request.side_effect = ConnectionError('unreachable')
+    apis.configure_client()
+    res = apis.server_information(mock_api_responses.PRIVATE_IP)
+    assert 'error' in res
+    assert isinstance(res['exception'], ConnectionError)
+
+
+def test_response_cache_ttl(transport, tmp_path):
+    apis.configure_cache(str(tmp_path))
+    transport.get.side_effect = mock_api_responses.server_information
+    for _ in range(3):
+        res = apis.server_information(mock_api_responses.PRIVATE_IP)
+        assert res['model']['tuners'] == 2
+    assert transport.get.call_count == 1
+    # Uncached endpoints always call the device.
+    transport.get.side_effect = mock_api_responses.server_recordings
+    apis.server_recordings(mock_api_responses.PRIVATE_IP)
+    apis.server_recordings(mock_api_responses.PRIVATE_IP)
+    assert transport.get.call_count == 3
+
+
+def test_response_cache_revalidation(transport, tmp_path):
+    cache = apis.configure_cache(str(tmp_path))
+    info = mock_api_responses.server_information('')
+    info.headers = {'ETag': '"v1"'}
+    transport.get.return_value = info
+    apis.server_information(mock_api_responses.PRIVATE_IP)
+
+    # Once stale, the entry is revalidated and a 304 serves it again.
+    url = apis.SRVR_INFORMATION_URL.format(ip=mock_api_responses.PRIVATE_IP)
+    entry = cache.get(url)
+    cache.put(url, apis.cached_response(entry), fetched=0)
+    transport.get.return_value = mock_api_responses.MockResponse(
+        None, '', status_code=304)
+    res = apis.server_information(mock_api_responses.PRIVATE_IP)
+    assert res['model']['tuners'] == 2
+    assert transport.get.call_args[1]['headers'] == {'If-None-Match': '"v1"'}
+    assert cache.get(url)['fetched'] > 0
+    assert cache.get(url)['etag'] == '"v1"'
+
+    # --refresh revalidates fresh entries too.
+    apis.configure_cache(str(tmp_path), refresh=True)
+    apis.server_information(mock_api_responses.PRIVATE_IP)
+    assert transport.get.call_count == 3
+
+
+def test_response_cache_eviction(tmp_path):
+    cache = apis.ResponseCache(str(tmp_path), max_bytes=500)
+    for i in range(10):
+        cache.put('http://tablo/%d' % i,
+                  apis.Response(200, {}, b'x' * 100))
+    assert cache.get('http://tablo/0') is None
+    assert cache.get('http://tablo/9')['content'] == 'x' * 100
+    assert len(list(tmp_path.iterdir())) < 10
+
+
+PLAYLIST_URL = 'http://%s:8885/stream/pl.m3u8?abc' % (
+    mock_api_responses.PRIVATE_IP)
+
+
+def test_parse_attributes():
+    assert apis.parse_attributes(
+        'BANDWIDTH=1500000,CODECS="avc1.4d401f,mp4a.40.2",RESOLUTION=720x480'
+    ) == {'BANDWIDTH': '1500000', 'CODECS': 'avc1.4d401f,mp4a.40.2',
+          'RESOLUTION': '720x480'}
+
+
+def test_select_variant():
+    variants = apis.playlist_variants(mock_api_responses.MASTER_PLAYLIST,
+                                      PLAYLIST_URL)
+    low, high = variants
+    assert low.resolution == '720x480'
+    assert apis.select_variant(variants, 'highest') == high
+    assert apis.select_variant(variants, 'lowest') == low
+    assert apis.select_variant(variants, apis.parse_quality('3M')) == low
+    assert apis.select_variant(variants, apis.parse_quality('4M')) == high
+    assert apis.playlist_variants(mock_api_responses.MEDIA_PLAYLIST,
+                                  PLAYLIST_URL) == []
+
+
+def test_playlist_m3u(transport):
+    transport.get.side_effect = lambda url, **kwargs: (
+        mock_api_responses.MockResponse(
+            None, mock_api_responses.MASTER_PLAYLIST)
+        if url == PLAYLIST_URL else mock_api_responses.MockResponse(
+            None, mock_api_responses.MEDIA_PLAYLIST))
+    pl_info = {'playlist_url': PLAYLIST_URL}
+    m3u = apis.playlist_m3u(pl_info, quality='lowest')
+    assert transport.get.call_args[0][0] == (
+        'http://192.168.1.1:8885/stream/low.m3u8')
+    assert 'http://192.168.1.1:8885/stream/segs/00001.ts' in m3u
+    assert 'http://192.168.1.1:8885/stream/00003.ts' in m3u
+    assert m3u.endswith('#EXT-X-ENDLIST\n')
+
+    m3u = apis.playlist_m3u(pl_info, quality=None)
+    assert 'http://192.168.1.1:8885/stream/low.m3u8' in m3u
@@ -0,0 +1,30 @@
+import json
+import random
+
+import pytest
+
+from tablo_downloader import benchmark
+
+
+def test_run_suite(tmp_path):
+    ip = '127.0.0.%d' % random.randint(2, 254)
+    try:
+        results = list(benchmark.run_suite(
+            sizes=[20], profiles=['lan'], repeat=2, ip=ip, downloads=1,
+            startup=False))
+    except OSError as e:
+        pytest.skip('Unable to listen on [%s]: %s' % (ip, e))
+    names = [r['benchmark'] for r in results]
+    assert names[:6] == ['sync', 'resync', 'dump', 'db_load', 'db_save',
+                         'fetch_segments']
+    for result in results:
+        assert result['recordings'] == 20
+        assert len(result['seconds']) == 2
+        assert result['min'] <= result['median']
+    assert results[0]['requests']['batch'] >= 2
+    assert results[5]['bytes'] > 0
+
+    output = tmp_path / 'results.jsonl'
+    output.write_text(''.join(
+        json.dumps(r) + '\n' for r in results))
+    assert benchmark.load_results(str(output)) == results
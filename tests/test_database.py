@@ -0,0 +1,169 @@
+import json
+import sqlite3
+
+from tablo_downloader import database
+from tests import mock_api_responses
+
+DEVICE = mock_api_responses.PRIVATE_IP
+
+
+def metadata(category, show_title, show_time, season=None, number=None):
+    details = {'airing_details': {'show_title': show_title,
+                                  'datetime': show_time}}
+    if category == 'series':
+        details['episode'] = {'season_number': season, 'number': number}
+    return {'category': category, 'details': details}
+
+
+RECORDINGS = {
+    '/recordings/series/episodes/3': metadata('series', 'B Show',
+                                              '2021-01-03T00:00Z', 1, 2),
+    '/recordings/series/episodes/2': metadata('series', 'B Show',
+                                              '2021-01-02T00:00Z', 1, 1),
+    '/recordings/movies/airings/1': metadata('movies', 'A Movie',
+                                             '2021-01-01T00:00Z'),
+    '/recordings/sports/events/4': metadata('sports', None,
+                                            '2021-01-04T00:00Z'),
+}
+
+
+def test_put_get_delete(tmp_path):
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        db.put_many(DEVICE, RECORDINGS)
+        assert db.count() == 4
+        assert db.devices() == [DEVICE]
+        assert db.recording_ids(DEVICE) == set(RECORDINGS)
+        path = '/recordings/movies/airings/1'
+        assert db.get(DEVICE, path) == RECORDINGS[path]
+        assert db.get('192.168.1.2', path) is None
+        db.delete_many(DEVICE, [path])
+        assert db.get(DEVICE, path) is None
+        assert db.count(DEVICE) == 3
+
+
+def test_recordings_order_and_filters(tmp_path):
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        db.put_many(DEVICE, RECORDINGS)
+        ids = [r for _, r, _ in db.recordings()]
+        assert ids == ['/recordings/sports/events/4',
+                       '/recordings/movies/airings/1',
+                       '/recordings/series/episodes/2',
+                       '/recordings/series/episodes/3']
+        ids = [r for _, r, _ in db.recordings(category='series')]
+        assert ids == ['/recordings/series/episodes/2',
+                       '/recordings/series/episodes/3']
+
+
+def test_download_state_preserved(tmp_path):
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        db.put_many(DEVICE, RECORDINGS)
+        path = '/recordings/movies/airings/1'
+        db.mark_downloaded(DEVICE, path, '/tmp/A_Movie.mp4',
+                           '2021-02-01T00:00:00')
+        db.put(DEVICE, path, RECORDINGS[path])
+        assert [r for _, r, _ in db.recordings(downloaded=True)] == [path]
+        assert len(list(db.recordings(downloaded=False))) == 3
+        assert db.get_verification(DEVICE, path) is None
+
+
+def test_verification(tmp_path):
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        db.put_many(DEVICE, RECORDINGS)
+        path = '/recordings/movies/airings/1'
+        verification = {'verified': False, 'problems': ['Truncated']}
+        db.mark_downloaded(DEVICE, path, '/tmp/A_Movie.mp4',
+                           '2021-02-01T00:00:00', verification)
+        assert db.get_verification(DEVICE, path) == verification
+        row = db._execute('SELECT verified FROM recordings '
+                          'WHERE recording_id = ?', (path,)).fetchone()
+        assert row['verified'] == 0
+
+
+def test_migrate_json(tmp_path):
+    legacy = tmp_path / '.tablodldb'
+    legacy.write_text(json.dumps({DEVICE: RECORDINGS}))
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite'),
+                               legacy_path=str(legacy)) as db:
+        assert db.recording_ids(DEVICE) == set(RECORDINGS)
+    assert not legacy.exists()
+    assert (tmp_path / '.tablodldb.migrated').exists()
+
+
+def test_journal_cursors(tmp_path):
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        db.put_many(DEVICE, RECORDINGS, change=database.ADDED)
+        db.delete_many(DEVICE, ['/recordings/movies/airings/1'],
+                       change=database.REMOVED)
+        assert db.last_change() == 5
+        assert db.journal_cursor('downloads') == 0
+        db.set_journal_cursor('downloads', 4)
+        assert [c['change'] for c in db.changes(
+            db.journal_cursor('downloads'))] == ['removed']
+        db.prune_changes()
+        assert [c['seq'] for c in db.changes()] == [5]
+
+
+def test_added_columns_filled_in(tmp_path):
+    path = str(tmp_path / 'db.sqlite')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE recordings (device TEXT NOT NULL, '
+                 'recording_id TEXT NOT NULL, category TEXT, '
+                 'show_title TEXT, show_time TEXT, episode_season INTEGER, '
+                 'episode_number INTEGER, downloaded_at TEXT, '
+                 'download_path TEXT, metadata TEXT NOT NULL, '
+                 'PRIMARY KEY (device, recording_id))')
+    conn.execute('INSERT INTO recordings (device, recording_id, metadata) '
+                 'VALUES (?, ?, ?)', (DEVICE, '/r/1', json.dumps(
+                     {'category': 'movies', 'details': {
+                         'airing_details': {'show_title': 'A Movie'},
+                         'video_details': {'state': 'recording'}}})))
+    conn.commit()
+    conn.close()
+    with database.RecordingsDB(path) as db:
+        assert db.recording_ids(DEVICE, in_progress=True) == {'/r/1'}
+        assert db.get_summary(DEVICE, '/r/1')['filename'] == 'A_Movie.mp4'
+
+
+def test_added_columns_only_refresh_derived(tmp_path, monkeypatch):
+    path = str(tmp_path / 'db.sqlite')
+    with database.RecordingsDB(path) as db:
+        db.put_many(DEVICE, RECORDINGS)
+    conn = sqlite3.connect(path)
+    conn.execute('ALTER TABLE recordings DROP COLUMN verification')
+    conn.commit()
+    conn.close()
+    refreshed = []
+    monkeypatch.setattr(database.RecordingsDB, '_refresh_derived_fields',
+                        lambda self: refreshed.append(self))
+    with database.RecordingsDB(path) as db:
+        assert db.get_verification(DEVICE, '/r/1') is None
+    assert refreshed == []
+
+
+def test_summaries(tmp_path):
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        db.put_many(DEVICE, RECORDINGS)
+        rows = list(db.summaries(category='series'))
+        assert [r['filename'] for r in rows] == [
+            'B_Show_-_S01E01.mp4', 'B_Show_-_S01E02.mp4']
+        assert rows[0]['title'] == 'B Show - S01E01'
+        assert rows[0]['summary']['episode_season'] == 1
+        summary = db.get_summary(DEVICE, '/recordings/sports/events/4')
+        assert summary['filename'] == 'UNKNOWN_-_2021-01-04.mp4'
+
+
+def test_aired_filters(tmp_path):
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        db.put_many(DEVICE, RECORDINGS)
+        db.mark_downloaded(DEVICE, '/recordings/series/episodes/2', 'a.mp4',
+                           '2021-02-01T00:00:00')
+        rows = list(db.summaries(aired_after='2021-01-02',
+                                 aired_before='2021-01-04'))
+        assert [r['recording_id'] for r in rows] == [
+            '/recordings/series/episodes/2', '/recordings/series/episodes/3']
+        assert rows[0]['download_path'] == 'a.mp4'
+        assert rows[1]['downloaded_at'] is None
+        assert list(db.recording_ids_matching(
+            aired_after='2021-01-02', downloaded=False)) == [
+                (DEVICE, '/recordings/sports/events/4'),
+                (DEVICE, '/recordings/series/episodes/3')]
@@ -0,0 +1,83 @@
+import ipaddress
+import random
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from tablo_downloader import apis
+from tablo_downloader import discovery
+from tablo_downloader import emulator
+from tablo_downloader import metrics
+from tests import mock_api_responses
+
+
+@pytest.fixture
+def device():
+    ip = '127.0.0.%d' % random.randint(2, 254)
+    device = emulator.Emulator(ip, recordings=1)
+    try:
+        device.start()
+    except OSError as e:
+        pytest.skip('Unable to listen on [%s]: %s' % (ip, e))
+    yield device
+    device.stop()
+
+
+def test_scan(device):
+    other = '127.0.0.%d' % (1 + int(device.ip.split('.')[-1]) % 254)
+    found = discovery.scan([device.ip, other], timeout=1)
+    assert list(found) == [device.ip]
+    assert found[device.ip]['server_id'].startswith('SID_EMULATOR')
+    # The shared client is left without a session per scanned address.
+    assert not apis.client()._sessions
+
+
+def test_server_info_probe_client(transport):
+    transport.get.side_effect = lambda url, **kwargs: (
+        mock_api_responses.MockResponse({'server_id': 'SID_1'}, '')
+        if '192.168.1.25' in url else
+        mock_api_responses.MockResponse(None, 'Oops', status_code=404))
+    transport.request = MagicMock(wraps=transport.request)
+    assert discovery.server_info('192.168.1.25', timeout=0.25) == {
+        'server_id': 'SID_1'}
+    assert discovery.server_info('192.168.1.26', timeout=0.25) is None
+    assert transport.request.call_args[1]['timeout'] == 0.25
+    # Probes stay out of the API metrics.
+    assert metrics.METRICS.snapshot() == []
+
+
+def test_broadcast_probe(device):
+    if device._discovery is None:
+        pytest.skip('Unable to answer discovery probes')
+    assert discovery.broadcast_probe([device.ip], timeout=0.2) == {device.ip}
+    assert device.stats['discovery'] == 1
+
+
+def test_discover(device):
+    network = ipaddress.ip_network(device.ip + '/24', strict=False)
+    start = time.monotonic()
+    found = discovery.discover([network], broadcast=[device.ip],
+                               timeout=0.5)
+    assert list(found) == [device.ip]
+    assert time.monotonic() - start < 5
+
+
+def test_local_ips_cache(tmp_path, monkeypatch):
+    path = str(tmp_path / 'ips')
+    discovered = []
+
+    def discover(timeout):
+        discovered.append(timeout)
+        return {'192.168.1.25': {}}
+
+    monkeypatch.setattr(discovery, 'discover', discover)
+    assert discovery.local_ips(path=path) == {'192.168.1.25'}
+    assert discovery.local_ips(path=path) == {'192.168.1.25'}
+    assert len(discovered) == 1
+    discovery.local_ips(refresh=True, path=path)
+    assert len(discovered) == 2
+    # Expired entries are discovered again.
+    discovery.local_ips(ttl=0, path=path)
+    assert len(discovered) == 3
+    assert discovery.cached_ips(path=str(tmp_path / 'missing')) is None
@@ -0,0 +1,85 @@
+import argparse
+import random
+import time
+
+import pytest
+
+from tablo_downloader import apis
+from tablo_downloader import emulator
+from tablo_downloader import hls
+from tablo_downloader import tablo
+
+
+@pytest.fixture
+def device(request):
+    # The Tablo APIs always use port 8885, so each emulated device gets its
+    # own loopback address.
+    kwargs = getattr(request, 'param', {})
+    ip = '127.0.0.%d' % random.randint(2, 254)
+    device = emulator.Emulator(ip, **dict(dict(recordings=30), **kwargs))
+    try:
+        device.start()
+    except OSError as e:
+        pytest.skip('Unable to listen on [%s]: %s' % (ip, e))
+    yield device
+    device.stop()
+
+
+def test_recordings(device):
+    assert apis.server_information(device.ip)['local_address'] == device.ip
+    recordings = apis.server_recordings(device.ip)
+    assert len(recordings) == 30
+    details = apis.batch_details(device.ip, recordings, chunk_size=8)
+    assert sorted(details) == sorted(recordings)
+    assert details[recordings[0]]['episode']['season_number'] == 1
+    assert apis.recording_details(device.ip, recordings[1])[
+        'movie_airing']['release_year'] == 1951
+    assert device.stats['batch'] == 4
+
+
+def test_playlist_and_segments(device):
+    recording = apis.server_recordings(device.ip)[0]
+    pl_info = apis.playlist_info(device.ip, recording)
+    segments = hls.playlist_segments(pl_info['playlist_url'])
+    assert len(segments) == emulator.DEFAULT_SEGMENTS
+    assert segments[0].duration == emulator.DEFAULT_SEGMENT_DURATION
+    chunks = []
+    size = hls.fetch_segments(segments[:3], chunks.append, workers=3)
+    assert size == 3 * len(device.segment)
+    assert all(chunk[0] == 0x47 for chunk in chunks)
+
+
+def test_delete(device):
+    recording = apis.server_recordings(device.ip)[0]
+    assert apis.delete_recording(device.ip, recording) == ''
+    assert recording not in apis.server_recordings(device.ip)
+    assert 'error' in apis.recording_details(device.ip, recording)
+
+
+@pytest.mark.parametrize('device', [{'error_rate': 1.0}], indirect=True)
+def test_error_injection(device):
+    assert apis.server_recordings(device.ip)['status_code'] == 500
+    assert device.stats['error'] == 1
+
+
+@pytest.mark.parametrize('device', [{'in_progress': 2}], indirect=True)
+def test_sync(device, tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    args = argparse.Namespace(
+        tablo_ips=device.ip, workers=4, workers_per_device=2, batch_size=10,
+        fetch_retries=0, full_sync=False)
+    summary, = tablo.create_or_update_recordings_database(args)
+    assert summary['added'] == 30
+    assert device.stats['batch'] == 3
+    # Only the recordings in progress are fetched again.
+    summary, = tablo.create_or_update_recordings_database(args)
+    assert (summary['added'], summary['updated']) == (0, 0)
+    assert device.stats['batch'] == 4
+
+
+def test_throttle():
+    device = emulator.Emulator(bandwidth=1e6)
+    start = time.monotonic()
+    for _ in range(3):
+        device.throttle(100000)
+    assert time.monotonic() - start >= 0.2
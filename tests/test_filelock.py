@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+from tablo_downloader import filelock
+
+pytestmark = pytest.mark.skipif(filelock.fcntl is None,
+                                reason='fcntl is unavailable')
+
+
+def test_exclusive(tmp_path):
+    path = str(tmp_path / 'db.lock')
+    with filelock.FileLock(path) as lock:
+        assert lock.locked
+        other = filelock.FileLock(path)
+        assert not other.acquire(blocking=False)
+        with pytest.raises(TimeoutError):
+            other.acquire(timeout=0.2)
+    assert other.acquire(blocking=False)
+    other.release()
+    assert os.path.exists(path)
+
+
+def test_remove(tmp_path):
+    path = str(tmp_path / '.a.mp4.lock')
+    lock = filelock.FileLock(path, remove=True)
+    assert lock.acquire(blocking=False)
+    stale = filelock.FileLock(path, remove=True)
+    assert not stale.acquire(blocking=False)
+    lock.release()
+    assert not os.path.exists(path)
+    assert stale.acquire(blocking=False)
+    stale.release()
@@ -0,0 +1,294 @@
+import hashlib
+import io
+import random
+import threading
+import time
+
+import pytest
+
+from tablo_downloader import apis
+from tablo_downloader import hls
+from tests import mock_api_responses
+from unittest.mock import patch
+
+PLAYLIST_URL = 'http://%s:8885/stream/pl.m3u8?abc' % (
+    mock_api_responses.PRIVATE_IP)
+
+
+def test_parse_media_playlist():
+    segments, variants = hls.parse_playlist(
+        mock_api_responses.MEDIA_PLAYLIST, PLAYLIST_URL)
+    assert not variants
+    assert [s.duration for s in segments] == [10.0, 10.0, 4.5]
+    assert segments[0].url == (
+        'http://192.168.1.1:8885/stream/segs/00001.ts')
+    assert segments[2].url == 'http://192.168.1.1:8885/stream/00003.ts'
+
+
+def test_parse_master_playlist():
+    segments, variants = hls.parse_playlist(
+        mock_api_responses.MASTER_PLAYLIST, PLAYLIST_URL)
+    assert not segments
+    assert variants == [
+        apis.Variant('http://192.168.1.1:8885/stream/low.m3u8', 1500000,
+                     '720x480'),
+        apis.Variant('http://192.168.1.1:8885/stream/high.m3u8', 6000000,
+                     '1920x1080')]
+
+
+@pytest.mark.parametrize('quality, variant', [
+    ('highest', 'high'), ('lowest', 'low'), (2000000, 'low'),
+    (5000000, 'high')])
+@patch('tablo_downloader.apis.call_api')
+def test_playlist_segments_variant(mock_call_api, quality, variant):
+    mock_call_api.side_effect = lambda url, output: (
+        mock_api_responses.MASTER_PLAYLIST if url == PLAYLIST_URL
+        else mock_api_responses.MEDIA_PLAYLIST)
+    segments = hls.playlist_segments(PLAYLIST_URL, quality)
+    assert len(segments) == 3
+    assert mock_call_api.call_args[0][0] == (
+        'http://192.168.1.1:8885/stream/%s.m3u8' % variant)
+
+
+@patch('tablo_downloader.apis.call_api')
+def test_fetch_segments_in_order(mock_call_api):
+    lock = threading.Lock()
+    in_flight = {'now': 0, 'peak': 0}
+
+    def fetch(url, output):
+        with lock:
+            in_flight['now'] += 1
+            in_flight['peak'] = max(in_flight['peak'], in_flight['now'])
+        time.sleep(random.random() / 100)
+        with lock:
+            in_flight['now'] -= 1
+        return url.encode()
+
+    mock_call_api.side_effect = fetch
+    segments = [hls.Segment('%04d' % i, 1.0) for i in range(50)]
+    out = io.BytesIO()
+    size = hls.fetch_segments(segments, out.write, workers=4, buffer_size=8)
+    assert out.getvalue() == b''.join(s.url.encode() for s in segments)
+    assert size == 200
+    assert in_flight['peak'] <= 4
+
+
+@patch('tablo_downloader.hls.SEGMENT_RETRY_DELAY', 0)
+@patch('tablo_downloader.apis.call_api')
+def test_fetch_segments_failure(mock_call_api):
+    mock_call_api.side_effect = lambda url, output: (
+        {'error': 'failed'} if url == '0003' else url.encode())
+    segments = [hls.Segment('%04d' % i, 1.0) for i in range(10)]
+    out = io.BytesIO()
+    with pytest.raises(hls.SegmentError):
+        hls.fetch_segments(segments, out.write, workers=2, buffer_size=4)
+    assert out.getvalue() == b'000000010002'
+
+
+def call_api(url, output):
+    if url == PLAYLIST_URL:
+        return mock_api_responses.MEDIA_PLAYLIST
+    return url.encode()
+
+
+@patch('subprocess.Popen')
+@patch('tablo_downloader.apis.call_api')
+def test_download(mock_call_api, mock_popen, tmp_path):
+    mock_call_api.side_effect = call_api
+    stdin = io.BytesIO()
+    stdin.close = lambda: None
+    mock_popen.return_value.stdin = stdin
+    mock_popen.return_value.wait.return_value = 0
+    mp4_filename = str(tmp_path / 'out.mp4')
+    assert hls.download(PLAYLIST_URL, mp4_filename, 'Title')
+    assert mock_popen.call_args[0][0][-1] == mp4_filename
+    assert 'pipe:0' in mock_popen.call_args[0][0]
+    assert stdin.getvalue().endswith(b'/stream/00003.ts')
+    assert not hls.has_partial(mp4_filename)
+    assert not (tmp_path / ('out.mp4' + hls.SPOOL_SUFFIX)).exists()
+
+
+@patch('tablo_downloader.hls.SEGMENT_RETRY_DELAY', 0)
+@patch('subprocess.Popen')
+@patch('tablo_downloader.apis.call_api')
+def test_download_resume(mock_call_api, mock_popen, tmp_path):
+    mp4_filename = str(tmp_path / 'out.mp4')
+    spool = tmp_path / ('out.mp4' + hls.SPOOL_SUFFIX)
+    mock_popen.return_value.stdin = io.BytesIO()
+
+    # The first attempt fails on the last segment.
+    mock_call_api.side_effect = lambda url, output: (
+        {'error': 'failed'} if url.endswith('00003.ts')
+        else call_api(url, output))
+    assert not hls.download(PLAYLIST_URL, mp4_filename, 'Title')
+    assert hls.has_partial(mp4_filename)
+    assert hls.load_state(mp4_filename)['completed'] == 2
+    mock_popen.return_value.kill.assert_called_once()
+
+    # Simulate a crash that left a partly written segment in the spool.
+    with open(spool, 'ab') as f:
+        f.write(b'garbage')
+
+    # The second attempt fetches only the last segment and remuxes the spool.
+    mock_call_api.reset_mock()
+    mock_call_api.side_effect = call_api
+    mock_popen.return_value.wait.return_value = 0
+    spool_contents = []
+    mock_popen.side_effect = lambda cmd, **kwargs: (
+        spool_contents.append(spool.read_bytes()) or mock_popen.return_value)
+    res = hls.download(PLAYLIST_URL, mp4_filename, 'Title')
+    assert res
+    fetched = [c[0][0] for c in mock_call_api.call_args_list]
+    assert fetched == [PLAYLIST_URL, 'http://192.168.1.1:8885/stream/00003.ts']
+    assert mock_popen.call_count == 2
+    assert str(spool) in mock_popen.call_args[0][0]
+    assert spool_contents == [
+        b'http://192.168.1.1:8885/stream/segs/00001.ts'
+        b'http://192.168.1.1:8885/stream/segs/00002.ts'
+        b'http://192.168.1.1:8885/stream/00003.ts']
+    assert not hls.has_partial(mp4_filename)
+    assert not spool.exists()
+    # The resumed download is hashed from the start of the stream.
+    assert res['segments'] == 3
+    assert res['sha256'] == hashlib.sha256(spool_contents[0]).hexdigest()
+
+
+@pytest.mark.parametrize('recording_id, quality', [
+    ('/recordings/movies/airings/2', 'highest'),
+    ('/recordings/movies/airings/1', 'lowest')])
+@patch('tablo_downloader.hls.SEGMENT_RETRY_DELAY', 0)
+@patch('subprocess.Popen')
+@patch('tablo_downloader.apis.call_api')
+def test_download_discards_other_partial(mock_call_api, mock_popen, tmp_path,
+                                         recording_id, quality):
+    mp4_filename = str(tmp_path / 'out.mp4')
+    mock_popen.return_value.stdin = io.BytesIO()
+
+    def master_call_api(url, output):
+        if url == PLAYLIST_URL:
+            return mock_api_responses.MASTER_PLAYLIST
+        if url.endswith('.m3u8'):
+            return mock_api_responses.MEDIA_PLAYLIST
+        return url.encode()
+
+    mock_call_api.side_effect = lambda url, output: (
+        {'error': 'failed'} if url.endswith('00003.ts')
+        else master_call_api(url, output))
+    assert not hls.download(PLAYLIST_URL, mp4_filename, 'Title',
+                            recording_id='/recordings/movies/airings/1')
+    assert hls.load_state(mp4_filename)['completed'] == 2
+
+    # Another recording or variant starts over rather than appending to
+    # the partial download.
+    mock_call_api.reset_mock()
+    mock_call_api.side_effect = master_call_api
+    mock_popen.return_value.wait.return_value = 0
+    stdin = io.BytesIO()
+    stdin.close = lambda: None
+    mock_popen.return_value.stdin = stdin
+    res = hls.download(PLAYLIST_URL, mp4_filename, 'Title', quality=quality,
+                       recording_id=recording_id)
+    assert res['segments'] == 3
+    fetched = [c[0][0] for c in mock_call_api.call_args_list]
+    assert sum(url.endswith('.ts') for url in fetched) == 3
+    assert 'pipe:0' in mock_popen.call_args[0][0]
+    assert stdin.getvalue().startswith(
+        b'http://192.168.1.1:8885/stream/segs/00001.ts')
+    assert not hls.has_partial(mp4_filename)
+
+
+def test_parse_progress():
+    lines = [b'frame=10\n', b'out_time_us=1500000\n', b'progress=continue\n',
+             b'out_time_us=N/A\n', b'progress=end\n']
+    blocks = list(hls.parse_progress(lines))
+    assert blocks[0]['out_time_us'] == '1500000'
+    assert blocks[1]['progress'] == 'end'
+
+    progress = hls.Progress('out.mp4', duration=10)
+    for block in blocks:
+        progress.update_media(block)
+    assert progress.position() == 1.5
+
+
+def test_progress_snapshot():
+    progress = hls.Progress('out.mp4', duration=100)
+    progress.segments = 10
+    progress.add_segment(1000, 10.0)
+    time.sleep(0.01)
+    progress.add_segment(1000, 10.0)
+    event = progress.snapshot()
+    assert (event['completed'], event['bytes']) == (2, 2000)
+    assert event['fraction'] == 0.2
+    assert event['bytes_per_second'] > 0
+    assert event['eta'] > 0
+    assert 'out.mp4] progress (fetching) 20% 20/100s' in (
+        hls.format_progress(event))
+
+
+@patch('tablo_downloader.hls.CANCEL_POLL_INTERVAL', 0.05)
+@patch('tablo_downloader.hls.SEGMENT_RETRY_DELAY', 0)
+@patch('subprocess.Popen')
+@patch('tablo_downloader.apis.call_api')
+def test_download_stalled(mock_call_api, mock_popen, tmp_path):
+    release = threading.Event()
+
+    def stuck_call_api(url, output):
+        if url.endswith('00002.ts'):
+            release.wait(5)
+        return call_api(url, output)
+
+    mock_call_api.side_effect = stuck_call_api
+    mock_popen.return_value.stdin = io.BytesIO()
+    mock_popen.return_value.poll.return_value = None
+    events = []
+    mp4_filename = str(tmp_path / 'out.mp4')
+    try:
+        assert not hls.download(PLAYLIST_URL, mp4_filename, 'Title',
+                                on_event=events.append, progress_interval=0,
+                                stall_timeout=0.2)
+    finally:
+        release.set()
+    assert [e['event'] for e in events] == ['stalled', 'failed']
+    assert events[-1]['completed'] == 1
+    assert events[-1]['duration'] == 24.5
+    mock_popen.return_value.kill.assert_called()
+    assert hls.load_state(mp4_filename)['completed'] == 1
+
+
+TS_SEGMENT = bytes([0x47]) + b'\0' * 187
+
+
+def test_verifier():
+    verifier = hls.Verifier(3, expected_duration=100)
+    for _ in range(3):
+        verifier.add(TS_SEGMENT * 10)
+    res = verifier.result(95)
+    assert res['verified']
+    assert res['bytes'] == 3 * 1880
+    assert res['sha256'] == hashlib.sha256(TS_SEGMENT * 30).hexdigest()
+
+    assert verifier.result(80)['problems'] == ['Output is 80.0s, expected '
+                                               '100.0s']
+    assert verifier.result(None)['problems'] == ['Unknown output duration']
+    verifier.add(b'<html>')
+    assert verifier.result(100)['problems'] == [
+        'Got [4] of [3] segments', '[1] segments are not MPEG-TS']
+
+
+@patch('subprocess.Popen')
+@patch('tablo_downloader.apis.call_api')
+def test_download_verified(mock_call_api, mock_popen, tmp_path):
+    mock_call_api.side_effect = lambda url, output: (
+        mock_api_responses.MEDIA_PLAYLIST if url == PLAYLIST_URL
+        else TS_SEGMENT)
+    mock_popen.return_value.stdin = io.BytesIO()
+    mock_popen.return_value.stdout = io.BytesIO(
+        b'out_time_us=24000000\nprogress=continue\n'
+        b'out_time_us=24500000\nprogress=end\n')
+    mock_popen.return_value.wait.return_value = 0
+    res = hls.download(PLAYLIST_URL, str(tmp_path / 'out.mp4'), 'Title',
+                       duration=30)
+    assert res['verified']
+    assert (res['segments'], res['expected_segments']) == (3, 3)
+    assert res['duration'] == 24.5
+    assert res['sha256'] == hashlib.sha256(TS_SEGMENT * 3).hexdigest()
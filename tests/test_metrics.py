@@ -0,0 +1,80 @@
+import json
+
+import requests
+
+from tablo_downloader import apis
+from tablo_downloader import metrics
+from tests import mock_api_responses
+
+IP = mock_api_responses.PRIVATE_IP
+
+
+def test_endpoint():
+    assert metrics.endpoint(
+        'http://%s:8885/recordings/series/episodes/123' % IP) == (
+            IP, '/recordings/series/episodes/{id}')
+    assert metrics.endpoint('http://%s:8885/stream/segs/abc/00001.ts?x=1'
+                            % IP) == (IP, '/stream/{segment}.ts')
+    assert metrics.endpoint(apis.TABLO_SERVERS_URL) == (
+        'api.tablotv.com', '/assocserver/getipinfo/')
+
+
+def test_call_api_records_metrics(transport):
+    transport.get.side_effect = mock_api_responses.recording_details
+    recording_id = mock_api_responses.server_recordings('').json()[0]
+    for _ in range(3):
+        apis.recording_details(IP, recording_id)
+    transport.get.side_effect = lambda url, **kwargs: (
+        mock_api_responses.MockResponse(None, 'Oops', status_code=500))
+    apis.server_information(IP)
+    transport.get.side_effect = requests.ConnectionError('unreachable')
+    apis.server_information(IP)
+
+    details, info = metrics.METRICS.snapshot()
+    assert details['calls'] == 3
+    assert details['errors'] == 0
+    assert details['status_codes'] == {'200': 3}
+    assert details['bytes'] > 0
+    assert sum(details['latency_buckets'].values()) == 3
+    assert info['endpoint'] == '/server/info'
+    assert info['calls'] == 2
+    assert info['errors'] == 2
+    assert info['status_codes'] == {'500': 1}
+    assert info['exceptions'] == {'ConnectionError': 1}
+    assert '[5] API calls, [2] errors' in metrics.METRICS.summary()
+
+
+def test_write(tmp_path):
+    m = metrics.Metrics()
+    m.record('GET', 'http://%s:8885/server/info' % IP, 0.02,
+             status_code=200, size=100)
+    m.record('GET', 'http://%s:8885/server/info' % IP, 120,
+             exception=TimeoutError())
+
+    m.write(str(tmp_path / 'metrics.json'))
+    snapshot = json.loads((tmp_path / 'metrics.json').read_text())
+    assert snapshot[0]['calls'] == 2
+
+    m.write(str(tmp_path / 'metrics.prom'))
+    text = (tmp_path / 'metrics.prom').read_text()
+    labels = 'device="%s",method="GET",endpoint="/server/info"' % IP
+    assert 'tablo_api_requests_total{%s,status="200"} 1' % labels in text
+    assert ('tablo_api_requests_total{%s,exception="TimeoutError"} 1' %
+            labels) in text
+    assert 'tablo_api_request_seconds_bucket{%s,le="0.025"} 1' % labels \
+        in text
+    assert 'tablo_api_request_seconds_bucket{%s,le="60.0"} 1' % labels \
+        in text
+    assert 'tablo_api_request_seconds_bucket{%s,le="+Inf"} 2' % labels \
+        in text
+    assert 'tablo_api_response_bytes_total{%s} 100' % labels in text
+
+
+def test_reporter():
+    lines = []
+    m = metrics.Metrics()
+    with metrics.Reporter(60, log=lines.append, metrics=m):
+        m.record('GET', 'http://%s:8885/server/info' % IP, 0.1,
+                 status_code=200)
+    assert lines == [m.summary()]
+    assert lines[0].startswith('[1] API calls, [0] errors')
@@ -0,0 +1,88 @@
+import json
+import os
+import random
+import time
+
+import pytest
+
+from tablo_downloader import apis
+from tablo_downloader import emulator
+from tablo_downloader import hls
+from tablo_downloader import ratelimit
+from unittest.mock import patch
+
+
+def test_parse_rate():
+    assert ratelimit.parse_rate('20M') == 20e6
+    assert ratelimit.parse_rate('1.5kb') == 1500
+    assert ratelimit.parse_rate(1000) == 1000
+    assert ratelimit.parse_rate('0') is None
+    assert ratelimit.parse_rate(None) is None
+    with pytest.raises(ValueError):
+        ratelimit.parse_rate('fast')
+
+
+@patch('tablo_downloader.ratelimit.BURST_SECONDS', 0.1)
+def test_token_bucket():
+    bucket = ratelimit.TokenBucket()
+    start = time.monotonic()
+    bucket.consume(10 ** 9)
+    assert time.monotonic() - start < 0.1
+
+    # The first 0.1s of tokens are available at once, the rest at the rate.
+    bucket.set_rate(1e6)
+    start = time.monotonic()
+    for _ in range(4):
+        bucket.consume(100000)
+    assert 0.25 <= time.monotonic() - start < 1
+
+    # Changes take effect immediately.
+    bucket.set_rate(None)
+    start = time.monotonic()
+    bucket.consume(10 ** 9)
+    assert time.monotonic() - start < 0.1
+
+
+def test_limits_file(tmp_path):
+    filename = str(tmp_path / 'limits.json')
+    with open(filename, 'w') as f:
+        json.dump({'global': '10M', 'devices': {'192.168.1.1': '1M'}}, f)
+    limits = ratelimit.BandwidthLimits()
+    limits.watch_file(filename)
+    assert limits.global_bucket.rate == 10e6
+    assert limits.limited('192.168.1.2')
+    assert limits._bucket('192.168.1.1').rate == 1e6
+    assert limits._bucket('192.168.1.2').rate is None
+
+    with open(filename, 'w') as f:
+        json.dump({'device': '2M'}, f)
+    os.utime(filename, (time.time() + 10, time.time() + 10))
+    limits.check_file()  # Not yet due.
+    assert limits.global_bucket.rate == 10e6
+    limits._next_check = 0
+    limits.check_file()
+    assert limits.global_bucket.rate is None
+    assert limits._bucket('192.168.1.1').rate == 2e6
+
+
+@patch('tablo_downloader.ratelimit.BURST_SECONDS', 0.1)
+def test_fetch_segments_limited():
+    ip = '127.0.0.%d' % random.randint(2, 254)
+    device = emulator.Emulator(ip, recordings=1, segments=4,
+                               segment_bytes=100000)
+    try:
+        device.start()
+    except OSError as e:
+        pytest.skip('Unable to listen on [%s]: %s' % (ip, e))
+    try:
+        pl_info = apis.playlist_info(ip, apis.server_recordings(ip)[0])
+        segments = hls.playlist_segments(pl_info['playlist_url'])
+        ratelimit.LIMITS.configure(device_rate=1e6)
+        chunks = []
+        start = time.monotonic()
+        size = hls.fetch_segments(segments, chunks.append, workers=4)
+        assert 0.25 <= time.monotonic() - start < 2
+        assert size == 4 * len(device.segment)
+        assert b''.join(chunks) == device.segment * 4
+    finally:
+        device.stop()
@@ -0,0 +1,21 @@
+import os
+
+from tablo_downloader import benchmark
+
+DUMP = ("sys.argv = ['tldl', '--dump']; "
+        "from tablo_downloader import tablo; tablo.main()")
+
+
+def test_entry_points_import_lazily():
+    modules = benchmark.imported_modules(
+        'import tablo_downloader.tablo, tablo_downloader.apis')
+    assert 'tablo_downloader.hls' in modules
+    assert not modules & set(benchmark.LAZY_MODULES)
+
+
+def test_dump_imports_lazily(tmp_path):
+    env = dict(os.environ, HOME=str(tmp_path))
+    # --dump reads the database but never calls a device.
+    modules = benchmark.imported_modules(DUMP, env)
+    assert 'sqlite3' in modules
+    assert not modules & (set(benchmark.LAZY_MODULES) - {'sqlite3'})
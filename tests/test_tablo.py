@@ -0,0 +1,569 @@
+import argparse
+import io
+import json
+import signal
+import threading
+import time
+
+import pytest
+
+from tablo_downloader import database
+from tablo_downloader import filelock
+from tablo_downloader import hls
+from tablo_downloader import tablo
+from tests import mock_api_responses
+from unittest.mock import patch
+
+RECORDINGS = [
+    '/recordings/series/episodes/567890',
+    '/recordings/movies/airings/548091',
+    '/recordings/sports/events/548117',
+]
+
+
+def batch_details(ip, paths, chunk_size):
+    if any(p.endswith('548091') for p in paths):
+        return {'error': 'API call failed', 'status_code': 500}
+    return {p: {'path': p} for p in paths}
+
+
+@patch('tablo_downloader.tablo.FETCH_RETRY_DELAY', 0)
+@patch('tablo_downloader.apis.recording_details')
+@patch('tablo_downloader.apis.batch_details')
+def test_fetch_recordings_metadata(mock_batch, mock_details):
+    mock_batch.side_effect = batch_details
+    mock_details.return_value = {'error': 'API call failed',
+                                 'status_code': 500}
+    metadata, failures = tablo.fetch_recordings_metadata(
+        mock_api_responses.PRIVATE_IP, RECORDINGS,
+        threading.BoundedSemaphore(2), workers_per_device=2, retries=1,
+        batch_size=1)
+    assert list(metadata) == [RECORDINGS[0], RECORDINGS[2]]
+    assert metadata[RECORDINGS[2]]['category'] == 'sports'
+    assert metadata[RECORDINGS[2]]['details'] == {'path': RECORDINGS[2]}
+    assert list(failures) == [RECORDINGS[1]]
+    # The failing batch is tried once and retried once.
+    assert mock_batch.call_count == 4
+    # Then its recording is fetched on its own.
+    mock_details.assert_called_once_with(mock_api_responses.PRIVATE_IP,
+                                         RECORDINGS[1])
+
+
+@patch('tablo_downloader.tablo.FETCH_RETRY_DELAY', 0)
+@patch('tablo_downloader.apis.recording_details')
+@patch('tablo_downloader.apis.batch_details')
+def test_fetch_recordings_chunk_falls_back(mock_batch, mock_details):
+    mock_batch.return_value = {'error': 'API call failed',
+                               'status_code': 500}
+    mock_details.side_effect = lambda ip, r: (
+        {'error': 'Not found', 'status_code': 404}
+        if r == RECORDINGS[1] else {'path': r})
+    metadata = tablo.fetch_recordings_chunk(
+        mock_api_responses.PRIVATE_IP, RECORDINGS,
+        threading.BoundedSemaphore(1), retries=1)
+    assert mock_batch.call_count == 2
+    assert list(metadata) == [RECORDINGS[0], RECORDINGS[2]]
+    assert metadata[RECORDINGS[0]]['details'] == {'path': RECORDINGS[0]}
+
+
+@patch('tablo_downloader.apis.batch_details')
+def test_fetch_recordings_metadata_batches(mock_batch):
+    mock_batch.side_effect = lambda ip, paths, chunk_size: {
+        p: {'path': p} for p in paths}
+    metadata, failures = tablo.fetch_recordings_metadata(
+        mock_api_responses.PRIVATE_IP, RECORDINGS,
+        threading.BoundedSemaphore(1), batch_size=2)
+    assert list(metadata) == RECORDINGS
+    assert not failures
+    assert mock_batch.call_count == 2
+
+
+def sync_args(**kwargs):
+    args = dict(tablo_ips='192.168.1.1,192.168.1.2', workers=4,
+                workers_per_device=2, fetch_retries=0, batch_size=10,
+                full_sync=False)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+@patch('tablo_downloader.apis.batch_details')
+@patch('tablo_downloader.apis.server_recordings')
+def test_create_or_update_recordings_database(mock_recordings, mock_batch,
+                                              tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    mock_recordings.side_effect = lambda ip: (
+        RECORDINGS if ip == '192.168.1.1' else {'error': 'unreachable'})
+    mock_batch.side_effect = lambda ip, paths, chunk_size: {
+        p: {'path': p} for p in paths}
+    summaries = tablo.create_or_update_recordings_database(sync_args())
+    summaries = {s['ip']: s for s in summaries}
+    assert summaries['192.168.1.1']['added'] == 3
+    assert summaries['192.168.1.2']['error'] == 'unreachable'
+    with tablo.open_recordings_db() as db:
+        assert db.devices() == ['192.168.1.1']
+        assert db.recording_ids('192.168.1.1') == set(RECORDINGS)
+
+
+@patch('tablo_downloader.tablo.CHECKPOINT_SIZE', 1)
+@patch('tablo_downloader.apis.batch_details')
+@patch('tablo_downloader.apis.server_recordings')
+def test_sync_checkpoints(mock_recordings, mock_batch, tmp_path):
+    mock_recordings.return_value = RECORDINGS
+    main_thread = threading.get_ident()
+
+    def batch_details(ip, paths, chunk_size):
+        if paths == [RECORDINGS[1]]:
+            # Ctrl-C while this batch is being fetched.
+            signal.pthread_kill(main_thread, signal.SIGINT)
+            time.sleep(0.5)
+        return {p: {'path': p} for p in paths}
+
+    mock_batch.side_effect = batch_details
+    args = sync_args(tablo_ips='192.168.1.1', workers_per_device=1,
+                     batch_size=1)
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        with pytest.raises(KeyboardInterrupt):
+            tablo.update_recordings_db(db, args)
+        # The batches fetched before and during the interruption were
+        # saved, nothing more was fetched, and the sync lock was released.
+        assert db.recording_ids('192.168.1.1') == set(RECORDINGS[:2])
+        assert mock_batch.call_count == 2
+        assert db.sync_lock().acquire(blocking=False)
+
+
+@patch('tablo_downloader.apis.batch_details')
+@patch('tablo_downloader.apis.server_recordings')
+def test_delta_sync_journal(mock_recordings, mock_batch, tmp_path,
+                            monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    states = {RECORDINGS[0]: 'recording'}
+    fetched = []
+
+    def batch_details(ip, paths, chunk_size):
+        fetched.extend(paths)
+        return {p: {'path': p, 'video_details': {
+            'state': states.get(p, 'finished')}} for p in paths}
+
+    mock_batch.side_effect = batch_details
+    mock_recordings.return_value = RECORDINGS
+    args = sync_args(tablo_ips='192.168.1.1')
+    tablo.create_or_update_recordings_database(args)
+    assert sorted(fetched) == sorted(RECORDINGS)
+
+    # Only the in progress recording is re-fetched; unchanged, it isn't
+    # journaled.
+    fetched.clear()
+    summary, = tablo.create_or_update_recordings_database(args)
+    assert fetched == [RECORDINGS[0]]
+    assert summary['updated'] == 0
+
+    # It finishes, one recording is deleted and another is added.
+    fetched.clear()
+    states[RECORDINGS[0]] = 'finished'
+    new_recording = '/recordings/series/episodes/567891'
+    mock_recordings.return_value = [RECORDINGS[0], RECORDINGS[1],
+                                    new_recording]
+    summary, = tablo.create_or_update_recordings_database(args)
+    assert sorted(fetched) == [RECORDINGS[0], new_recording]
+    assert (summary['added'], summary['updated'], summary['removed']) == (
+        1, 1, 1)
+
+    # Nothing in progress, so nothing is fetched.
+    fetched.clear()
+    tablo.create_or_update_recordings_database(args)
+    assert fetched == []
+
+    with tablo.open_recordings_db() as db:
+        changes = [(c['change'], c['recording_id']) for c in db.changes()]
+        assert changes[3:] == [('removed', RECORDINGS[2]),
+                               ('added', new_recording),
+                               ('updated', RECORDINGS[0])]
+        assert [c['change'] for c in db.changes(since=3)] == [
+            'removed', 'added', 'updated']
+
+
+def test_run_download_jobs_limits():
+    lock = threading.Lock()
+    running = {'192.168.1.1': 0, '192.168.1.2': 0, 'total': 0}
+    peaks = dict(running)
+
+    def download(ip, recording_id):
+        with lock:
+            for key in (ip, 'total'):
+                running[key] += 1
+                peaks[key] = max(peaks[key], running[key])
+        time.sleep(0.01)
+        with lock:
+            running[ip] -= 1
+            running['total'] -= 1
+        return None if recording_id == 'bad' else ''
+
+    jobs = [('192.168.1.1', str(i)) for i in range(6)]
+    jobs += [('192.168.1.2', str(i)) for i in range(5)]
+    jobs += [('192.168.1.2', 'bad')]
+    results = tablo.run_download_jobs(
+        jobs, download, {'192.168.1.1': 2, '192.168.1.2': 1}, 3)
+    assert [(r['ip'], r['recording_id']) for r in results] == jobs
+    assert [r['filename'] for r in results].count(None) == 1
+    assert peaks == {'192.168.1.1': 2, '192.168.1.2': 1, 'total': 3}
+
+
+def test_download_queue_close():
+    started = threading.Event()
+    release = threading.Event()
+    lookups = []
+
+    def download(ip, recording_id):
+        started.set()
+        release.wait(5)
+        return ''
+
+    def device_limit(ip):
+        # Looked up without holding the queue's lock, so other threads
+        # can use the queue meanwhile.
+        other = threading.Thread(target=queue.pending)
+        other.start()
+        other.join(1)
+        lookups.append(not other.is_alive())
+        return 1
+
+    queue = tablo.DownloadQueue(download, device_limit, 2)
+    assert queue.put('192.168.1.1', '1')
+    assert queue.put('192.168.1.1', '2')
+    assert lookups == [True]
+    started.wait(5)
+    closer = threading.Thread(target=queue.close)
+    closer.start()
+    while queue.pending() > 1:
+        time.sleep(0.01)
+    release.set()
+    closer.join(5)
+    # The running job finishes, the queued one is dropped, and nothing is
+    # started or queued after closing.
+    assert list(queue.results) == [('192.168.1.1', '1')]
+    assert queue.pending() == 0
+    assert not queue.put('192.168.1.1', '3')
+
+
+@patch('tablo_downloader.tablo.open_recordings_db')
+def test_downloads_require_recordings_directory(mock_open_db, caplog):
+    args = argparse.Namespace(recordings_directory=None,
+                              tablo_ips='192.168.1.1',
+                              recording_id=RECORDINGS[0])
+    assert tablo.download_all_recordings(args) == []
+    tablo.download_recording(args)
+    mock_open_db.assert_not_called()
+    assert [r.getMessage() for r in caplog.records] == [
+        '--download_all requires --recordings_directory',
+        '--download_recording requires --recordings_directory',
+    ]
+
+
+def test_quality_setting_parsed(monkeypatch):
+    monkeypatch.setattr('sys.argv', ['tldl'])
+    monkeypatch.setattr(tablo, 'load_settings', lambda: {'quality': '3M'})
+    assert tablo.parse_args_and_settings().quality == 3000000
+    monkeypatch.setattr(tablo, 'load_settings', lambda: {'quality': 'x'})
+    with pytest.raises(SystemExit):
+        tablo.parse_args_and_settings()
+
+
+@patch('tablo_downloader.apis.server_information')
+def test_device_download_limit(mock_info):
+    mock_info.return_value = {'model': {'tuners': 4}}
+    assert tablo.device_download_limit('192.168.1.1') == 4
+    assert tablo.device_download_limit('192.168.1.1', override=1) == 1
+    mock_info.return_value = {'error': 'unreachable'}
+    assert tablo.device_download_limit('192.168.1.1') == 1
+
+
+def test_dump_recordings(tmp_path):
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        details = mock_api_responses.recording_details('').json()
+        db.put(mock_api_responses.PRIVATE_IP, details['path'],
+               {'category': 'series', 'details': details})
+        out = io.StringIO()
+        tablo.dump_recordings(db, out)
+    assert out.getvalue().splitlines() == [
+        'Filename : Show_Title_-_Episode_Title_-_S02E10.mp4',
+        'Title Tag: Show Title - Episode Title',
+        'Desc:      Episode Description',
+        'Path:      /recordings/series/episodes/567890',
+        '',
+    ]
+
+
+def test_dump_recordings_formats(tmp_path):
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        details = mock_api_responses.recording_details('').json()
+        db.put(mock_api_responses.PRIVATE_IP, details['path'],
+               {'category': 'series', 'details': details})
+        out = io.StringIO()
+        tablo.dump_recordings(db, out, output_format='jsonl')
+        row, = [json.loads(line) for line in out.getvalue().splitlines()]
+        assert row['filename'] == 'Show_Title_-_Episode_Title_-_S02E10.mp4'
+        assert (row['season'], row['episode']) == (2, 10)
+        assert row['downloaded_at'] is None
+
+        out = io.StringIO()
+        tablo.dump_recordings(db, out, output_format='csv')
+        header, line = out.getvalue().splitlines()
+        assert header.split(',') == list(tablo.DUMP_FIELDS)
+        assert line.startswith(mock_api_responses.PRIVATE_IP + ',')
+
+        args = argparse.Namespace(
+            category='movies', show_title=None, device=None, aired_after=None,
+            aired_before=None, download_state='not_downloaded')
+        out = io.StringIO()
+        tablo.dump_recordings(db, out, output_format='jsonl',
+                              **tablo.dump_filters(args))
+        assert out.getvalue() == ''
+
+
+def test_progress_reporter(tmp_path):
+    events = tmp_path / 'events.jsonl'
+    args = argparse.Namespace(progress_events=str(events))
+    on_event = tablo.progress_reporter(args, '192.168.1.1', RECORDINGS[0])
+    progress = hls.Progress('out.mp4', duration=100, on_event=on_event)
+    progress.add_segment(1000, 10.0)
+    progress.emit()
+    progress.emit('finished')
+    lines = [json.loads(line) for line in events.read_text().splitlines()]
+    assert [e['event'] for e in lines] == ['progress', 'finished']
+    assert lines[0]['recording_id'] == RECORDINGS[0]
+    assert lines[0]['fraction'] == 0.1
+
+
+@patch('tablo_downloader.tablo.download_from_db')
+@patch('tablo_downloader.apis.batch_details')
+@patch('tablo_downloader.apis.server_recordings')
+def test_watcher(mock_recordings, mock_batch, mock_download, tmp_path,
+                 monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    states = {RECORDINGS[0]: 'recording'}
+    mock_batch.side_effect = lambda ip, paths, chunk_size: {
+        p: {'path': p, 'video_details': {
+            'state': states.get(p, 'finished')}} for p in paths}
+    mock_recordings.return_value = RECORDINGS
+    downloads = []
+    failures = [RECORDINGS[2]]
+
+    def download(db, ip, recording_id, args):
+        downloads.append(recording_id)
+        if recording_id in failures:
+            failures.remove(recording_id)
+            return None
+        db.mark_downloaded(ip, recording_id, recording_id, 'now')
+        return recording_id
+
+    mock_download.side_effect = download
+    args = sync_args(tablo_ips='192.168.1.1', category=None, show_title=None,
+                     downloads_per_device=1, max_downloads=2,
+                     poll_interval=40, active_poll_interval=10)
+    with tablo.open_recordings_db() as db, tablo.Watcher(db, args) as watcher:
+        # Finished recordings are downloaded; the failed one is retried on
+        # the next poll.
+        watcher.run(cycles=1)
+        watcher.queue.join()
+        assert sorted(downloads) == sorted(RECORDINGS[1:])
+        assert watcher.interval == 10
+        assert watcher.failed == {('192.168.1.1', RECORDINGS[2])}
+
+        # The in progress recording finishes.
+        downloads.clear()
+        states[RECORDINGS[0]] = 'finished'
+        watcher.run(cycles=1)
+        watcher.queue.join()
+        assert sorted(downloads) == sorted([RECORDINGS[0], RECORDINGS[2]])
+        assert watcher.interval == 10
+
+        # Nothing changes, so polls back off.
+        downloads.clear()
+        watcher.run(cycles=1)
+        watcher.queue.join()
+        assert downloads == []
+        assert watcher.interval == 20
+        watcher.run(cycles=1)
+        watcher.run(cycles=1)
+        assert watcher.interval == 40
+        # Processed journal entries are pruned.
+        assert db.journal_cursor(tablo.WATCH_JOURNAL_CONSUMER) == 4
+        assert db.changes() == []
+
+
+@patch('tablo_downloader.apis.delete_recording')
+@patch('tablo_downloader.hls.download')
+@patch('tablo_downloader.apis.playlist_info')
+def test_download_from_db_gates_delete(mock_playlist, mock_download,
+                                       mock_delete, tmp_path):
+    mock_playlist.return_value = {'playlist_url': 'http://x/pl.m3u8'}
+    recording = RECORDINGS[0]
+    args = argparse.Namespace(
+        recordings_directory=str(tmp_path), dry_run=False, overwrite=True,
+        segment_workers=1, segment_buffer=1, progress_interval=0,
+        progress_events=None, stall_timeout=0, quality='highest',
+        delete_originals_after_downloading=True)
+
+    def download(url, mp4_filename, title, verified, **kwargs):
+        with open(mp4_filename, 'wb') as f:
+            f.write(b'mp4')
+        return {'verified': verified, 'problems': [] if verified else [
+            'Got [1] of [2] segments']}
+
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        db.put('192.168.1.1', recording, {
+            'category': 'series', 'details': mock_api_responses
+            .recording_details(recording).json()})
+        mock_download.side_effect = lambda *a, **kw: download(
+            *a, verified=False, **kw)
+        filename = tablo.download_from_db(db, '192.168.1.1', recording, args)
+        # A download that fails verification is removed and left not
+        # downloaded, so the next run retries it.
+        assert filename is None
+        assert not list(tmp_path.glob('**/*.mp4'))
+        assert list(db.recording_ids_matching(downloaded=True)) == []
+        assert db.queued_deletes() == []
+        assert db.get_verification('192.168.1.1', recording)[
+            'problems'] == ['Got [1] of [2] segments']
+
+        mock_download.side_effect = lambda *a, **kw: download(
+            *a, verified=True, **kw)
+        tablo.download_from_db(db, '192.168.1.1', recording, args)
+        assert mock_download.call_args[1]['duration'] == 3456
+        # Deletes are queued for a DeleteWorker rather than made inline.
+        mock_delete.assert_not_called()
+        entry, = db.queued_deletes()
+        assert entry['recording_id'] == recording
+        mock_delete.return_value = ''
+        with tablo.DeleteWorker(db, poll_interval=0.01):
+            pass
+        mock_delete.assert_called_once_with('192.168.1.1', recording)
+        assert db.queued_deletes() == []
+        assert db.get('192.168.1.1', recording) is None
+
+
+@patch('tablo_downloader.hls.download')
+@patch('tablo_downloader.apis.playlist_info')
+def test_download_from_db_missing_directory(mock_playlist, mock_download,
+                                            tmp_path, caplog):
+    mock_playlist.return_value = {'playlist_url': 'http://x/pl.m3u8'}
+    missing = str(tmp_path / 'missing')
+    args = argparse.Namespace(recordings_directory=missing, dry_run=False)
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        db.put('192.168.1.1', RECORDINGS[0], {
+            'category': 'series', 'details': mock_api_responses
+            .recording_details(RECORDINGS[0]).json()})
+        assert tablo.download_from_db(
+            db, '192.168.1.1', RECORDINGS[0], args) is None
+    mock_download.assert_not_called()
+    assert caplog.records[-1].getMessage() == (
+        'Recordings directory [%s] does not exist' % missing)
+
+
+@patch('tablo_downloader.hls.download')
+@patch('tablo_downloader.apis.playlist_info')
+def test_in_progress_recordings_not_deleted(mock_playlist, mock_download,
+                                            tmp_path):
+    mock_playlist.return_value = {'playlist_url': 'http://x/pl.m3u8'}
+
+    def download(url, mp4_filename, title, **kwargs):
+        with open(mp4_filename, 'wb') as f:
+            f.write(b'mp4')
+        return {'verified': True, 'problems': []}
+
+    mock_download.side_effect = download
+    args = argparse.Namespace(
+        recordings_directory=str(tmp_path), dry_run=False, overwrite=True,
+        segment_workers=1, segment_buffer=1, progress_interval=0,
+        progress_events=None, stall_timeout=0, quality='highest',
+        delete_originals_after_downloading=True, tablo_ips='192.168.1.1',
+        category=None, show_title=None)
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        for recording in RECORDINGS[:2]:
+            details = mock_api_responses.recording_details(recording).json()
+            details['path'] = recording
+            if recording == RECORDINGS[0]:
+                details['video_details']['state'] = 'recording'
+            db.put('192.168.1.1', recording, {
+                'category': recording.split('/')[2], 'details': details})
+        assert tablo.plan_downloads(db, args) == [
+            ('192.168.1.1', RECORDINGS[1])]
+
+        # Downloaded anyway, e.g. with --download_recording, it is kept on
+        # the device.
+        assert tablo.download_from_db(db, '192.168.1.1', RECORDINGS[0],
+                                      args)
+        assert db.queued_deletes() == []
+
+
+@patch('tablo_downloader.hls.download')
+@patch('tablo_downloader.apis.playlist_info')
+def test_download_from_db_locks_destination(mock_playlist, mock_download,
+                                            tmp_path):
+    mock_playlist.return_value = {'playlist_url': 'http://x/pl.m3u8'}
+    recording = RECORDINGS[0]
+    args = argparse.Namespace(recordings_directory=str(tmp_path),
+                              dry_run=False)
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        db.put('192.168.1.1', recording, {
+            'category': 'series', 'details': mock_api_responses
+            .recording_details(recording).json()})
+        filename = db.get_summary('192.168.1.1', recording)['filename']
+        lock = filelock.FileLock(tablo.download_lock_filename(
+            str(tmp_path / filename)))
+        assert lock.acquire(blocking=False)
+        assert tablo.download_from_db(db, '192.168.1.1', recording,
+                                      args) is None
+        lock.release()
+    mock_download.assert_not_called()
+
+
+@patch('tablo_downloader.tablo.DELETE_RETRY_DELAY', 0.01)
+@patch('tablo_downloader.apis.delete_recording')
+def test_delete_worker_retries(mock_delete, tmp_path):
+    results = {
+        RECORDINGS[0]: ['', {'error': 'failed', 'status_code': 500}],
+        RECORDINGS[1]: [{'error': 'failed', 'status_code': 404}],
+        RECORDINGS[2]: [{'error': 'failed', 'exception': OSError()}] * 5,
+    }
+    mock_delete.side_effect = lambda ip, r: results[r].pop()
+    with database.RecordingsDB(str(tmp_path / 'db.sqlite')) as db:
+        db.put_many('192.168.1.1', {r: {'category': 'series', 'details': {}}
+                                    for r in RECORDINGS})
+        db.queue_deletes('192.168.1.1', RECORDINGS)
+        with tablo.DeleteWorker(db, workers=2, poll_interval=0.01) as worker:
+            pass
+        assert (worker.deleted, worker.failed) == (2, 1)
+        assert mock_delete.call_count == 2 + 1 + tablo.DELETE_ATTEMPTS
+        entry, = db.queued_deletes()
+        assert entry['recording_id'] == RECORDINGS[2]
+        assert entry['attempts'] == tablo.DELETE_ATTEMPTS
+        assert db.recording_ids('192.168.1.1') == {RECORDINGS[2]}
+        # Queueing a recording again retries it from scratch.
+        db.queue_deletes('192.168.1.1', [RECORDINGS[2]])
+        assert db.queued_deletes(max_attempts=1)[0]['attempts'] == 0
+
+
+@patch('tablo_downloader.apis.delete_recording')
+def test_purge_downloaded(mock_delete, tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    mock_delete.return_value = ''
+    mp4 = tmp_path / 'a.mp4'
+    mp4.write_bytes(b'mp4')
+    with tablo.open_recordings_db() as db:
+        db.put_many('192.168.1.1', {r: {'category': 'series', 'details': {}}
+                                    for r in RECORDINGS})
+        db.mark_downloaded('192.168.1.1', RECORDINGS[0], str(mp4), 'now',
+                           {'verified': True})
+        db.mark_downloaded('192.168.1.1', RECORDINGS[1], str(mp4), 'now',
+                           {'verified': False})
+        db.mark_downloaded('192.168.1.1', RECORDINGS[2], str(mp4), 'now')
+    args = argparse.Namespace(category=None, show_title=None, dry_run=True,
+                              delete_workers=2)
+    tablo.purge_downloaded(args)
+    mock_delete.assert_not_called()
+    args.dry_run = False
+    tablo.purge_downloaded(args)
+    mock_delete.assert_called_once_with('192.168.1.1', RECORDINGS[0])
+    with tablo.open_recordings_db() as db:
+        assert db.recording_ids('192.168.1.1') == set(RECORDINGS[1:])